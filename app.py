@@ -2,16 +2,28 @@ import streamlit as st
 import os
 import json
 import configparser
+import copy
 from datetime import datetime
 import io
-import base64
+import shutil
+import tempfile
+import zipfile
+import threading
 import time
+from concurrent.futures import Future
 from pathlib import Path
 
 # Import processing functions
-from pptx_extractor import extract_text_from_pptx
-from kpi_extractor import extract_kpis_with_ai
+from pptx_extractor import document_digest, parse_decks, spool_upload
+from kpi_extractor import extract_kpis_with_ai, extract_kpis_packed
 from email_generator import generate_email, are_pmax_and_vla_identical
+import deck_metadata
+import job_queue
+import kpi_history
+import llm_archive
+import providers
+from pipeline import Pipeline, format_stats
+import store_registry
 
 # Set page config
 st.set_page_config(page_title="Dealership Report Parser", layout="wide")
@@ -78,31 +90,28 @@ st.markdown("""
 CONFIG_FILE = "parser_config.ini"
 
 def load_config():
-    """Load API keys from config file or environment variables"""
+    """Load API keys (secrets, env vars, then config file – see providers.api_key) and settings"""
+    registry = providers.load_providers()
     config = {
-        "claude_api_key": None,
-        "openai_api_key": None,
-        "deepseek_api_key": None,
-        "default_ai": "claude"
+        "api_keys": {},
+        "default_ai": "claude",
+        "max_open_mb": 512,
+        "llm_concurrency": 0,
+        "queue_depth": 4
     }
     
-    # Try to load from Streamlit secrets
+    # Streamlit secrets take precedence over env vars and the config file
+    secret_keys = {}
     try:
         if "API_KEYS" in st.secrets:
-            config["claude_api_key"] = st.secrets["API_KEYS"].get("claude")
-            config["openai_api_key"] = st.secrets["API_KEYS"].get("openai")
-            config["deepseek_api_key"] = st.secrets["API_KEYS"].get("deepseek")
+            secret_keys = dict(st.secrets["API_KEYS"])
             config["default_ai"] = st.secrets.get("SETTINGS", {}).get("default_ai", config["default_ai"])
     except Exception as e:
         print(f"Error loading secrets: {e}")
     
-    # Then try environment variables (as fallback)
-    if not config["claude_api_key"]:
-        config["claude_api_key"] = os.environ.get("CLAUDE_API_KEY")
-    if not config["openai_api_key"]:
-        config["openai_api_key"] = os.environ.get("OPENAI_API_KEY")
-    if not config["deepseek_api_key"]:
-        config["deepseek_api_key"] = os.environ.get("DEEPSEEK_API_KEY")
+    for name, spec in registry.items():
+        if spec.needs_key and not spec.key_name:   # variants share their owner's key
+            config["api_keys"][name] = providers.api_key(name, secret_keys)
     if not config["default_ai"]:
         config["default_ai"] = os.environ.get("DEFAULT_AI", config["default_ai"])
     
@@ -110,46 +119,109 @@ def load_config():
     if os.path.exists(CONFIG_FILE):
         parser = configparser.ConfigParser()
         parser.read(CONFIG_FILE)
-        if "API_KEYS" in parser:
-            if not config["claude_api_key"] and "claude" in parser["API_KEYS"]:
-                config["claude_api_key"] = parser["API_KEYS"]["claude"]
-            if not config["openai_api_key"] and "openai" in parser["API_KEYS"]:
-                config["openai_api_key"] = parser["API_KEYS"]["openai"]
-            if not config["deepseek_api_key"] and "deepseek" in parser["API_KEYS"]:
-                config["deepseek_api_key"] = parser["API_KEYS"]["deepseek"]
         if "SETTINGS" in parser and "default_ai" in parser["SETTINGS"]:
             config["default_ai"] = parser["SETTINGS"]["default_ai"]
+        if "SETTINGS" in parser and "max_open_mb" in parser["SETTINGS"]:
+            config["max_open_mb"] = parser["SETTINGS"].getint("max_open_mb")
+        for key in ("llm_concurrency", "queue_depth"):
+            if "SETTINGS" in parser and key in parser["SETTINGS"]:
+                config[key] = parser["SETTINGS"].getint(key)
     
     return config
 
 def save_config(config):
-    """Save API keys to config file"""
+    """Save API keys and settings, keeping any other sections ([QUEUE], [PROVIDER ...])"""
     parser = configparser.ConfigParser()
+    if os.path.exists(CONFIG_FILE):
+        parser.read(CONFIG_FILE)
     
-    parser["API_KEYS"] = {
-        "claude": config["claude_api_key"] or "",
-        "openai": config["openai_api_key"] or "",
-        "deepseek": config["deepseek_api_key"] or ""
-    }
+    parser["API_KEYS"] = {name: key or "" for name, key in config["api_keys"].items()}
     
     parser["SETTINGS"] = {
-        "default_ai": config["default_ai"]
+        "default_ai": config["default_ai"],
+        "max_open_mb": str(config["max_open_mb"]),
+        "llm_concurrency": str(config["llm_concurrency"]),
+        "queue_depth": str(config["queue_depth"])
     }
     
     with open(CONFIG_FILE, 'w') as f:
         parser.write(f)
 
-def get_download_link(text, filename, link_text, is_html=False):
-    """Generate a download link for text content"""
-    if is_html:
-        # Set MIME type for HTML content
-        mime_type = "text/html"
+ALL_EMAILS_HTML_HEAD = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>All Dealership Reports</title>
+    <style>
+        body { font-family: Arial, sans-serif; }
+        .email-container { margin-bottom: 50px; border-bottom: 2px solid #ddd; padding-bottom: 30px; }
+        h2 { color: #2c3e50; }
+    </style>
+</head>
+<body>
+"""
+ALL_EMAILS_HTML_TAIL = """
+</body>
+</html>
+"""
+
+def cache_minimums(name):
+    """'claude-3-opus-20240229: 1,024 tokens, …' for a provider and its fast variant"""
+    registry = providers.load_providers()
+    spec = registry[name]
+    specs = [spec] + ([registry[spec.fast_variant]] if spec.fast_variant in registry else [])
+    return ", ".join(f"{s.model}: {s.min_cache_tokens:,} tokens" for s in specs if s.min_cache_tokens) \
+        or "see the provider's documentation"
+
+def output_basename(result, selected_month, selected_year):
+    """Base filename shared by a report's email and KPI downloads"""
+    if result.get('store'):
+        slug = result['store']['slug']   # canonical: account id + registry name
     else:
-        mime_type = "file/txt"
-    
-    b64 = base64.b64encode(text.encode()).decode()
-    href = f'<a href="data:{mime_type};base64,{b64}" download="{filename}">{link_text}</a>'
-    return href
+        slug = store_registry.Store("", None, result['kpis'].get('store_name') or "").slug
+    return f"{slug}_{selected_month}_{selected_year}"
+
+def write_zip_bundle(results, path, selected_month, selected_year):
+    """Write every report plus the combined files into a ZIP on disk.
+
+    Each member is streamed into the archive one report at a time, so the
+    bundle never has to exist as a single string in memory.
+    """
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        used = {}
+        for r in results:
+            base = output_basename(r, selected_month, selected_year)
+            used[base] = used.get(base, 0) + 1
+            if used[base] > 1:   # same store twice in one batch
+                base = f"{base}_{used[base]}"
+            zf.writestr(f"{base}_email.html", r['email']['html'])
+            zf.writestr(f"{base}_email.txt", r['email']['plain'])
+            zf.writestr(f"{base}_kpis.json", json.dumps(r['kpis'], indent=2))
+
+        with zf.open(f"all_emails_{selected_month}_{selected_year}.txt", "w") as fh:
+            for r in results:
+                fh.write(("=" * 40 + f"\n{r['filename']}\n" + "=" * 40 + f"\n{r['email']['plain']}\n\n\n").encode())
+
+        with zf.open(f"all_emails_{selected_month}_{selected_year}.html", "w") as fh:
+            fh.write(ALL_EMAILS_HTML_HEAD.encode())
+            for r in results:
+                store = r['kpis'].get('store_name', 'Unknown Dealership')
+                fh.write(f"""
+                <div class="email-container">
+                    <h2>{store} - {r['filename']}</h2>
+                    {r['email']['html']}
+                </div>
+                """.encode())
+            fh.write(ALL_EMAILS_HTML_TAIL.encode())
+
+        with zf.open(f"all_kpis_{selected_month}_{selected_year}.json", "w") as fh:
+            fh.write(b"{")
+            for i, r in enumerate(results):
+                sep = "," if i else ""
+                fh.write(f"{sep}\n  {json.dumps(r['filename'])}: {json.dumps(r['kpis'])}".encode())
+            fh.write(b"\n}\n")
+    return path
 
 def main():
     # Load configuration
@@ -162,27 +234,21 @@ def main():
         # API Key Management
         st.header("API Keys")
         
+        registry = providers.load_providers()
         with st.expander("Manage API Keys"):
-            claude_key = st.text_input("Claude API Key", value=config["claude_api_key"] or "", type="password")
-            openai_key = st.text_input("OpenAI API Key", value=config["openai_api_key"] or "", type="password")
-            deepseek_key = st.text_input("DeepSeek API Key", value=config["deepseek_api_key"] or "", type="password")
+            entered = {name: st.text_input(f"{registry[name].label} API Key", value=key or "", type="password")
+                       for name, key in config["api_keys"].items()}
             
             if st.button("Save API Keys"):
-                config["claude_api_key"] = claude_key
-                config["openai_api_key"] = openai_key
-                config["deepseek_api_key"] = deepseek_key
+                config["api_keys"].update(entered)
                 save_config(config)
                 st.success("API keys saved successfully!")
         
-        # AI Provider Selection
+        # AI Provider Selection (keyless local providers are listed when enabled in the registry)
         st.header("AI Provider")
-        ai_options = []
-        if config["claude_api_key"]:
-            ai_options.append("claude")
-        if config["openai_api_key"]:
-            ai_options.append("openai")
-        if config["deepseek_api_key"]:
-            ai_options.append("deepseek")
+        ai_options = [name for name, spec in registry.items()
+                      if spec.listed and (not spec.needs_key or config["api_keys"].get(name)
+                                          or llm_archive.replaying())]
         
         if not ai_options:
             st.warning("Please add at least one API key to continue.")
@@ -194,6 +260,37 @@ def main():
             if selected_ai != config["default_ai"]:
                 config["default_ai"] = selected_ai
                 save_config(config)
+        
+        # Resource limits
+        st.header("Performance")
+        max_open_mb = st.number_input("Memory ceiling for open decks (MB, 0 = no limit)",
+                                      min_value=0, step=64, value=int(config["max_open_mb"]))
+        if max_open_mb != config["max_open_mb"]:
+            config["max_open_mb"] = max_open_mb
+            save_config(config)
+        llm_concurrency = st.number_input("Concurrent AI calls (0 = provider limit)",
+                                          min_value=0, max_value=64, value=int(config["llm_concurrency"]))
+        queue_depth = st.number_input("Pipeline queue depth (decks between stages)",
+                                      min_value=1, max_value=64, value=int(config["queue_depth"]),
+                                      help="How far parsing may run ahead of the AI calls, and the AI "
+                                           "calls ahead of email generation.")
+        if (llm_concurrency, queue_depth) != (config["llm_concurrency"], config["queue_depth"]):
+            config["llm_concurrency"], config["queue_depth"] = llm_concurrency, queue_depth
+            save_config(config)
+        route_models = st.checkbox("Route simple decks to a faster model", value=True,
+                                   help="Decks the regex pass already reads cleanly go to the provider's "
+                                        "fast model; the result is re-checked and re-asked on the full "
+                                        "model if it doesn't hold up.")
+        pack_decks = st.checkbox("Pack small decks into shared requests", value=False,
+                                 help="Sends several condensed decks per LLM call (one schema per deck) "
+                                      "to cut per-request overhead. Cards appear once each pack returns.")
+        
+        # Background processing (see job_queue.py)
+        st.header("Job Queue")
+        use_queue = st.checkbox("Run in background job queue", value=False,
+                                help="Decks are processed by `python job_queue.py worker` processes, "
+                                     "shared fairly with other users.")
+        queue_user = st.text_input("Your name (for fair scheduling)", value=os.environ.get("USER", "anonymous"))
     
     # Main content area
     st.markdown('<h1 class="main-header">Dealership Report Parser</h1>', unsafe_allow_html=True)
@@ -221,217 +318,416 @@ def main():
                                        accept_multiple_files=True)
     
     if uploaded_files and selected_ai:
-        # Get the appropriate API key
-        if selected_ai == "claude":
-            api_key = config["claude_api_key"]
-        elif selected_ai == "openai":
-            api_key = config["openai_api_key"]
-        else:  # deepseek
-            api_key = config["deepseek_api_key"]
+        # Get the appropriate API key ("" for providers that need none)
+        api_key = config["api_keys"].get(selected_ai, "")
         
         # Process button
         if st.button("Process Reports"):
-            if not api_key:
+            if registry[selected_ai].needs_key and not api_key and not llm_archive.replaying():
                 st.error(f"No API key found for {selected_ai}. Please add your API key in the configuration.")
+            elif use_queue:
+                # Hand the batch to the worker processes and poll below
+                files = [(f.name, spool_upload(f, job_queue.spool_dir())) for f in uploaded_files]
+                st.session_state["batch_id"] = job_queue.submit_batch(
+                    queue_user or "anonymous", selected_ai, f"{selected_month} {selected_year}", files)
+                st.session_state["report_period"] = (selected_month, selected_year)
+                st.session_state.pop("results", None)
+                st.session_state.pop("bundle", None)
             else:
                 # Create a progress bar
                 progress_bar = st.progress(0)
                 progress_text = st.empty()
+                summary = st.empty()
+                results_area = st.container()
                 
-                # Process each file
+                # Parse decks across processes; each card renders as soon as
+                # its deck is parsed, extracted and turned into an email
+                progress_text.text(f"Parsing {len(uploaded_files)} reports...")
+                spool_dir = tempfile.mkdtemp(prefix="report_uploads_")
+                sources = {i: spool_upload(f, spool_dir) for i, f in enumerate(uploaded_files)}
+                max_open_mb = int(config["max_open_mb"]) or None
                 results = []
-                for i, uploaded_file in enumerate(uploaded_files):
-                    progress_text.text(f"Processing {uploaded_file.name}...")
-                    
-                    try:
-                        # Extract text from PPTX
-                        extracted_text, _ = extract_text_from_pptx(uploaded_file)
-                        
-                        # Extract KPIs using AI
-                        progress_text.text(f"Extracting KPIs from {uploaded_file.name}...")
-                        kpis = extract_kpis_with_ai(api_key, extracted_text, selected_ai)
-                        
-                        # Generate email template
-                        progress_text.text(f"Generating email for {uploaded_file.name}...")
-                        email_content = generate_email(kpis, f"{selected_month} {selected_year}")
-                        
-                        # Add to results
-                        results.append({
-                            "filename": uploaded_file.name,
-                            "kpis": kpis,
-                            "email": email_content
-                        })
+                seen = {}   # document digest → (first filename, Future of its KPIs)
+                pipeline_stats = None
+                batch_usage = {}   # token totals incl. prompt-cache reads/writes
+                pending = {}   # pack mode: digest → text, extracted after parsing
+                pending_kpis = {}   # pack mode: digest → regex slide KPIs
+                pending_meta = {}   # pack mode: digest → store / period known without the LLM
+                waiting = {}   # pack mode: digest → filenames sharing that text
+                
+                period = f"{selected_month} {selected_year}"
+                
+                def build_result(filename, kpis, duplicate_of=None, route=None, repairs=None):
+                    """Store, email and history for one extracted deck (no Streamlit calls – runs off the script thread)"""
+                    store = store_registry.resolve(filename, kpis.get("store_name"))
+                    month = kpi_history.report_month(kpis, period)
+                    result = {
+                        "filename": filename,
+                        "kpis": kpis,
+                        "store": store.as_dict(),
+                        "email": generate_email(kpis, period, kpi_history.previous(store.key, month))
+                    }
+                    kpi_history.record(kpis, month, store.key)
+                    if duplicate_of:
+                        result["duplicate_of"] = duplicate_of
+                    if route:
+                        result["route"] = route
+                    if repairs:
+                        result["repairs"] = repairs
+                    return result
+                
+                def emit(filename, kpis=None, error=None, duplicate_of=None, route=None, repairs=None, result=None):
+                    if result is None and error is None:
+                        try:
+                            progress_text.text(f"Generating email for {filename}...")
+                            result = build_result(filename, kpis, duplicate_of, route, repairs)
+                        except Exception as e:
+                            error = e
+                    if error is not None:
+                        result = {"filename": filename, "error": str(error)}
+                    results.append(result)
+                    with results_area:
+                        render_result(result, len(results) - 1, selected_month, selected_year)
+                    progress_bar.progress(len(results) / len(uploaded_files))
+                    progress_text.text(f"Processed {len(results)} of {len(uploaded_files)} files")
+                
+                if pack_decks:
+                    for i, parsed in parse_decks(sources, max_open_mb=max_open_mb):
+                        uploaded_file = uploaded_files[i]
+                        os.remove(sources[i])   # spooled copy is no longer needed
                         
-                    except Exception as e:
-                        st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+                        if isinstance(parsed, Exception):
+                            emit(uploaded_file.name, error=parsed)
+                            continue
+                        digest = document_digest(parsed["text"])
+                        pending.setdefault(digest, parsed["text"])
+                        pending_kpis.setdefault(digest, parsed["kpis"])
+                        pending_meta.setdefault(digest, deck_metadata.known_fields(uploaded_file.name, parsed))
+                        waiting.setdefault(digest, []).append(uploaded_file.name)
+                        progress_text.text(f"Parsed {uploaded_file.name}")
+                else:
+                    # Parsing, AI calls and emails overlap (see pipeline.py)
+                    seen_lock = threading.Lock()
+                    streaming = {}   # filename → chars received so far, written by the AI threads
+                    
+                    def drop_spool(i):
+                        try:
+                            os.remove(sources[i])   # spooled copy is no longer needed
+                        except OSError:
+                            pass
+                    
+                    def show_streams():
+                        # drawn from the script thread while the pipeline waits
+                        active = sorted(streaming.items())
+                        if active:
+                            shown = ", ".join(f"{n} ({c:,} chars)" for n, c in active[:3])
+                            more = f" and {len(active) - 3} more" if len(active) > 3 else ""
+                            progress_text.text(f"Extracting KPIs from {shown}{more}... "
+                                               f"({len(results)} of {len(uploaded_files)} done)")
+                    
+                    def extract(i, parsed):
+                        name = uploaded_files[i].name
+                        digest = document_digest(parsed["text"])
+                        with seen_lock:
+                            owner = digest not in seen
+                            if owner:
+                                seen[digest] = (name, Future())
+                        first_name, first = seen[digest]
+                        if not owner:
+                            # Identical content uploaded under another name: reuse its KPIs
+                            return {"kpis": copy.deepcopy(first.result()), "duplicate_of": first_name}
+                        route, repairs, usage = {}, [], {}
+                        def show_stream(chars):
+                            streaming[name] = chars
+                        try:
+                            kpis = extract_kpis_with_ai(api_key, parsed["text"], selected_ai, on_progress=show_stream,
+                                                        usage=usage, deck=parsed if route_models else None, route=route,
+                                                        repairs=repairs, slide_kpis=parsed["kpis"],
+                                                        metadata=deck_metadata.known_fields(name, parsed))
+                        except Exception as e:
+                            first.set_exception(e)
+                            raise
+                        finally:
+                            streaming.pop(name, None)
+                        first.set_result(kpis)
+                        return {"kpis": kpis, "route": route, "repairs": repairs, "usage": usage}
                     
-                    # Update progress
-                    progress = (i + 1) / len(uploaded_files)
-                    progress_bar.progress(progress)
-                    progress_text.text(f"Processed {i + 1} of {len(uploaded_files)} files")
+                    def render(i, parsed, extracted):
+                        result = build_result(uploaded_files[i].name, extracted["kpis"],
+                                              extracted.get("duplicate_of"), extracted.get("route"),
+                                              extracted.get("repairs"))
+                        return result, extracted.get("usage", {})
+                    
+                    concurrency = int(config["llm_concurrency"]) or providers.get_provider(selected_ai).max_concurrency
+                    pipe = Pipeline(extract, render, llm_concurrency=concurrency,
+                                    parse_queue=int(config["queue_depth"]), render_queue=int(config["queue_depth"]),
+                                    max_open_mb=max_open_mb, on_parsed=drop_spool)
+                    progress_text.text(f"Processing {len(uploaded_files)} reports "
+                                       f"({concurrency} AI calls at a time)...")
+                    for i, done in pipe.run(sources, idle=show_streams):
+                        if isinstance(done, Exception):
+                            emit(uploaded_files[i].name, error=done)
+                            continue
+                        result, usage = done
+                        for k, v in usage.items():
+                            batch_usage[k] = batch_usage.get(k, 0) + v
+                        emit(uploaded_files[i].name, result=result)
+                    pipeline_stats = format_stats(pipe.stats())
+                    print(f"Pipeline: {pipeline_stats}")
+                
+                if pending:
+                    # Several condensed decks per request; identical uploads share one slot
+                    progress_text.text(f"Extracting KPIs from {len(pending)} decks in packs...")
+                    def show_pack(chars):
+                        progress_text.text(f"Extracting KPIs in packs... ({chars:,} chars received)")
+                    pack_repairs = {}   # digest → channel re-asks
+                    for digest, kpis in extract_kpis_packed(api_key, pending, selected_ai,
+                                                            on_progress=show_pack, usage=batch_usage,
+                                                            slide_kpis=pending_kpis, metadata=pending_meta,
+                                                            repairs=pack_repairs):
+                        first, *dupes = waiting[digest]
+                        if isinstance(kpis, Exception):
+                            for name in waiting[digest]:
+                                emit(name, error=kpis)
+                            continue
+                        emit(first, kpis, repairs=pack_repairs.get(digest))
+                        for name in dupes:
+                            emit(name, copy.deepcopy(kpis), duplicate_of=first)
+                
+                shutil.rmtree(spool_dir, ignore_errors=True)
                 
                 # Clear progress indicators
                 progress_bar.empty()
                 progress_text.empty()
                 
-                # Display results
-                st.success(f"Successfully processed {len(results)} reports!")
+                # Keep results across reruns (download buttons trigger one)
+                st.session_state["results"] = results
+                st.session_state["report_period"] = (selected_month, selected_year)
+                st.session_state.pop("bundle", None)
                 
-                # Display each result in an expandable card
-                for result in results:
-                    with st.expander(f"Report: {result['filename']}"):
-                        st.markdown(f"### KPIs Extracted")
-                        
-                        # Display the store name
-                        store_name = result['kpis'].get('store_name', 'Unknown Dealership')
-                        st.markdown(f"**Dealership:** {store_name}")
-                        st.markdown(f"**Date Range:** {result['kpis'].get('date_range', 'Unknown')}")
-                        
-                        # Create columns for different metric groups
-                        col1, col2 = st.columns(2)
-                        
-                        # Display RSA/Search metrics
-                        if any(k.startswith('rsa_') for k in result['kpis']):
-                            with col1:
-                                st.markdown("#### Google Search (RSA)")
-                                st.markdown(f"Impressions: {result['kpis'].get('rsa_impr', '[x,xxx]')}")
-                                st.markdown(f"Clicks: {result['kpis'].get('rsa_clicks', '[xxx]')}")
-                                st.markdown(f"CPC: {result['kpis'].get('rsa_cpc', '$x.xx')}")
-                                st.markdown(f"Conversions: {result['kpis'].get('rsa_conv', '[xx]')}")
-                                st.markdown(f"Cost/Conv: {result['kpis'].get('rsa_cost_conv', '$x.xx')}")
-                        
-                        # Display PMAX metrics (if they're not identical to VLA metrics)
-                        if any(k.startswith('pmax_') and not k.startswith('pmax_vla_') for k in result['kpis']) and not are_pmax_and_vla_identical(result['kpis']):
-                            with col2:
-                                st.markdown("#### Performance Max")
-                                st.markdown(f"Impressions: {result['kpis'].get('pmax_impr', '[x,xxx]')}")
-                                st.markdown(f"Clicks: {result['kpis'].get('pmax_clicks', '[xxx]')}")
-                                st.markdown(f"CPC: {result['kpis'].get('pmax_cpc', '$x.xx')}")
-                                st.markdown(f"Conversions: {result['kpis'].get('pmax_conv', '[xx]')}")
-                                st.markdown(f"Cost/Conv: {result['kpis'].get('pmax_cost_conv', '$x.xx')}")
-                        
-                        # Add more metric groups in new rows
-                        col3, col4 = st.columns(2)
-                        
-                        # Display PMAX VLA metrics
-                        if any(k.startswith('pmax_vla_') for k in result['kpis']):
-                            with col3:
-                                st.markdown("#### Performance Max w/ VLA")
-                                st.markdown(f"Impressions: {result['kpis'].get('pmax_vla_impr', '[x,xxx]')}")
-                                st.markdown(f"Clicks: {result['kpis'].get('pmax_vla_clicks', '[xxx]')}")
-                                st.markdown(f"CPC: {result['kpis'].get('pmax_vla_cpc', '$x.xx')}")
-                                st.markdown(f"Conversions: {result['kpis'].get('pmax_vla_conv', '[xx]')}")
-                                st.markdown(f"Cost/Conv: {result['kpis'].get('pmax_vla_cost_conv', '$x.xx')}")
-                        
-                        # Display Social metrics
-                        if any(k.startswith('social_') for k in result['kpis']):
-                            with col4:
-                                st.markdown("#### Social Ads")
-                                st.markdown(f"Reach: {result['kpis'].get('social_reach', '[x,xxx]')}")
-                                st.markdown(f"Impressions: {result['kpis'].get('social_impr', '[x,xxx]')}")
-                                st.markdown(f"Clicks: {result['kpis'].get('social_clicks', '[xxx]')}")
-                                st.markdown(f"CPC: {result['kpis'].get('social_cpc', '$x.xx')}")
-                                st.markdown(f"VDP Views: {result['kpis'].get('social_vdp', '[xxx]')}")
-                        
-                        # Display Video metrics if present
-                        col5, col6 = st.columns(2)
-                        if any(k.startswith('dv_') for k in result['kpis']):
-                            with col5:
-                                st.markdown("#### Video Campaigns")
-                                st.markdown(f"Views: {result['kpis'].get('dv_views', '[x,xxx]')}")
-                                st.markdown(f"View Rate: {result['kpis'].get('dv_viewrate', '[xx.xx%]')}")
-                                st.markdown(f"CPC: {result['kpis'].get('dv_cpc', '$x.xx')}")
-                                st.markdown(f"CPM: {result['kpis'].get('dv_cpm', '$x.xx')}")
-                        
-                        # Display BCDF metrics if present
-                        if result['kpis'].get('has_bcdf', False):
-                            with col6:
-                                st.markdown("#### BCDF Program")
-                                
-                                # Display tactics in a more readable format
-                                tactics_text = "Unknown"
-                                if 'bcdf_tactics_organized' in result['kpis'] and 'tactics_list' in result['kpis']['bcdf_tactics_organized']:
-                                    tactics_text = result['kpis']['bcdf_tactics_organized']['tactics_list']
-                                else:
-                                    tactics_text = str(result['kpis'].get('bcdf_tactics', 'None'))
-                                
-                                st.markdown(f"Tactics: {tactics_text}")
-                                st.markdown(f"Impressions: {result['kpis'].get('bcdf_impr', '[x,xxx]')}")
-                                st.markdown(f"Clicks: {result['kpis'].get('bcdf_clicks', '[xxx]')}")
-                                st.markdown(f"CPC: {result['kpis'].get('bcdf_cpc', '$x.xx')}")
-                                st.markdown(f"VDP Views: {result['kpis'].get('bcdf_vdp', '[xxx]')}")
-                        
-                        # Email Preview and Download
-                        st.markdown("### Email Preview")
-                        email_tab1, email_tab2 = st.tabs(["Formatted HTML", "Plain Text"])
-                        
-                        with email_tab1:
-                            st.components.v1.html(result['email']['html'], height=500, scrolling=True)
-                            
-                            # Add download link for HTML email
-                            email_filename_html = f"{store_name.replace(' ', '_')}_{selected_month}_{selected_year}_email.html"
-                            download_link_html = get_download_link(result['email']['html'], email_filename_html, "Download HTML Email", is_html=True)
-                            st.markdown(download_link_html, unsafe_allow_html=True)
-                        
-                        with email_tab2:
-                            st.text_area("Email Content (Plain Text)", result['email']['plain'], height=300)
-                            
-                            # Add download link for plain text email
-                            email_filename_txt = f"{store_name.replace(' ', '_')}_{selected_month}_{selected_year}_email.txt"
-                            download_link_txt = get_download_link(result['email']['plain'], email_filename_txt, "Download Plain Text Email")
-                            st.markdown(download_link_txt, unsafe_allow_html=True)
-                        
-                        # Add download link for KPIs as JSON
-                        kpis_json = json.dumps(result['kpis'], indent=2)
-                        kpis_filename = f"{store_name.replace(' ', '_')}_{selected_month}_{selected_year}_kpis.json"
-                        kpis_download_link = get_download_link(kpis_json, kpis_filename, "Download KPIs as JSON")
-                        st.markdown(kpis_download_link, unsafe_allow_html=True)
+                ok = sum(1 for r in results if "error" not in r)
+                summary.success(f"Successfully processed {ok} of {len(results)} reports!")
+                if batch_usage:
+                    st.caption(
+                        f"Tokens this batch – input: {batch_usage['input_tokens']:,} "
+                        f"(cache read: {batch_usage['cache_read_tokens']:,}, "
+                        f"cache write: {batch_usage['cache_write_tokens']:,}), "
+                        f"output: {batch_usage['output_tokens']:,}"
+                        + (f" – prompt cache not used on {batch_usage['uncached_requests']:,} requests: "
+                           f"the prompt prefix is under the model's minimum cacheable length "
+                           f"({cache_minimums(selected_ai)})"
+                           if batch_usage.get("uncached_requests") else ""))
+                if pipeline_stats:
+                    st.caption(f"Pipeline – {pipeline_stats}")
+                render_batch_downloads(results, selected_month, selected_year)
+                return
+    
+    # Follow a queued batch until every job has finished
+    if st.session_state.get("batch_id"):
+        report_month, report_year = st.session_state["report_period"]
+        poll_batch(st.session_state["batch_id"], report_month, report_year)
+        return
+    
+    # Re-display results from the latest run (e.g. after a download click)
+    if st.session_state.get("results"):
+        report_month, report_year = st.session_state["report_period"]
+        for idx, result in enumerate(st.session_state["results"]):
+            render_result(result, idx, report_month, report_year)
+        render_batch_downloads(st.session_state["results"], report_month, report_year)
+
+def poll_batch(batch_id, selected_month, selected_year):
+    """Render queued jobs as workers finish them; survives reruns via session_state"""
+    progress_bar = st.progress(0)
+    progress_text = st.empty()
+    summary = st.empty()
+    results_area = st.container()
+    
+    results = []
+    rendered = set()
+    while True:
+        jobs = job_queue.batch_jobs(batch_id)
+        for job in jobs:
+            if job["status"] in ("done", "failed") and job["id"] not in rendered:
+                result = job["result"] if job["status"] == "done" else \
+                    {"filename": job["filename"], "error": job["error"]}
+                results.append(result)
+                rendered.add(job["id"])
+                with results_area:
+                    render_result(result, len(results) - 1, selected_month, selected_year)
+        
+        total = len(jobs) or 1
+        progress_bar.progress(len(rendered) / total)
+        if len(rendered) >= len(jobs):
+            break
+        running = sum(1 for j in jobs if j["status"] == "running")
+        queued = sum(1 for j in jobs if j["status"] == "queued")
+        hint = "" if running else " – waiting for a worker (`python job_queue.py worker`)"
+        progress_text.text(f"{len(rendered)} of {len(jobs)} done, {running} running, {queued} queued{hint}")
+        time.sleep(job_queue.POLL_INTERVAL_S)
+    
+    progress_bar.empty()
+    progress_text.empty()
+    st.session_state["results"] = results
+    st.session_state.pop("batch_id", None)
+    
+    ok = sum(1 for r in results if "error" not in r)
+    summary.success(f"Successfully processed {ok} of {len(results)} reports!")
+    render_batch_downloads(results, selected_month, selected_year)
+
+def render_result(result, idx, selected_month, selected_year):
+    """Show one processed report as a card; failed decks show their error inline"""
+    if "error" in result:
+        with st.expander(f"Report: {result['filename']}", expanded=True):
+            st.error(f"Error processing {result['filename']}: {result['error']}")
+        return
+    
+    with st.expander(f"Report: {result['filename']}"):
+        if result.get("duplicate_of"):
+            st.caption(f"Same content as {result['duplicate_of']} – KPIs reused without another AI call.")
+        if result.get("route"):
+            route = result["route"]
+            note = f"Model: {route['model']} (complexity {route['score']:.2f})"
+            if route["stepped_up"]:
+                note += f" – stepped up from the fast model: {route['stepped_up'][0]}"
+            st.caption(note)
+        for fix in result.get("repairs", []):
+            outcome = "fixed" if fix["fixed"] else "kept the first reading"
+            st.caption(f"Re-read the {fix['channel']} slides ({'; '.join(fix['issues'])}) – {outcome}.")
+        st.markdown(f"### KPIs Extracted")
+        
+        # Display the store name
+        store_name = result['kpis'].get('store_name', 'Unknown Dealership')
+        st.markdown(f"**Dealership:** {store_name}")
+        if result.get("store", {}).get("account_id"):
+            st.caption(f"Account {result['store']['account_id']} – {result['store']['name']}")
+        st.markdown(f"**Date Range:** {result['kpis'].get('date_range', 'Unknown')}")
+        
+        # Create columns for different metric groups
+        col1, col2 = st.columns(2)
+        
+        # Display RSA/Search metrics
+        if any(k.startswith('rsa_') for k in result['kpis']):
+            with col1:
+                st.markdown("#### Google Search (RSA)")
+                st.markdown(f"Impressions: {result['kpis'].get('rsa_impr', '[x,xxx]')}")
+                st.markdown(f"Clicks: {result['kpis'].get('rsa_clicks', '[xxx]')}")
+                st.markdown(f"CPC: {result['kpis'].get('rsa_cpc', '$x.xx')}")
+                st.markdown(f"Conversions: {result['kpis'].get('rsa_conv', '[xx]')}")
+                st.markdown(f"Cost/Conv: {result['kpis'].get('rsa_cost_conv', '$x.xx')}")
+        
+        # Display PMAX metrics (if they're not identical to VLA metrics)
+        if any(k.startswith('pmax_') and not k.startswith('pmax_vla_') for k in result['kpis']) and not are_pmax_and_vla_identical(result['kpis']):
+            with col2:
+                st.markdown("#### Performance Max")
+                st.markdown(f"Impressions: {result['kpis'].get('pmax_impr', '[x,xxx]')}")
+                st.markdown(f"Clicks: {result['kpis'].get('pmax_clicks', '[xxx]')}")
+                st.markdown(f"CPC: {result['kpis'].get('pmax_cpc', '$x.xx')}")
+                st.markdown(f"Conversions: {result['kpis'].get('pmax_conv', '[xx]')}")
+                st.markdown(f"Cost/Conv: {result['kpis'].get('pmax_cost_conv', '$x.xx')}")
+        
+        # Add more metric groups in new rows
+        col3, col4 = st.columns(2)
+        
+        # Display PMAX VLA metrics
+        if any(k.startswith('pmax_vla_') for k in result['kpis']):
+            with col3:
+                st.markdown("#### Performance Max w/ VLA")
+                st.markdown(f"Impressions: {result['kpis'].get('pmax_vla_impr', '[x,xxx]')}")
+                st.markdown(f"Clicks: {result['kpis'].get('pmax_vla_clicks', '[xxx]')}")
+                st.markdown(f"CPC: {result['kpis'].get('pmax_vla_cpc', '$x.xx')}")
+                st.markdown(f"Conversions: {result['kpis'].get('pmax_vla_conv', '[xx]')}")
+                st.markdown(f"Cost/Conv: {result['kpis'].get('pmax_vla_cost_conv', '$x.xx')}")
+        
+        # Display Social metrics
+        if any(k.startswith('social_') for k in result['kpis']):
+            with col4:
+                st.markdown("#### Social Ads")
+                st.markdown(f"Reach: {result['kpis'].get('social_reach', '[x,xxx]')}")
+                st.markdown(f"Impressions: {result['kpis'].get('social_impr', '[x,xxx]')}")
+                st.markdown(f"Clicks: {result['kpis'].get('social_clicks', '[xxx]')}")
+                st.markdown(f"CPC: {result['kpis'].get('social_cpc', '$x.xx')}")
+                st.markdown(f"VDP Views: {result['kpis'].get('social_vdp', '[xxx]')}")
+        
+        # Display Video metrics if present
+        col5, col6 = st.columns(2)
+        if any(k.startswith('dv_') for k in result['kpis']):
+            with col5:
+                st.markdown("#### Video Campaigns")
+                st.markdown(f"Views: {result['kpis'].get('dv_views', '[x,xxx]')}")
+                st.markdown(f"View Rate: {result['kpis'].get('dv_viewrate', '[xx.xx%]')}")
+                st.markdown(f"CPC: {result['kpis'].get('dv_cpc', '$x.xx')}")
+                st.markdown(f"CPM: {result['kpis'].get('dv_cpm', '$x.xx')}")
+        
+        # Display BCDF metrics if present
+        if result['kpis'].get('has_bcdf', False):
+            with col6:
+                st.markdown("#### BCDF Program")
                 
-                # Batch download option (if multiple reports)
-                if len(results) > 1:
-                    st.markdown("### Batch Downloads")
-                    
-                    # Create a text file with all plain text emails
-                    all_emails_plain = "\n".join(["=" * 40 + f"\n{r['filename']}\n" + "=" * 40 + f"\n{r['email']['plain']}\n\n" for r in results])
-                    batch_email_link_plain = get_download_link(all_emails_plain, f"all_emails_{selected_month}_{selected_year}.txt", "Download All Plain Text Emails")
-                    st.markdown(batch_email_link_plain, unsafe_allow_html=True)
-                    
-                    # Create an HTML file with all HTML emails
-                    all_emails_html = """
-                    <!DOCTYPE html>
-                    <html>
-                    <head>
-                        <meta charset="UTF-8">
-                        <title>All Dealership Reports</title>
-                        <style>
-                            body { font-family: Arial, sans-serif; }
-                            .email-container { margin-bottom: 50px; border-bottom: 2px solid #ddd; padding-bottom: 30px; }
-                            h2 { color: #2c3e50; }
-                        </style>
-                    </head>
-                    <body>
-                    """
-                    for r in results:
-                        store = r['kpis'].get('store_name', 'Unknown Dealership')
-                        all_emails_html += f"""
-                        <div class="email-container">
-                            <h2>{store} - {r['filename']}</h2>
-                            {r['email']['html']}
-                        </div>
-                        """
-                    all_emails_html += """
-                    </body>
-                    </html>
-                    """
-                    
-                    batch_email_link_html = get_download_link(all_emails_html, f"all_emails_{selected_month}_{selected_year}.html", "Download All HTML Emails", is_html=True)
-                    st.markdown(batch_email_link_html, unsafe_allow_html=True)
-                    
-                    # Create a combined JSON with all KPIs
-                    all_kpis = {r['filename']: r['kpis'] for r in results}
-                    all_kpis_json = json.dumps(all_kpis, indent=2)
-                    batch_kpis_link = get_download_link(all_kpis_json, f"all_kpis_{selected_month}_{selected_year}.json", "Download All KPIs")
-                    st.markdown(batch_kpis_link, unsafe_allow_html=True)
+                # Display tactics in a more readable format
+                tactics_text = "Unknown"
+                if 'bcdf_tactics_organized' in result['kpis'] and 'tactics_list' in result['kpis']['bcdf_tactics_organized']:
+                    tactics_text = result['kpis']['bcdf_tactics_organized']['tactics_list']
+                else:
+                    tactics_text = str(result['kpis'].get('bcdf_tactics', 'None'))
+                
+                st.markdown(f"Tactics: {tactics_text}")
+                st.markdown(f"Impressions: {result['kpis'].get('bcdf_impr', '[x,xxx]')}")
+                st.markdown(f"Clicks: {result['kpis'].get('bcdf_clicks', '[xxx]')}")
+                st.markdown(f"CPC: {result['kpis'].get('bcdf_cpc', '$x.xx')}")
+                st.markdown(f"VDP Views: {result['kpis'].get('bcdf_vdp', '[xxx]')}")
+        
+        # Email preview and downloads are only sent to the browser for cards
+        # the user opens – a collapsed expander still ships its contents
+        if not st.toggle("Show email and downloads", key=f"open_{idx}"):
+            return
+        st.markdown("### Email Preview")
+        email_tab1, email_tab2 = st.tabs(["Formatted HTML", "Plain Text"])
+        base = output_basename(result, selected_month, selected_year)
+        
+        with email_tab1:
+            st.components.v1.html(result['email']['html'], height=500, scrolling=True)
+            
+            # Served from Streamlit's media endpoint, not inlined in the page
+            st.download_button("Download HTML Email", result['email']['html'],
+                               file_name=f"{base}_email.html", mime="text/html",
+                               key=f"dl_html_{idx}")
+        
+        with email_tab2:
+            st.text_area("Email Content (Plain Text)", result['email']['plain'], height=300, key=f"plain_{idx}")
+            
+            st.download_button("Download Plain Text Email", result['email']['plain'],
+                               file_name=f"{base}_email.txt", mime="text/plain",
+                               key=f"dl_txt_{idx}")
+        
+        # Add download button for KPIs as JSON
+        st.download_button("Download KPIs as JSON", json.dumps(result['kpis'], indent=2),
+                           file_name=f"{base}_kpis.json", mime="application/json",
+                           key=f"dl_json_{idx}")
+
+def render_batch_downloads(results, selected_month, selected_year):
+    """Offer the ZIP bundle assembled from every successful report"""
+    results = [r for r in results if "error" not in r]
+    
+    # Batch download option (if multiple reports)
+    if len(results) <= 1:
+        return
+    
+    st.markdown("### Batch Downloads")
+    
+    # The bundle is written to a scratch directory once per batch (member by
+    # member) and its bytes kept for the session, so reruns neither rebuild
+    # nor re-read it and nothing is left on disk
+    if "bundle" not in st.session_state:
+        file_name = f"reports_{selected_month}_{selected_year}.zip"
+        with tempfile.TemporaryDirectory(prefix="report_bundle_") as bundle_dir:
+            bundle_path = os.path.join(bundle_dir, file_name)
+            write_zip_bundle(results, bundle_path, selected_month, selected_year)
+            with open(bundle_path, "rb") as fh:
+                st.session_state["bundle"] = (file_name, fh.read())
+    
+    file_name, data = st.session_state["bundle"]
+    st.download_button("Download All Reports (ZIP)", data, file_name=file_name,
+                       mime="application/zip", key="dl_bundle")
 
 if __name__ == "__main__":
     main()
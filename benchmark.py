@@ -0,0 +1,388 @@
+"""benchmark.py – golden‑dataset accuracy & speed regression suite
+-----------------------------------------------------------------
+* golden : builds golden_kpis.json from every generation of KPI output in
+           "project history" – per field, the value most distinct runs
+           agreed on; ties are kept as "disputed" and not scored until
+           someone settles them by editing the file
+* history: scores each historical KPI file against the golden set, i.e.
+           which earlier extractor version was right
+* run    : extracts a folder of decks with any provider / option set
+           (incl. offline mock and llm_archive replay) and scores
+           field‑level accuracy, wall time, tokens and cost
+* Every run is appended to benchmark_results.jsonl; `compare` lists them
+  and `run --max-drop` exits non‑zero on an accuracy regression
+"""
+
+from __future__ import annotations
+
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from kpi_extractor import KPI_SCHEMA, _is_placeholder, _to_number
+
+HISTORY_DIR = "project history"
+GOLDEN_FILE = "golden_kpis.json"
+RESULTS_FILE = "benchmark_results.jsonl"
+
+# free‑text fields whose wording legitimately varies between runs
+_UNSCORED = ("bcdf_tactics",)
+SCORED_FIELDS = [k for k in KPI_SCHEMA["properties"] if k not in _UNSCORED]
+# a historical record is used only if most of its keys are current schema keys
+_MIN_SCHEMA_SHARE = 0.8
+NUMBER_TOLERANCE = 0.005
+
+
+# ---------------------------------------------------------------------------
+#  NORMALISATION & MATCHING
+# ---------------------------------------------------------------------------
+
+def _norm_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
+
+
+def normalize(key: str, value: Any) -> Any:
+    """Comparable form of one KPI value; None for placeholders / missing."""
+    if isinstance(value, list):   # some generations returned per‑campaign arrays
+        value = next((v for v in value if not _is_placeholder(v)), None)
+    if value is None or value == "" or _is_placeholder(value):
+        return None
+    spec = KPI_SCHEMA["properties"].get(key, {})
+    if spec.get("type") == "boolean":
+        return value if isinstance(value, bool) else str(value).strip().lower() == "true"
+    if spec.get("type") == "string":
+        return " ".join(str(value).split())
+    num = _to_number(value)
+    return round(float(num), 4) if num is not None else None
+
+
+def same_value(expected: Any, got: Any) -> bool:
+    if expected is None or got is None:
+        return expected is got
+    if isinstance(expected, bool) or isinstance(got, bool):
+        return expected == got
+    if isinstance(expected, float) and isinstance(got, (int, float)):
+        return abs(expected - got) <= NUMBER_TOLERANCE * max(abs(expected), 1)
+    return _norm_name(str(expected)) == _norm_name(str(got))
+
+
+# ---------------------------------------------------------------------------
+#  GOLDEN SET
+# ---------------------------------------------------------------------------
+
+def _history_records(history_dir: str) -> Iterable[Tuple[str, Optional[str], Dict[str, Any]]]:
+    """(source file, deck filename or None, raw KPI dict) for every usable record."""
+    for path in sorted(glob.glob(os.path.join(history_dir, "*kpis*.json"))):
+        try:
+            with open(path, encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        name = os.path.basename(path)
+        records = data.items() if name.startswith("all_kpis") else [(None, data)]
+        for deck, kpis in records:
+            if not isinstance(kpis, dict) or not kpis.get("store_name"):
+                continue
+            if sum(k in KPI_SCHEMA["properties"] for k in kpis) < _MIN_SCHEMA_SHARE * len(kpis):
+                continue   # pre‑schema generation with different field names
+            yield name, deck, kpis
+
+
+def build_golden(history_dir: str = HISTORY_DIR) -> Dict[str, Any]:
+    stores: Dict[str, Dict[str, Any]] = {}
+    for source, deck, kpis in _history_records(history_dir):
+        entry = stores.setdefault(_norm_name(kpis["store_name"]),
+                                  {"store_name": kpis["store_name"].strip(), "decks": set(), "runs": {}})
+        if deck:
+            entry["decks"].add(deck)
+        fields = {k: normalize(k, kpis.get(k)) for k in SCORED_FIELDS}
+        # identical re‑downloads of one run count once
+        entry["runs"].setdefault(json.dumps(fields, sort_keys=True), (source, fields))
+
+    golden: Dict[str, Any] = {}
+    for key, entry in sorted(stores.items()):
+        runs = [fields for _, fields in entry["runs"].values()]
+        values: Dict[str, Any] = {}
+        absent: List[str] = []
+        disputed: Dict[str, List[Any]] = {}
+        for field in SCORED_FIELDS:
+            votes = Counter(json.dumps(r[field]) for r in runs).most_common()
+            if len(votes) > 1 and votes[0][1] == votes[1][1]:
+                disputed[field] = [json.loads(v) for v, n in votes if n == votes[0][1]]
+                continue
+            winner = json.loads(votes[0][0])
+            if winner is None:
+                absent.append(field)
+            else:
+                values[field] = winner
+        golden[key] = {
+            "store_name": entry["store_name"],
+            "decks": sorted(entry["decks"]),
+            "runs": len(runs),
+            "sources": sorted({source for source, _ in entry["runs"].values()}),
+            "fields": values,
+            "absent": absent,
+            "disputed": disputed,
+        }
+    return {"built_from": history_dir, "tolerance": NUMBER_TOLERANCE, "stores": golden}
+
+
+def load_golden(path: str = GOLDEN_FILE) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def golden_fingerprint(golden: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(golden["stores"], sort_keys=True).encode()).hexdigest()[:12]
+
+
+def match_store(golden: Dict[str, Any], deck_name: str) -> Optional[str]:
+    """Golden key for a deck file: exact filename first, then store name in the filename."""
+    for key, entry in golden["stores"].items():
+        if deck_name in entry["decks"]:
+            return key
+    norm = _norm_name(os.path.splitext(deck_name)[0])
+    hits = [k for k in golden["stores"] if k in norm]
+    return max(hits, key=len) if hits else None
+
+
+# ---------------------------------------------------------------------------
+#  SCORING
+# ---------------------------------------------------------------------------
+
+def score(kpis: Dict[str, Any], expected: Dict[str, Any]) -> Dict[str, Any]:
+    """Field‑level comparison of one extraction against its golden entry."""
+    wrong = []
+    scored = 0
+    for field in SCORED_FIELDS:
+        if field in expected["disputed"]:
+            continue
+        want = expected["fields"].get(field)
+        if want is None and field not in expected["absent"]:
+            continue
+        scored += 1
+        got = normalize(field, kpis.get(field))
+        if not same_value(want, got):
+            wrong.append({"field": field, "expected": want, "got": got})
+    correct = scored - len(wrong)
+    return {"scored": scored, "correct": correct,
+            "accuracy": round(correct / scored, 4) if scored else None, "wrong": wrong}
+
+
+def score_history(golden: Dict[str, Any], history_dir: str = HISTORY_DIR) -> List[Dict[str, Any]]:
+    """Accuracy of every historical KPI file against the golden set."""
+    per_file: Dict[str, List[int]] = {}
+    for source, _, kpis in _history_records(history_dir):
+        expected = golden["stores"].get(_norm_name(kpis["store_name"]))
+        if expected is None:
+            continue
+        s = score(kpis, expected)
+        totals = per_file.setdefault(source, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += s["correct"]
+        totals[2] += s["scored"]
+    return [{"file": f, "records": n, "accuracy": round(c / t, 4) if t else None}
+            for f, (n, c, t) in sorted(per_file.items())]
+
+
+# ---------------------------------------------------------------------------
+#  BENCHMARK RUN
+# ---------------------------------------------------------------------------
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(decks_dir: str, provider: str = "mock", label: str = "",
+                  pack: bool = False, route: bool = False,
+                  golden_file: str = GOLDEN_FILE) -> Dict[str, Any]:
+    """Extract every deck of decks_dir that has a golden entry and score it."""
+    import providers
+    from deck_metadata import known_fields
+    from kpi_extractor import extract_kpis_packed, extract_kpis_with_ai
+    from pptx_extractor import EXTRACTOR_VERSION, parse_deck
+
+    golden = load_golden(golden_file)
+    spec = providers.get_provider(provider)
+    api_key = providers.api_key(provider) or ""
+
+    decks = {}
+    for path in sorted(glob.glob(os.path.join(decks_dir, "*.pptx"))):
+        key = match_store(golden, os.path.basename(path))
+        if key is None:
+            print(f"skipped (no golden entry): {os.path.basename(path)}")
+        else:
+            decks[path] = key
+
+    results: Dict[str, Dict[str, Any]] = {}
+    usage: Dict[str, int] = {}
+    started = time.perf_counter()
+
+    parsed = {}
+    for path in decks:
+        t0 = time.perf_counter()
+        parsed[path] = parse_deck(path, cache_dir=None)   # cold: parsing is part of the extractor
+        results[path] = {"parse_s": time.perf_counter() - t0}
+
+    if pack:
+        t0 = time.perf_counter()
+        texts = {p: parsed[p]["text"] for p in decks}
+        for path, kpis in extract_kpis_packed(api_key, texts, provider, usage=usage,
+                                              slide_kpis={p: parsed[p]["kpis"] for p in decks},
+                                              metadata={p: known_fields(p, parsed[p]) for p in decks}):
+            results[path]["kpis"] = kpis
+        share = (time.perf_counter() - t0) / max(len(decks), 1)
+        for path in decks:
+            results[path]["extract_s"] = share
+    else:
+        for path in decks:
+            t0 = time.perf_counter()
+            deck_usage: Dict[str, int] = {}
+            try:
+                results[path]["kpis"] = extract_kpis_with_ai(
+                    api_key, parsed[path]["text"], provider, usage=deck_usage,
+                    deck=parsed[path] if route else None, slide_kpis=parsed[path]["kpis"],
+                    metadata=known_fields(path, parsed[path]))
+            except Exception as e:
+                results[path]["kpis"] = e
+            results[path]["extract_s"] = time.perf_counter() - t0
+            results[path]["tokens"] = deck_usage.get("input_tokens", 0) + deck_usage.get("output_tokens", 0)
+            for k, v in deck_usage.items():
+                usage[k] = usage.get(k, 0) + v
+    wall = time.perf_counter() - started
+
+    per_deck = []
+    correct = scored = 0
+    for path, key in decks.items():
+        r = results[path]
+        kpis = r.get("kpis")
+        row = {"deck": os.path.basename(path), "store": key,
+               "seconds": round(r["parse_s"] + r.get("extract_s", 0.0), 3)}
+        if "tokens" in r:
+            row["tokens"] = r["tokens"]
+        if isinstance(kpis, dict):
+            s = score(kpis, golden["stores"][key])
+            correct += s["correct"]
+            scored += s["scored"]
+            row.update(accuracy=s["accuracy"], wrong=s["wrong"])
+        else:
+            scored += score({}, golden["stores"][key])["scored"]
+            row.update(accuracy=0.0, error=str(kpis))
+        per_deck.append(row)
+
+    seconds = sorted(row["seconds"] for row in per_deck)
+    return {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": label,
+        "commit": _git_commit(),
+        "extractor_version": EXTRACTOR_VERSION,
+        "golden": golden_fingerprint(golden),
+        "provider": provider,
+        "model": spec.model,
+        "options": {"pack": pack, "route": route},
+        "summary": {
+            "decks": len(per_deck),
+            "accuracy": round(correct / scored, 4) if scored else None,
+            "wall_s": round(wall, 2),
+            "p50_deck_s": seconds[len(seconds) // 2] if seconds else None,
+            "tokens": usage.get("input_tokens", 0) + usage.get("output_tokens", 0),
+            "tokens_per_deck": round((usage.get("input_tokens", 0) + usage.get("output_tokens", 0))
+                                     / max(len(per_deck), 1)),
+            "cost_usd": round(providers.cost_usd(spec, usage), 4),
+        },
+        "decks": per_deck,
+    }
+
+
+def save_result(result: Dict[str, Any], path: str = RESULTS_FILE) -> None:
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(json.dumps(result) + "\n")
+
+
+def load_results(path: str = RESULTS_FILE) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def regression(result: Dict[str, Any], previous: List[Dict[str, Any]], max_drop: float) -> Optional[str]:
+    """Message if accuracy fell more than max_drop below the best comparable earlier run."""
+    comparable = [r for r in previous
+                  if r["golden"] == result["golden"] and r["provider"] == result["provider"]
+                  and r["model"] == result["model"] and r["summary"]["accuracy"] is not None]
+    if not comparable or result["summary"]["accuracy"] is None:
+        return None
+    best = max(comparable, key=lambda r: r["summary"]["accuracy"])
+    drop = best["summary"]["accuracy"] - result["summary"]["accuracy"]
+    if drop > max_drop:
+        return (f"accuracy {result['summary']['accuracy']:.2%} is {drop:.2%} below "
+                f"{best['summary']['accuracy']:.2%} ({best['ts']}, {best.get('commit') or 'no commit'})")
+    return None
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    ap = argparse.ArgumentParser(description="KPI accuracy / speed benchmark")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    g = sub.add_parser("golden", help="build golden_kpis.json from project history")
+    g.add_argument("--history", default=HISTORY_DIR)
+    sub.add_parser("history", help="score each historical KPI file against the golden set")
+    r = sub.add_parser("run", help="extract and score a folder of decks")
+    r.add_argument("decks")
+    r.add_argument("--provider", default="mock")
+    r.add_argument("--label", default="")
+    r.add_argument("--pack", action="store_true")
+    r.add_argument("--route", action="store_true")
+    r.add_argument("--replay", choices=("original", "zero"),
+                   help="answer from llm_archive instead of the provider")
+    r.add_argument("--max-drop", type=float, default=None,
+                   help="exit 1 if accuracy is this much below the best comparable run")
+    sub.add_parser("compare", help="list stored runs")
+    args = ap.parse_args()
+
+    if args.cmd == "golden":
+        golden = build_golden(args.history)
+        with open(GOLDEN_FILE, "w", encoding="utf-8") as fh:
+            json.dump(golden, fh, indent=2)
+        disputed = sum(len(e["disputed"]) for e in golden["stores"].values())
+        print(f"{len(golden['stores'])} stores written to {GOLDEN_FILE} ({disputed} disputed fields)")
+    elif args.cmd == "history":
+        for row in score_history(load_golden()):
+            print(f"{row['accuracy']:7.2%}  {row['records']:2} record(s)  {row['file']}")
+    elif args.cmd == "run":
+        if args.replay:
+            import llm_archive
+            llm_archive.configure("replay", args.replay)
+        previous = load_results()
+        result = run_benchmark(args.decks, args.provider, args.label, args.pack, args.route)
+        save_result(result)
+        print(json.dumps(result["summary"], indent=2))
+        for row in result["decks"]:
+            for w in row.get("wrong", []):
+                print(f"  {row['store']}: {w['field']} expected {w['expected']!r}, got {w['got']!r}")
+        if args.max_drop is not None:
+            problem = regression(result, previous, args.max_drop)
+            if problem:
+                sys.exit(f"REGRESSION: {problem}")
+    elif args.cmd == "compare":
+        for r in load_results():
+            s = r["summary"]
+            opts = ",".join(k for k, v in r["options"].items() if v) or "-"
+            acc = f"{s['accuracy']:.2%}" if s["accuracy"] is not None else "n/a"
+            print(f"{r['ts']}  {r.get('commit') or '-':8} {r['provider']:9} {r['model']:24} {opts:10}"
+                  f" acc {acc:>7}  {s['wall_s']:7.2f}s  {s['tokens_per_deck']:6} tok/deck"
+                  f"  ${s['cost_usd']:.4f}  {r['label']}")
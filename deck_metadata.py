@@ -0,0 +1,121 @@
+"""deck_metadata.py – store and period metadata without the LLM
+-----------------------------------------------------------------
+* from_filename(): "27418_-_Nicholasville_CDJR(04-01-2025-04-19-2025).pptx"
+  → account id 27418, store "Nicholasville CDJR", "04/01/2025 - 04/19/2025"
+* from_deck(): the same fields from a parse_deck() result – the date range
+  on the title slide or in the core properties, and a store name from
+  the core‑properties title or the title slide only when the store
+  registry already knows it (a title slide line may just as well be
+  "Monthly Performance Review")
+* known_fields() merges both, filename first; kpi_extractor leaves every
+  field found here out of the LLM schema and fills it in itself
+"""
+
+from __future__ import annotations
+
+import calendar
+import os
+import re
+from datetime import date
+from typing import Any, Dict, Optional
+
+from slide_classifier import SLIDE_SPLIT
+
+# the fields the LLM no longer has to read when a deck's metadata has them
+METADATA_FIELDS = ("store_name", "date_range")
+
+_FILENAME = re.compile(
+    r"^(?:(?P<id>\d+)_-_)?(?P<name>.+?)\s*"
+    r"(?:\((?P<m1>\d{2})-(?P<d1>\d{2})-(?P<y1>\d{4})-(?P<m2>\d{2})-(?P<d2>\d{2})-(?P<y2>\d{4})\))?"
+    r"(?:\s*\(\d+\))?\.pptx$", re.I)
+_NUMERIC_RANGE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})\s*[-–]\s*(\d{1,2})/(\d{1,2})/(\d{4})")
+_MONTH = "|".join(calendar.month_name[1:] + calendar.month_abbr[1:])
+# "April 1 - 19, 2025" and "April 1, 2025 - April 19, 2025"
+_WORDED_RANGE = re.compile(
+    rf"\b({_MONTH})\.? (\d{{1,2}})(?:, (\d{{4}}))?\s*[-–]\s*(?:({_MONTH})\.? )?(\d{{1,2}}),? (\d{{4}})", re.I)
+
+
+def _month_number(name: str) -> int:
+    name = name[:3].lower()
+    return next(n for n in range(1, 13) if calendar.month_abbr[n].lower() == name)
+
+
+def _date_range(start: date, end: date) -> Optional[str]:
+    if end < start:
+        return None
+    return f"{start:%m/%d/%Y} - {end:%m/%d/%Y}"
+
+
+def date_range_in(text: str) -> Optional[str]:
+    """First report period written in text, as MM/DD/YYYY - MM/DD/YYYY."""
+    try:
+        m = _NUMERIC_RANGE.search(text or "")
+        if m:
+            m1, d1, y1, m2, d2, y2 = map(int, m.groups())
+            return _date_range(date(y1, m1, d1), date(y2, m2, d2))
+        m = _WORDED_RANGE.search(text or "")
+        if m:
+            month1, d1, y1, month2, d2, y2 = m.groups()
+            start = date(int(y1 or y2), _month_number(month1), int(d1))
+            return _date_range(start, date(int(y2), _month_number(month2 or month1), int(d2)))
+    except ValueError:   # 02/30/2025 and friends
+        return None
+    return None
+
+
+def from_filename(filename: str) -> Dict[str, Any]:
+    """account_id / store_name / date_range found in a deck filename."""
+    m = _FILENAME.match(os.path.basename(filename or ""))
+    if not m or not (m.group("id") or m.group("y1")):
+        return {}   # not a report export name – "deck.pptx" names no store
+    meta: Dict[str, Any] = {}
+    if m.group("id"):
+        meta["account_id"] = m.group("id")
+    name = m.group("name").replace("_s_", "'s_").replace("_", " ").strip()
+    if name:
+        meta["store_name"] = name
+    if m.group("y1"):
+        try:
+            period = _date_range(date(int(m.group("y1")), int(m.group("m1")), int(m.group("d1"))),
+                                 date(int(m.group("y2")), int(m.group("m2")), int(m.group("d2"))))
+        except ValueError:
+            period = None
+        if period:
+            meta["date_range"] = period
+    return meta
+
+
+def from_deck(parsed: Dict[str, Any]) -> Dict[str, Any]:
+    """store_name / date_range from a parse_deck() result's title slide and core properties."""
+    import store_registry
+
+    props = parsed.get("properties", {})
+    parts = SLIDE_SPLIT.split(parsed.get("text", ""))
+    title_slide = parts[2] if len(parts) > 2 else ""
+
+    meta: Dict[str, Any] = {}
+    period = date_range_in(title_slide) or date_range_in(props.get("subject", "")) \
+        or date_range_in(props.get("title", ""))
+    if period:
+        meta["date_range"] = period
+    for candidate in [props.get("title", "")] + title_slide.strip().splitlines()[:3]:
+        store = store_registry.find(candidate) if candidate.strip() else None
+        if store is not None:
+            meta["store_name"] = store.name
+            break
+    return meta
+
+
+def known_fields(filename: Optional[str], parsed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Every METADATA_FIELDS value found without the LLM; the filename wins."""
+    meta = from_deck(parsed) if parsed else {}
+    meta.update(from_filename(filename or ""))
+    return {k: meta[k] for k in METADATA_FIELDS if meta.get(k)}
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+
+    for arg in sys.argv[1:]:
+        print(arg, json.dumps(from_filename(arg)))
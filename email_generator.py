@@ -7,14 +7,22 @@ email_generator.py – 2025‑04‑23
 • Clean labels (Impressions, Conversions, Cost per Conversion, etc.)
 • Simplified greeting and sign-off
 • BCDF tactics appear after heading and before KPIs
+• Month‑over‑month change (▲ / ▼ %) next to each metric when the prior
+  month's record is passed in (see kpi_history.previous); counts are
+  pro‑rated to the current report's number of days, and only rates are
+  compared when either date range is unknown
 """
 
 from __future__ import annotations
 import locale
+import re
+from datetime import date
 from typing import Any, Dict, List, Tuple, Optional
 
 locale.setlocale(locale.LC_ALL, "")
 _CURRENCY = ("cpc", "cpm", "cost_conv", "cost", "cpl", "cpa", "cpv")
+_RATES = ("_cpc", "_cpm", "_cost_conv", "_viewrate")   # comparable across windows of any length
+_RANGE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})\s*-\s*(\d{1,2})/(\d{1,2})/(\d{4})")
 
 # =======================  REPLACE the helper section  =======================
 def _placeholder(val: Any) -> bool:
@@ -54,6 +62,47 @@ def _fmt_val(key: str, val: Any) -> str:
         return _fmt_num(n, any(t in key.lower() for t in _CURRENCY))
     except (TypeError, ValueError):
         return str(val)
+
+def _delta(key: str, val: Any, prev: Optional[Dict[str, Any]]) -> str:
+    """' (▲ 12.5%)' vs. the prior month; rates move in points, not percent."""
+    if not prev or _placeholder(val) or _placeholder(prev.get(key)): return ""
+    cur, old = _numeric_from(val), _numeric_from(prev.get(key))
+    if cur is None or old is None or old == 0: return ""
+    if "viewrate" in key.lower():
+        change, unit = cur - old, " pts"
+    else:
+        change, unit = (cur - old) / abs(old) * 100, "%"
+    if abs(change) < 0.05: return " (– 0.0%s)" % unit
+    return f" ({'▲' if change > 0 else '▼'} {abs(change):.1f}{unit})"
+
+def _days(date_range: Any) -> Optional[int]:
+    """Number of days in 'MM/DD/YYYY - MM/DD/YYYY', inclusive."""
+    m = _RANGE.search(str(date_range or ""))
+    if not m: return None
+    m1, d1, y1, m2, d2, y2 = map(int, m.groups())
+    try: days = (date(y2, m2, d2) - date(y1, m1, d1)).days + 1
+    except ValueError: return None
+    return days if days > 0 else None
+
+def _comparable(prev: Dict[str, Any], kpis: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    """
+    The prior record scaled to the current report's window: month‑to‑date
+    counts (impressions, clicks …) are pro‑rated by days, rates are kept as
+    they are. Without both date ranges only the rates remain. Second value:
+    whether counts were kept.
+    """
+    cur_days, old_days = _days(kpis.get("date_range")), _days(prev.get("date_range"))
+    out: Dict[str, Any] = {}
+    for key, val in prev.items():
+        if key.endswith(_RATES) or _numeric_from(val) is None or isinstance(val, bool):
+            out[key] = val
+        elif cur_days and old_days:
+            out[key] = _numeric_from(val) * cur_days / old_days
+    return out, bool(cur_days and old_days)
+
+def _row(key: str, k: Dict[str, Any], prev: Optional[Dict[str, Any]]) -> str:
+    val = _fmt_val(key, k.get(key))
+    return val + _delta(key, k.get(key), prev) if val else ""
 # ===========================================================================
 
 
@@ -74,10 +123,11 @@ def _pmax_same(k:Dict[str,Any])->bool:
     return all(k.get(f"pmax_{m}")==k.get(f"pmax_vla_{m}") for m in met)
 
 # ---------------------------------------------------------------- section builders
-def _section(title:str, rows:List[Tuple[str,str]], k:Dict[str,Any])->str:
+def _section(title:str, rows:List[Tuple[str,str]], k:Dict[str,Any],
+             prev:Optional[Dict[str,Any]]=None)->str:
     lines=[]
     for lbl,key in rows:
-        val=_fmt_val(key,k.get(key))
+        val=_row(key,k,prev)
         if val:
             lines.append(f"    <li>{lbl}: {val}</li>")
     if not lines:
@@ -85,7 +135,7 @@ def _section(title:str, rows:List[Tuple[str,str]], k:Dict[str,Any])->str:
     body="\n".join(lines)
     return f"<p><b>{title}</b></p>\n<ul>\n{body}\n</ul>\n"
 
-def _bcdf_html(k:Dict[str,Any])->str:
+def _bcdf_html(k:Dict[str,Any], prev:Optional[Dict[str,Any]]=None)->str:
     if not k.get("has_bcdf"):
         return ""
     
@@ -103,7 +153,7 @@ def _bcdf_html(k:Dict[str,Any])->str:
     
     lines=[]
     for lbl,key in rows:
-        val=_fmt_val(key,k.get(key))
+        val=_row(key,k,prev)
         if val:
             lines.append(f"    <li>{lbl}: {val}</li>")
     
@@ -114,15 +164,23 @@ def _bcdf_html(k:Dict[str,Any])->str:
     return f"{bcdf_header}{tactics_line}<ul>\n{body}\n</ul>\n"
 
 # ---------------------------------------------------------------- main
-def generate_email(kpis:Dict[str,Any], month:str)->Dict[str,str]:
+def generate_email(kpis:Dict[str,Any], month:str,
+                   previous:Optional[Tuple[str,Dict[str,Any]]]=None)->Dict[str,str]:
+    """previous = (month label, kpis) of the prior report, for change arrows."""
     store=kpis.get("store_name","Unknown Dealership")
     pmax_same=_pmax_same(kpis)
+    prev_label,prev=previous if previous else ("",None)
+    compare=""
+    if prev:
+        prev,prorated=_comparable(prev,kpis)
+        compare=(f" Changes are shown against {prev_label}, pro‑rated to the same number of days."
+                 if prorated else f" Changes in rates are shown against {prev_label}.")
 
     # build HTML
     html_parts=[f"""<div style="font-family:Arial, sans-serif; color:#000; font-size:12px;">
 <p><b>SUBJECT:</b> {month} MTD Digital Marketing Report – {store}</p>
 <p>Hello!</p>
-<p>Attached is the month‑to‑date performance report for <b>{store}</b>, covering <b>{kpis.get('date_range','[Date Range]')}</b>.</p>
+<p>Attached is the month‑to‑date performance report for <b>{store}</b>, covering <b>{kpis.get('date_range','[Date Range]')}</b>.{compare}</p>
 <p><b>KPI Breakdown by Channel:</b></p>
 """]
 
@@ -130,33 +188,33 @@ def generate_email(kpis:Dict[str,Any], month:str)->Dict[str,str]:
     if _has("rsa_",kpis):
         html_parts.append(_section("GOOGLE SEARCH CAMPAIGNS (RSA)",[
             ("Impressions","rsa_impr"),("Clicks","rsa_clicks"),("Avg. CPC","rsa_cpc"),
-            ("Conversions","rsa_conv"),("Cost per Conversion","rsa_cost_conv")],kpis))
+            ("Conversions","rsa_conv"),("Cost per Conversion","rsa_cost_conv")],kpis,prev))
     # PMAX
     if _has("pmax_",kpis) and not pmax_same:
         html_parts.append(_section("PERFORMANCEMAX CAMPAIGNS",[
             ("Impressions","pmax_impr"),("Clicks","pmax_clicks"),("Avg. CPC","pmax_cpc"),
-            ("Conversions","pmax_conv"),("Cost per Conversion","pmax_cost_conv")],kpis))
+            ("Conversions","pmax_conv"),("Cost per Conversion","pmax_cost_conv")],kpis,prev))
     if _has("pmax_vla_",kpis):
         html_parts.append(_section("PERFORMANCEMAX w/ VLA CAMPAIGNS",[
             ("Impressions","pmax_vla_impr"),("Clicks","pmax_vla_clicks"),("Avg. CPC","pmax_vla_cpc"),
-            ("Conversions","pmax_vla_conv"),("Cost per Conversion","pmax_vla_cost_conv")],kpis))
+            ("Conversions","pmax_vla_conv"),("Cost per Conversion","pmax_vla_cost_conv")],kpis,prev))
     # Demand Gen
     if _has("dg_",kpis):
         html_parts.append(_section("GOOGLE DEMAND GEN CAMPAIGNS",[
             ("Impressions","dg_impr"),("Clicks","dg_clicks"),("CPM","dg_cpm"),("Avg. CPC","dg_cpc"),
-            ("Conversions","dg_conv")],kpis))
+            ("Conversions","dg_conv")],kpis,prev))
     # Social
     if _has("social_",kpis):
         html_parts.append(_section("SOCIAL ADS",[
             ("Reach","social_reach"),("Impressions","social_impr"),("Clicks","social_clicks"),
-            ("Avg. CPC","social_cpc"),("VDP Views","social_vdp")],kpis))
+            ("Avg. CPC","social_cpc"),("VDP Views","social_vdp")],kpis,prev))
     # Video / Display
     if _has_video(kpis):
         html_parts.append(_section("VIDEO / DISPLAY CAMPAIGNS",[
             ("Views","dv_views"),("View‑through Rate","dv_viewrate"),
-            ("Avg. CPC","dv_cpc"),("CPM","dv_cpm")],kpis))
+            ("Avg. CPC","dv_cpc"),("CPM","dv_cpm")],kpis,prev))
     # BCDF
-    html_parts.append(_bcdf_html(kpis))
+    html_parts.append(_bcdf_html(kpis,prev))
 
     html_parts.append("<p>Thank you,</p></div>")
     html="".join(filter(None,html_parts))
@@ -164,11 +222,11 @@ def generate_email(kpis:Dict[str,Any], month:str)->Dict[str,str]:
     # plain text mirrors HTML
     plain_lines=[f"SUBJECT: {month} MTD Digital Marketing Report – {store}",
                  "", "Hello!", "",
-                 f"Attached is the month‑to‑date performance report for {store}, covering {kpis.get('date_range','[Date Range]')}.",
+                 f"Attached is the month‑to‑date performance report for {store}, covering {kpis.get('date_range','[Date Range]')}.{compare}",
                  "","KPI Breakdown by Channel:"]
     
     def add_block(title:str, rows:List[Tuple[str,str]]):
-        vals=[(lbl,_fmt_val(key,kpis.get(key))) for lbl,key in rows if _fmt_val(key,kpis.get(key))]
+        vals=[(lbl,_row(key,kpis,prev)) for lbl,key in rows if _row(key,kpis,prev)]
         if vals:
             plain_lines.append(""); plain_lines.append(title)
             for lbl,val in vals:
@@ -212,7 +270,7 @@ def generate_email(kpis:Dict[str,Any], month:str)->Dict[str,str]:
               ("VDP Views","bcdf_vdp"),("Conversions","bcdf_conv")]
         
         for lbl,key in rows:
-            val=_fmt_val(key,kpis.get(key))
+            val=_row(key,kpis,prev)
             if val:
                 plain_lines.append(f"- {lbl}: {val}")
 
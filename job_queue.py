@@ -0,0 +1,301 @@
+"""job_queue.py – local background job queue (SQLite, no external service)
+-----------------------------------------------------------------
+* The Streamlit UI submits decks as jobs and polls for results; the work
+  runs in separate worker processes started with
+      python job_queue.py worker [-n 4]
+* Per‑provider concurrency is enforced globally (across every worker and
+  every browser session) from the jobs table itself
+* Fair scheduling: the next job goes to the user with the fewest jobs
+  currently running, oldest job first among equals
+* Workers heartbeat their running job; a job whose heartbeat goes quiet
+  (crashed worker) is re‑queued after a timeout
+* A worker only writes its result and removes the upload while its claim
+  (worker + start time) is still the job's current one
+"""
+
+from __future__ import annotations
+
+import configparser
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import deck_metadata
+import kpi_history
+import llm_archive
+import providers
+import store_registry
+
+DB_FILE = os.environ.get("JOB_QUEUE_DB", "job_queue.sqlite3")
+SPOOL_DIR = os.environ.get("JOB_QUEUE_SPOOL", "job_uploads")
+CONFIG_FILE = "parser_config.ini"
+
+# simultaneous LLM calls per provider default to the registry's
+# max_concurrency (providers.py); override in parser_config.ini [QUEUE]
+STALE_AFTER_S = 15 * 60
+HEARTBEAT_S = 30.0
+POLL_INTERVAL_S = 1.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch     TEXT NOT NULL,
+    user      TEXT NOT NULL,
+    provider  TEXT NOT NULL,
+    period    TEXT NOT NULL,
+    filename  TEXT NOT NULL,
+    path      TEXT NOT NULL,
+    status    TEXT NOT NULL DEFAULT 'queued',   -- queued | running | done | failed
+    worker    TEXT,
+    created   REAL NOT NULL,
+    started   REAL,
+    heartbeat REAL,
+    finished  REAL,
+    result    TEXT,
+    error     TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, provider);
+CREATE INDEX IF NOT EXISTS jobs_batch  ON jobs(batch);
+"""
+
+# ---------------------------------------------------------------------------
+#  DATABASE
+# ---------------------------------------------------------------------------
+
+def _connect(db_file: str = DB_FILE) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    if "heartbeat" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+        # queues created before workers heartbeat their jobs
+        conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+    return conn
+
+
+@contextmanager
+def _db(db_file: str = DB_FILE) -> Iterator[sqlite3.Connection]:
+    conn = _connect(db_file)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def provider_limits() -> Dict[str, int]:
+    limits = {name: spec.max_concurrency for name, spec in providers.load_providers().items()}
+    if os.path.exists(CONFIG_FILE):
+        parser = configparser.ConfigParser()
+        parser.read(CONFIG_FILE)
+        if "QUEUE" in parser:
+            for provider, limit in parser["QUEUE"].items():
+                limits[provider] = int(limit)
+    return limits
+
+
+# ---------------------------------------------------------------------------
+#  UI SIDE: SUBMIT & POLL
+# ---------------------------------------------------------------------------
+
+def submit_batch(user: str, provider: str, period: str,
+                 files: List[Tuple[str, str]], db_file: str = DB_FILE) -> str:
+    """Queue (filename, spooled path) pairs; returns the batch id to poll."""
+    batch = uuid.uuid4().hex
+    now = time.time()
+    with _db(db_file) as conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO jobs (batch, user, provider, period, filename, path, created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(batch, user, provider, period, name, path, now) for name, path in files])
+        conn.execute("COMMIT")
+    return batch
+
+
+def batch_jobs(batch: str, db_file: str = DB_FILE) -> List[Dict[str, Any]]:
+    """Every job of a batch in submission order; finished ones carry their result."""
+    with _db(db_file) as conn:
+        rows = conn.execute("SELECT * FROM jobs WHERE batch = ? ORDER BY id", (batch,)).fetchall()
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        jobs.append(job)
+    return jobs
+
+
+def queue_depth(db_file: str = DB_FILE) -> Dict[str, int]:
+    with _db(db_file) as conn:
+        rows = conn.execute("SELECT status, COUNT(*) FROM jobs"
+                            " WHERE status IN ('queued', 'running') GROUP BY status").fetchall()
+    return {status: n for status, n in rows}
+
+
+# ---------------------------------------------------------------------------
+#  WORKER SIDE: CLAIM & COMPLETE
+# ---------------------------------------------------------------------------
+
+def claim_job(worker: str, limits: Dict[str, int], db_file: str = DB_FILE) -> Optional[Dict[str, Any]]:
+    """
+    Atomically pick the next job. Providers at their concurrency limit are
+    skipped; among the rest, the user with the fewest running jobs goes next.
+    """
+    conn = _connect(db_file)
+    try:
+        conn.execute("BEGIN IMMEDIATE")   # one claimer at a time
+        conn.execute("UPDATE jobs SET status = 'queued', worker = NULL, started = NULL, heartbeat = NULL"
+                     " WHERE status = 'running' AND COALESCE(heartbeat, started) < ?",
+                     (time.time() - STALE_AFTER_S,))
+        running = dict(conn.execute("SELECT provider, COUNT(*) FROM jobs"
+                                    " WHERE status = 'running' GROUP BY provider").fetchall())
+        open_providers = [p for p in
+                          (r[0] for r in conn.execute("SELECT DISTINCT provider FROM jobs WHERE status = 'queued'"))
+                          if running.get(p, 0) < limits.get(p, 1)]
+        if not open_providers:
+            conn.execute("COMMIT")
+            return None
+        marks = ",".join("?" * len(open_providers))
+        row = conn.execute(
+            f"SELECT j.* FROM jobs j WHERE j.status = 'queued' AND j.provider IN ({marks})"
+            " ORDER BY (SELECT COUNT(*) FROM jobs r WHERE r.status = 'running' AND r.user = j.user),"
+            " j.id LIMIT 1", open_providers).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        job = dict(row, status="running", worker=worker, started=time.time())
+        job["heartbeat"] = job["started"]
+        conn.execute("UPDATE jobs SET status = 'running', worker = ?, started = ?, heartbeat = ? WHERE id = ?",
+                     (worker, job["started"], job["heartbeat"], job["id"]))
+        conn.execute("COMMIT")
+        return job
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+_CLAIMED = "id = ? AND status = 'running' AND worker = ? AND started = ?"
+
+
+def heartbeat(job: Dict[str, Any], db_file: str = DB_FILE) -> bool:
+    """Mark a claimed job as still alive; False once the claim has been lost."""
+    with _db(db_file) as conn:
+        cur = conn.execute(f"UPDATE jobs SET heartbeat = ? WHERE {_CLAIMED}",
+                           (time.time(), job["id"], job["worker"], job["started"]))
+    return cur.rowcount == 1
+
+
+def finish_job(job: Dict[str, Any], result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None, db_file: str = DB_FILE) -> bool:
+    """
+    Store the outcome of a claimed job. Returns False (and writes nothing)
+    when the job was re‑queued and claimed again in the meantime.
+    """
+    with _db(db_file) as conn:
+        cur = conn.execute(f"UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? WHERE {_CLAIMED}",
+                           ("failed" if error else "done", time.time(),
+                            json.dumps(result) if result is not None else None, error,
+                            job["id"], job["worker"], job["started"]))
+    return cur.rowcount == 1
+
+
+def _keep_alive(job: Dict[str, Any], db_file: str, stop: threading.Event) -> None:
+    while not stop.wait(HEARTBEAT_S):
+        try:
+            if not heartbeat(job, db_file):
+                return
+        except sqlite3.Error as e:
+            print(f"Heartbeat for job {job['id']} failed: {e}")
+
+
+def process_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    from pptx_extractor import parse_deck
+    from kpi_extractor import extract_kpis_with_ai
+    from email_generator import generate_email
+
+    api_key = providers.api_key(job["provider"])
+    if api_key is None and not llm_archive.replaying():
+        raise RuntimeError(f"No API key configured for {job['provider']}")
+    parsed = parse_deck(job["path"])
+    route: Dict[str, Any] = {}
+    repairs: List[Dict[str, Any]] = []
+    kpis = extract_kpis_with_ai(api_key, parsed["text"], job["provider"], deck=parsed,
+                                route=route, repairs=repairs,
+                                metadata=deck_metadata.known_fields(job["filename"], parsed))
+    store = store_registry.resolve(job["filename"], kpis.get("store_name"))
+    month = kpi_history.report_month(kpis, job["period"])
+    email = generate_email(kpis, job["period"], kpi_history.previous(store.key, month))
+    kpi_history.record(kpis, month, store.key)
+    return {
+        "filename": job["filename"],
+        "kpis": kpis,
+        "store": store.as_dict(),
+        "email": email,
+        "route": route,
+        "repairs": repairs,
+    }
+
+
+def worker_loop(db_file: str = DB_FILE, stop_when_idle: bool = False) -> None:
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    limits = provider_limits()
+    print(f"Worker {worker} started (limits: {limits})")
+    while True:
+        job = claim_job(worker, limits, db_file)
+        if job is None:
+            if stop_when_idle and not queue_depth(db_file).get("queued"):
+                return
+            time.sleep(POLL_INTERVAL_S)
+            continue
+        stop = threading.Event()
+        threading.Thread(target=_keep_alive, args=(job, db_file, stop), daemon=True).start()
+        try:
+            owned = finish_job(job, result=process_job(job), db_file=db_file)
+        except Exception as e:
+            owned = finish_job(job, error=str(e), db_file=db_file)
+        finally:
+            stop.set()
+        if not owned:
+            # re‑queued while we ran: the current claimant owns the upload and the result
+            print(f"Worker {worker} lost job {job['id']}; result discarded")
+            continue
+        try:
+            os.remove(job["path"])
+        except OSError:
+            pass
+
+
+def spool_dir() -> str:
+    """Uploads for queued jobs live here until a worker is done with them."""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    return SPOOL_DIR
+
+
+if __name__ == "__main__":
+    import argparse
+    import multiprocessing
+
+    ap = argparse.ArgumentParser(description="Report parser job queue")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    w = sub.add_parser("worker", help="run worker processes")
+    w.add_argument("-n", "--processes", type=int, default=1)
+    sub.add_parser("status", help="show queue depth")
+    args = ap.parse_args()
+
+    if args.cmd == "status":
+        print(queue_depth())
+    elif args.processes == 1:
+        worker_loop()
+    else:
+        procs = [multiprocessing.Process(target=worker_loop) for _ in range(args.processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
@@ -1,11 +1,21 @@
 """kpi_extractor.py – full functionality + fixes
 -----------------------------------------------------------------
 * Supports Claude, OpenAI **and DeepSeek** (cheap tier)
-* Crash‑proof `_to_int()`; placeholders never raise `ValueError`
+* Providers come from the registry in providers.py, incl. offline local / mock
+* Crash‑proof `_to_number()`; placeholders never raise `ValueError`
 * Keeps all original KPI keys & logic
 * Drops `bcdf_vdp` / `bcdf_conv` when they're placeholders
 * Removes the whole video block if it's just placeholders
-* Retains Palmer‑specific PMAX VLA fix
+* PMAX / PMAX‑VLA figures reconciled against the regex slide KPIs
+* Linear brace scanner for replies; unparseable output raises KPIParseError
+* Streams provider replies and stops at the KPI object's closing brace
+* KPI_SCHEMA drives the prompt, tool calls and local validation
+* Static prompt prefix is cached provider‑side; token / cache usage reported
+* Optional multi‑deck packing: several condensed decks per request
+* Raw prompts / replies can be recorded and replayed offline (llm_archive.py)
+* Latency, tokens, retries and cost of every request go to provider_metrics
+* Optional routing of simple decks to a fast model, with step‑up on failure
+* Inconsistent channels are re‑asked from their own slides only and merged
 """
 
 from __future__ import annotations
@@ -13,34 +23,103 @@ from __future__ import annotations
 import json
 import re
 import time
-from typing import Any, Dict, Optional
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import requests
 import anthropic
 import openai
 
+import llm_archive
+import model_router
+import provider_metrics
+from providers import Provider, cost_usd, get_provider
+from slide_classifier import KPI_LABEL, SLIDE_SPLIT
+
 # ---------------------------------------------------------------------------
 #  PROMPT & PLACEHOLDERS
 # ---------------------------------------------------------------------------
-SYSTEM_PROMPT = """
-You are an expert at extracting specific metrics from dealership marketing
-reports. Return ONLY a JSON object with these keys (use placeholders when the
-metric truly is missing):
-
-- store_name, date_range
-- rsa_impr, rsa_clicks, rsa_cpc, rsa_conv, rsa_cost_conv
-- pmax_impr, pmax_clicks, pmax_cpc, pmax_conv, pmax_cost_conv
-- pmax_vla_impr, pmax_vla_clicks, pmax_vla_cpc, pmax_vla_conv,
-  pmax_vla_cost_conv
-- dg_impr, dg_clicks, dg_cpm, dg_conv               # <-- CPM only
-- dv_views, dv_viewrate, dv_cpc, dv_cpm  (include only if actual numbers
-  appear in the report)
-- social_reach, social_impr, social_clicks, social_cpc, social_vdp
-- has_bcdf (true/false) and, if true:
-  - bcdf_tactics, bcdf_impr, bcdf_clicks, bcdf_cpc,
-  - bcdf_conv  (omit if not present)
-  - bcdf_vdp   (omit if not present)
-"""
+# One schema drives the prompt, provider‑native tool calls and local
+# validation. Metrics are numbers (dollars / percentages as bare numbers) or
+# null when the report truly lacks them.
+_METRIC_DESC = {
+    "impr":      "impressions",
+    "clicks":    "clicks",
+    "cpc":       "average cost per click, dollars",
+    "conv":      "conversions",
+    "cost_conv": "cost per conversion, dollars",
+    "cpm":       "cost per thousand impressions, dollars",
+    "views":     "video views",
+    "viewrate":  "view rate, percent (12.5 means 12.5%)",
+    "reach":     "people reached",
+    "vdp":       "vehicle detail page views",
+}
+
+# (key prefix, channel title, metric suffixes)
+KPI_CHANNELS = [
+    ("rsa",      "Google Search (RSA)",            ("impr", "clicks", "cpc", "conv", "cost_conv")),
+    ("pmax",     "Performance Max",                ("impr", "clicks", "cpc", "conv", "cost_conv")),
+    ("pmax_vla", "Performance Max w/ VLA",         ("impr", "clicks", "cpc", "conv", "cost_conv")),
+    ("dg",       "Demand Gen (CPM only)",          ("impr", "clicks", "cpm", "conv")),
+    ("dv",       "Video / Display",                ("views", "viewrate", "cpc", "cpm")),
+    ("social",   "Social Ads",                     ("reach", "impr", "clicks", "cpc", "vdp")),
+    ("bcdf",     "Business Center Directed Funds", ("impr", "clicks", "cpc", "conv", "vdp")),
+]
+
+
+def _build_schema() -> Dict[str, Any]:
+    props: Dict[str, Any] = {
+        "store_name": {"type": "string", "description": "dealership name"},
+        "date_range": {"type": "string", "description": "report date range, MM/DD/YYYY - MM/DD/YYYY"},
+    }
+    for prefix, title, metrics in KPI_CHANNELS:
+        if prefix == "bcdf":
+            props["has_bcdf"] = {"type": "boolean", "description": "true if the report has a BCDF slide"}
+            props["bcdf_tactics"] = {"type": "array", "items": {"type": "string"},
+                                     "description": "BCDF campaign / tactic names, empty if no BCDF"}
+        for m in metrics:
+            props[f"{prefix}_{m}"] = {"type": ["number", "null"],
+                                      "description": f"{title}: {_METRIC_DESC[m]}"}
+    return {
+        "type": "object",
+        "properties": props,
+        "required": list(props),
+        "additionalProperties": False,
+    }
+
+
+KPI_SCHEMA: Dict[str, Any] = _build_schema()
+
+
+def _prompt_from_schema(schema: Dict[str, Any]) -> str:
+    lines = [
+        "You are an expert at extracting specific metrics from dealership marketing",
+        "reports. Return ONLY a JSON object with exactly these keys. Numbers must be",
+        "bare JSON numbers (no $, % or commas); use null when a metric is truly",
+        "missing from the report, never a placeholder such as [xxx] or $x.xx.",
+        "",
+    ]
+    for key, spec in schema["properties"].items():
+        kind = spec["type"] if isinstance(spec["type"], str) else "/".join(spec["type"])
+        lines.append(f"- {key} ({kind}): {spec.get('description', '')}")
+    return "\n".join(lines) + "\n"
+
+
+SYSTEM_PROMPT = _prompt_from_schema(KPI_SCHEMA)
+
+
+@lru_cache(maxsize=None)
+def _schema_without(fields: Tuple[str, ...]) -> Tuple[str, Dict[str, Any]]:
+    """(system prompt, schema) minus fields the deck metadata already settled."""
+    if not fields:
+        return SYSTEM_PROMPT, KPI_SCHEMA
+    props = {k: v for k, v in KPI_SCHEMA["properties"].items() if k not in fields}
+    schema = dict(KPI_SCHEMA, properties=props, required=list(props))
+    return _prompt_from_schema(schema), schema
+
+# Tool definition used to force schema‑shaped output where supported
+KPI_TOOL_NAME = "record_kpis"
+KPI_TOOL_DESC = "Record the KPIs extracted from one dealership report."
 
 # placeholder tokens that appear in the reports or AI output
 PLACEHOLDER_NUM   = "[x,xxx]"
@@ -49,35 +128,194 @@ PLACEHOLDER_COST  = "$x.xx"
 PLACEHOLDER_CONV  = "[xx]"
 PLACEHOLDER_RATE  = "[xx.xx%]"
 
+
 # ---------------------------------------------------------------------------
 #  HELPER FUNCTIONS
 # ---------------------------------------------------------------------------
 
+class KPIParseError(ValueError):
+    """
+    Raised when a provider reply holds no parseable KPI object.
+    Carries enough context for the caller to log it and retry.
+    """
+
+    def __init__(self, reason: str, position: int = -1, snippet: str = "") -> None:
+        super().__init__(f"{reason} (at char {position}): {snippet!r}")
+        self.reason = reason
+        self.position = position
+        self.snippet = snippet
+
+
+def _object_spans(text: str) -> Iterator[tuple[int, int]]:
+    """
+    Single linear pass yielding (start, end) of every balanced top‑level
+    {...} in text. Braces inside JSON strings are ignored, and code fences
+    or prose around the object are simply skipped over.
+    """
+    depth, start = 0, -1
+    in_str = escape = False
+    for i, ch in enumerate(text):
+        if in_str:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"' and depth:
+            in_str = True
+        elif ch == "{":
+            if not depth:
+                start = i
+            depth += 1
+        elif ch == "}" and depth:
+            depth -= 1
+            if not depth:
+                yield start, i + 1
+
+
+def _strip_trailing_commas(s: str) -> str:
+    """Drop commas that directly precede a closing } or ] (outside strings)."""
+    out: list[str] = []
+    in_str = escape = False
+    pending = -1   # index in out of a comma that may turn out to be trailing
+    for ch in s:
+        if in_str:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+            pending = -1
+        elif ch == ",":
+            pending = len(out)
+        elif ch in "}]":
+            if pending >= 0:
+                out[pending] = ""
+            pending = -1
+        elif not ch.isspace():
+            pending = -1
+        out.append(ch)
+    return "".join(out)
+
+
 def _json_from_text(text: str) -> Dict[str, Any]:
-    """Extract JSON object from text that may contain markdown or other content."""
-    # Try to find JSON object within markdown code blocks
-    json_match = re.search(r'```(?:json)?\s*({.*?})\s*```', text, re.DOTALL)
-    if json_match:
-        json_str = json_match.group(1)
-    else:
-        # Fall back to finding anything that looks like a JSON object
-        json_match = re.search(r'({[\s\S]*})', text)
-        json_str = json_match.group(1) if json_match else text
-    
-    try:
-        return json.loads(json_str)
-    except (json.JSONDecodeError, TypeError):
-        # If we failed to parse JSON, return empty dict
-        print(f"Failed to parse JSON from: {text[:200]}...")
-        return {}
-
-def _to_int(val: str | int | None) -> Optional[int]:
-    if val is None:
-        return None
-    if isinstance(val, int):
-        return val
-    cleaned = str(val).replace(",", "").strip()
-    return int(cleaned) if cleaned.isdigit() else None
+    """
+    Return the first complete top‑level JSON object in a model reply.
+    Tolerates markdown fences, surrounding prose and trailing commas;
+    raises KPIParseError instead of silently returning {}.
+    """
+    if not text or not text.strip():
+        raise KPIParseError("empty reply", 0, "")
+
+    first_error: Optional[KPIParseError] = None
+    for start, end in _object_spans(text):
+        candidate = text[start:end]
+        try:
+            obj = json.loads(candidate)
+        except json.JSONDecodeError:
+            try:
+                obj = json.loads(_strip_trailing_commas(candidate))
+            except json.JSONDecodeError as exc:
+                first_error = first_error or KPIParseError(
+                    f"invalid JSON: {exc.msg}", start + exc.pos, candidate[max(0, exc.pos - 40): exc.pos + 40])
+                continue
+        if isinstance(obj, dict):
+            return obj
+
+    if first_error:
+        raise first_error
+    brace = text.find("{")
+    if brace >= 0:
+        raise KPIParseError("unterminated JSON object", brace, text[brace: brace + 80])
+    raise KPIParseError("no JSON object in reply", 0, text[:80])
+
+
+class _JsonObjectStream:
+    """
+    Accumulates streamed reply text and tracks brace depth (string‑aware) so
+    the caller can stop reading as soon as the first top‑level object closes.
+    """
+
+    def __init__(self) -> None:
+        self._parts: list[str] = []
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self.chars = 0
+        self.done = False
+
+    def feed(self, chunk: str) -> bool:
+        """Add a chunk; returns True once the KPI object is complete."""
+        if self.done or not chunk:
+            return self.done
+        for i, ch in enumerate(chunk):
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"' and self._depth:
+                self._in_str = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}" and self._depth:
+                self._depth -= 1
+                if not self._depth:
+                    chunk = chunk[: i + 1]
+                    self.done = True
+                    break
+        self._parts.append(chunk)
+        self.chars += len(chunk)
+        return self.done
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+
+_PROGRESS_EVERY = 200   # chars between on_progress callbacks
+
+
+# events read after the closing brace, only to pick up trailing usage totals
+_DRAIN_EVENTS = 8
+
+
+def _stream_into(scanner: _JsonObjectStream, chunks, on_progress: Optional[Callable[[int], None]]) -> str:
+    """Feed streamed text chunks into scanner, stopping at the closing brace."""
+    reported = 0
+    for chunk in chunks:
+        if scanner.feed(chunk):
+            break
+        if on_progress and scanner.chars - reported >= _PROGRESS_EVERY:
+            reported = scanner.chars
+            on_progress(scanner.chars)
+    # a forced tool call / JSON mode ends right after the object, so a few
+    # more events cost nothing and carry the usage block
+    if scanner.done:
+        for _, _ in zip(range(_DRAIN_EVENTS), chunks):
+            pass
+    if on_progress:
+        on_progress(scanner.chars)
+    return scanner.text
+
+
+# uncached_requests: requests whose cacheable prefix the provider declined
+# (shorter than Provider.min_cache_tokens), so no cache read or write
+USAGE_KEYS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens",
+              "uncached_requests")
+
+
+def _add_usage(total: Optional[Dict[str, int]], usage: Dict[str, int]) -> None:
+    if total is None:
+        return
+    for key in USAGE_KEYS:
+        total[key] = total.get(key, 0) + int(usage.get(key) or 0)
 
 
 def _is_placeholder(value: Any) -> bool:
@@ -157,144 +395,827 @@ def cleanup_placeholders(kpis: Dict[str, Any]) -> Dict[str, Any]:
     return kpis
 
 
-def validate_kpis(kpis: Dict[str, Any]) -> Dict[str, Any]:
-    # strip commas in numeric strings
-    for k, v in list(kpis.items()):
-        if isinstance(v, str) and re.fullmatch(r"\d{1,3}(,\d{3})+", v):
-            kpis[k] = v.replace(",", "")
+def _to_number(val: Any) -> Optional[float]:
+    """"$1,234.50" / "12.5%" / 1234 → number; placeholders and junk → None."""
+    if isinstance(val, bool) or val is None:
+        return None
+    if isinstance(val, (int, float)):
+        return val
+    cleaned = str(val).replace(",", "").replace("$", "").replace("%", "").strip()
+    try:
+        num = float(cleaned)
+    except ValueError:
+        return None
+    return int(num) if num.is_integer() and "." not in cleaned else num
+
+
+def conform_to_schema(kpis: Dict[str, Any], schema: Dict[str, Any] = KPI_SCHEMA) -> Dict[str, Any]:
+    """
+    Local check against KPI_SCHEMA: coerce each value to its declared type,
+    drop unknown keys, and omit metrics that are null so the email and UI
+    only ever see real values.
+    """
+    out: Dict[str, Any] = {}
+    for key, spec in schema["properties"].items():
+        val = kpis.get(key)
+        kind = spec["type"]
+        if kind == "string":
+            if val is not None and not _is_placeholder(val):
+                out[key] = str(val).strip()
+        elif kind == "boolean":
+            out[key] = val if isinstance(val, bool) else str(val).strip().lower() == "true"
+        elif kind == "array":
+            # a bare string is kept as‑is; organize_bcdf_tactics handles both
+            if isinstance(val, (list, str)) and val:
+                out[key] = val
+        else:
+            num = _to_number(val)
+            if num is not None:
+                out[key] = num
+    return out
 
+
+def validate_kpis(kpis: Dict[str, Any]) -> Dict[str, Any]:
+    kpis = conform_to_schema(kpis)
     kpis = organize_bcdf_tactics(kpis)
     kpis = cleanup_placeholders(kpis)
     return kpis
 
 # ---------------------------------------------------------------------------
-#  PMAX / VLA EDGE‑CASE FIX (Palmer)
+#  PMAX / VLA RECONCILIATION
 # ---------------------------------------------------------------------------
 
-def fix_pmax_vla_inconsistency(kpis: Dict[str, Any]) -> Dict[str, Any]:
-    has_pmax = any(k.startswith("pmax_") and not k.startswith("pmax_vla_") for k in kpis)
-    has_vla  = any(k.startswith("pmax_vla_") for k in kpis)
-    if not (has_pmax and has_vla):
-        return kpis
+_PMAX_METRICS = ("impr", "clicks", "cpc", "conv", "cost_conv")
+_SLIDE_CHANNELS = ("pmax", "pmax_vla")
 
-    pmax_total = _to_int(kpis.get("pmax_impr"))
-    vla_total  = _to_int(kpis.get("pmax_vla_impr"))
-    if pmax_total is None or vla_total is None:
-        return kpis
 
-    if 0 < vla_total < pmax_total * 0.25 and "palmer" in kpis.get("store_name", "").lower():
-        for metric in ("impr", "clicks", "cpc", "conv", "cost_conv"):
-            kpis[f"pmax_vla_{metric}"] = kpis.get(f"pmax_{metric}")
-            placeholder = (
-                PLACEHOLDER_COST  if metric == "cpc"   else
-                PLACEHOLDER_CLICK if metric == "clicks" else
-                PLACEHOLDER_CONV  if metric == "conv"   else
-                PLACEHOLDER_NUM
-            )
-            kpis[f"pmax_{metric}"] = placeholder
-    return kpis
+def _same_figure(a: float, b: float) -> bool:
+    return abs(a - b) <= max(0.005 * max(abs(a), abs(b)), 0.01)
+
+
+def _figure_source(kpis: Dict[str, Any], block: str, slide_kpis: Dict[str, Any]) -> Optional[str]:
+    """
+    Which slide ("pmax" / "pmax_vla") the LLM's figures for one block were
+    read from, by majority over the metrics that can be compared; None when
+    undecidable (no regex figures, both slides identical, or no match).
+    """
+    votes = {src: 0 for src in _SLIDE_CHANNELS}
+    compared = 0
+    for m in _PMAX_METRICS:
+        got = _to_number(kpis.get(f"{block}_{m}"))
+        if got is None:
+            continue
+        refs = {src: _to_number(slide_kpis.get(f"{src}_{m}")) for src in _SLIDE_CHANNELS}
+        if all(r is None for r in refs.values()):
+            continue
+        compared += 1
+        hits = [src for src, r in refs.items() if r is not None and _same_figure(got, r)]
+        if len(hits) == 1:
+            votes[hits[0]] += 1
+    if not compared:
+        return None
+    best = max(votes, key=votes.get)
+    rival = votes["pmax" if best == "pmax_vla" else "pmax_vla"]
+    return best if votes[best] > rival and votes[best] * 2 >= compared else None
+
+
+def reconcile_pmax_vla(kpis: Dict[str, Any], slide_kpis: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Put every PMAX / PMAX‑VLA figure back on the channel whose slide it came
+    from, using the regex KPIs of the PMAX and PMAX_VLA slides as reference:
+    swapped blocks are swapped back, a block copied into the wrong channel
+    is replaced by that channel's own slide figures (or dropped when the
+    deck has no such slide). Local and cheap; returns (kpis, notes).
+    """
+    if not slide_kpis:
+        return kpis, []
+    source = {block: _figure_source(kpis, block, slide_kpis) for block in _SLIDE_CHANNELS}
+    wrong = [block for block in _SLIDE_CHANNELS if source[block] not in (None, block)]
+    if not wrong:
+        return kpis, []
+
+    blocks = {block: {m: kpis.pop(f"{block}_{m}") for m in _PMAX_METRICS if f"{block}_{m}" in kpis}
+              for block in _SLIDE_CHANNELS}
+    notes = []
+    for block in _SLIDE_CHANNELS:
+        other = "pmax" if block == "pmax_vla" else "pmax_vla"
+        if source[block] == block:
+            figures = blocks[block]
+        elif source[other] == block:
+            figures = blocks[other]
+            notes.append(f"{block} figures were reported under {other}; moved back")
+        elif source[block] is None:
+            figures = blocks[block]
+        else:
+            # this block repeats the other slide; fall back to its own slide's figures
+            figures = {m: slide_kpis.get(f"{block}_{m}") for m in _PMAX_METRICS}
+            figures = {m: v for m, v in figures.items() if v is not None}
+            notes.append(f"{block} repeated the {other} slide; "
+                         + ("used the regex figures of its own slide" if figures else "dropped (no such slide)"))
+        kpis.update({f"{block}_{m}": v for m, v in figures.items()})
+    return kpis, notes
+
 
 # ---------------------------------------------------------------------------
 #  AI CLIENT WRAPPERS
 # ---------------------------------------------------------------------------
 
 
-def _query_claude(api_key: str, document: str) -> Dict[str, Any]:
+# Adapters return (raw reply text, token usage). The static prefix (tool
+# schema + SYSTEM_PROMPT) always comes first and the deck last, so
+# provider‑side prompt caching can reuse it across every deck of a batch.
+# Model ids, limits and retry policy come from the registry (providers.py).
+# Adapters make exactly one HTTP attempt (SDK retries are off); _call retries
+# transport failures itself so provider_metrics sees every retry.
+Reply = Tuple[str, Dict[str, int]]
+
+# statuses worth another attempt (as the SDKs' own retry logic treats them)
+_RETRY_STATUSES = (408, 409, 429)
+
+
+class ProviderHTTPError(RuntimeError):
+    """Non‑200 reply from a plain‑HTTP provider."""
+
+    def __init__(self, message: str, status_code: int) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _retryable(exc: Exception) -> bool:
+    if isinstance(exc, (anthropic.APIConnectionError, openai.APIConnectionError,
+                        requests.ConnectionError, requests.Timeout)):
+        return True
+    status = getattr(exc, "status_code", None)
+    return isinstance(status, int) and (status in _RETRY_STATUSES or status >= 500)
+
+
+def _truncate(spec: Provider, document: str) -> str:
+    if spec.max_input_chars and len(document) > spec.max_input_chars:
+        return document[:spec.max_input_chars] + "\n[Truncated]"
+    return document
+
+
+def _query_claude(spec: Provider, api_key: str, document: str,
+                  on_progress: Optional[Callable[[int], None]] = None,
+                  system: str = SYSTEM_PROMPT, schema: Dict[str, Any] = KPI_SCHEMA) -> Reply:
     """
     Calls Anthropic Claude 3 using the correct message schema.
+    Streams the reply and hangs up once the KPI object's closing brace arrives.
+    The tool + system prefix is marked cacheable (cache_control); a reply
+    with neither a cache read nor a write means the prefix was under the
+    model's minimum and is counted in usage["uncached_requests"].
     """
-    client = anthropic.Anthropic(api_key=api_key)
+    client = anthropic.Anthropic(api_key=api_key, max_retries=0, timeout=spec.timeout_s)
 
-    resp = client.messages.create(
-        model="claude-3-opus-20240229",
-        max_tokens=4000,
-        system=SYSTEM_PROMPT,
+    stream = client.messages.create(
+        model=spec.model,
+        max_tokens=spec.max_output_tokens,
+        # cache breakpoint after the system block covers tools + system
+        system=[{"type": "text", "text": system,
+                 "cache_control": {"type": "ephemeral"}}],
+        # forced tool call → the reply is the schema‑shaped tool input
+        tools=[{"name": KPI_TOOL_NAME, "description": KPI_TOOL_DESC,
+                "input_schema": schema}],
+        tool_choice={"type": "tool", "name": KPI_TOOL_NAME},
         messages=[
             {
                 "role": "user",
                 "content": [  # ← must be a list of dicts
-                    { "type": "text", "text": document }
+                    { "type": "text", "text": _truncate(spec, document) }
                 ]
             }
-        ]
+        ],
+        stream=True,
     )
+    usage: Dict[str, int] = {}
 
-    # Claude 3 returns content as a list as well
-    reply = resp.content[0].text if isinstance(resp.content, list) else resp.content
-    return _json_from_text(reply)
+    def chunks() -> Iterator[str]:
+        for event in stream:
+            if event.type == "message_start":
+                u = event.message.usage
+                usage["input_tokens"] = u.input_tokens
+                usage["cache_read_tokens"] = getattr(u, "cache_read_input_tokens", 0) or 0
+                usage["cache_write_tokens"] = getattr(u, "cache_creation_input_tokens", 0) or 0
+            elif event.type == "message_delta" and event.usage:
+                usage["output_tokens"] = event.usage.output_tokens
+            elif event.type == "content_block_delta":
+                delta = event.delta
+                yield getattr(delta, "partial_json", None) or getattr(delta, "text", "") or ""
 
+    try:
+        reply = _stream_into(_JsonObjectStream(), chunks(), on_progress)
+    finally:
+        stream.response.close()   # stop generation of any trailing prose
+    if not usage.get("cache_read_tokens") and not usage.get("cache_write_tokens"):
+        usage["uncached_requests"] = 1
+    return reply, usage
 
 
-def _query_openai(api_key: str, document: str) -> Dict[str, Any]:
-    client = openai.OpenAI(api_key=api_key)
-    resp = client.chat.completions.create(
-        model="gpt-4-turbo",
+
+def _query_openai(spec: Provider, api_key: str, document: str,
+                  on_progress: Optional[Callable[[int], None]] = None,
+                  system: str = SYSTEM_PROMPT, schema: Dict[str, Any] = KPI_SCHEMA) -> Reply:
+    """OpenAI caches identical prompt prefixes automatically (≥1024 tokens)."""
+    client = openai.OpenAI(api_key=api_key, max_retries=0, timeout=spec.timeout_s)
+    stream = client.chat.completions.create(
+        model=spec.model,
+        max_tokens=spec.max_output_tokens,
         messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user",   "content": document}
+            {"role": "system", "content": system},
+            {"role": "user",   "content": _truncate(spec, document)}
         ],
-        response_format={"type": "json_object"}
+        tools=[{"type": "function",
+                "function": {"name": KPI_TOOL_NAME, "description": KPI_TOOL_DESC,
+                             "parameters": schema}}],
+        tool_choice={"type": "function", "function": {"name": KPI_TOOL_NAME}},
+        stream=True,
+        stream_options={"include_usage": True},
     )
-    return json.loads(resp.choices[0].message.content)
+    usage: Dict[str, int] = {}
 
+    def chunks() -> Iterator[str]:
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                details = getattr(chunk.usage, "prompt_tokens_details", None)
+                usage["input_tokens"] = chunk.usage.prompt_tokens
+                usage["output_tokens"] = chunk.usage.completion_tokens
+                usage["cache_read_tokens"] = getattr(details, "cached_tokens", 0) or 0
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.tool_calls:
+                yield delta.tool_calls[0].function.arguments or ""
+            else:
+                yield delta.content or ""
 
-def _query_deepseek(api_key: str, document: str) -> Dict[str, Any]:
+    try:
+        reply = _stream_into(_JsonObjectStream(), chunks(), on_progress)
+    finally:
+        stream.response.close()
+    return reply, usage
+
+
+def _sse_content(resp: requests.Response, usage: Dict[str, int]) -> Iterator[str]:
+    """Yield delta text from an OpenAI‑compatible server‑sent‑event stream."""
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        event = json.loads(data)
+        if event.get("usage"):
+            u = event["usage"]
+            usage["input_tokens"] = u.get("prompt_tokens", 0)
+            usage["output_tokens"] = u.get("completion_tokens", 0)
+            # DeepSeek reports its disk cache hits separately
+            usage["cache_read_tokens"] = u.get("prompt_cache_hit_tokens") or \
+                (u.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        choices = event.get("choices") or [{}]
+        yield (choices[0].get("delta") or {}).get("content") or ""
+
+
+def _query_openai_compatible(spec: Provider, api_key: str, document: str,
+                             on_progress: Optional[Callable[[int], None]] = None,
+                             system: str = SYSTEM_PROMPT, schema: Dict[str, Any] = KPI_SCHEMA) -> Reply:
     """
-    Call DeepSeek Chat API (OpenAI‑compatible) and return the JSON KPI object.
-    Removes unsupported 'response_format' and handles long docs gracefully.
+    Plain‑HTTP chat completions for DeepSeek and local OpenAI‑compatible
+    servers; returns the raw JSON reply. Uses the server's JSON output mode
+    where the registry says it has one, and truncates over‑long decks.
+    DeepSeek's context cache matches on the unchanged system‑prompt prefix.
     """
 
-    if not api_key:
-        raise RuntimeError("DEEPSEEK_API_KEY is missing or empty")
-
-    url = "https://api.deepseek.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-    }
+    if spec.needs_key and not api_key:
+        raise RuntimeError(f"{spec.key_env} is missing or empty")
 
-    # DeepSeek has a ~60 k token limit; hard‑truncate huge decks.
-    if len(document) > 50_000:
-        document = document[:50_000] + "\n[Truncated]"
+    url = spec.base_url.rstrip("/") + "/chat/completions"
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
 
     payload = {
-        "model": "deepseek-chat",
+        "model": spec.model,
         "messages": [
-            { "role": "system", "content": SYSTEM_PROMPT },
-            { "role": "user",   "content": document      }
+            { "role": "system", "content": system },
+            { "role": "user",   "content": _truncate(spec, document) }
         ],
-        # No 'response_format' key – DeepSeek doesn't support it
+        "max_tokens": spec.max_output_tokens,
         "temperature": 0.2,
+        "stream": True,
+        "stream_options": {"include_usage": True},
     }
+    if spec.json_mode:
+        # JSON mode guarantees an object; keys follow the system prompt
+        payload["response_format"] = {"type": "json_object"}
 
-    for attempt in range(3):
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
-        if resp.status_code == 200:
-            txt = resp.json()["choices"][0]["message"]["content"]
-            return _json_from_text(txt)
-        else:
-            # Log first failure for easier debugging
-            if attempt == 0:
-                print("DeepSeek error:", resp.status_code, resp.text[:300])
-        time.sleep((attempt + 1) * 2)   # back‑off 2s, 4s
+    resp = requests.post(url, headers=headers, json=payload, timeout=spec.timeout_s, stream=True)
+    try:
+        if resp.status_code != 200:
+            print(f"{spec.label} error:", resp.status_code, resp.text[:300])
+            raise ProviderHTTPError(f"{spec.label} API failed (last status {resp.status_code})",
+                                    resp.status_code)
+        usage: Dict[str, int] = {}
+        txt = _stream_into(_JsonObjectStream(), _sse_content(resp, usage), on_progress)
+    finally:
+        resp.close()
+    return txt, usage
+
+
+_MOCK_DECK = re.compile(r"^=== DECK (\S+) ===$(.*?)^=== END DECK \1 ===$", re.M | re.S)
+_DATE_RANGE = re.compile(r"\d{1,2}/\d{1,2}/\d{4}\s*-\s*\d{1,2}/\d{1,2}/\d{4}")
+
+
+def _mock_kpis(text: str) -> Dict[str, Any]:
+    """Regex KPIs of structured (or condensed) slide text, first value per key wins."""
+    from pptx_extractor import channel_kpis
 
-    raise RuntimeError(f"DeepSeek API failed (last status {resp.status_code})")
+    kpis: Dict[str, Any] = {}
+    tactics: List[str] = []
+    for n, (stype, body) in enumerate(slide_blocks(text)):
+        body = body.strip()
+        if n == 0 and body:
+            kpis["store_name"] = body.splitlines()[0].strip()
+        if not body:
+            continue
+        for key, value in channel_kpis(stype, body).items():
+            if key == "bcdf_tactics":
+                if value:
+                    tactics.append(value)
+            elif value is not None and kpis.get(key) is None:
+                kpis[key] = value
+    kpis["bcdf_tactics"] = tactics
+    kpis.setdefault("has_bcdf", False)
+    m = _DATE_RANGE.search(text)
+    if m:
+        kpis["date_range"] = m.group(0)
+    return kpis
+
+
+def _query_mock(spec: Provider, api_key: str, document: str,
+                on_progress: Optional[Callable[[int], None]] = None,
+                system: str = SYSTEM_PROMPT, schema: Dict[str, Any] = KPI_SCHEMA) -> Reply:
+    """
+    Offline, deterministic stand‑in: answers with the regex slide KPIs of
+    the document (per deck id for packed requests). Token counts are the
+    usual ≈4 chars per token estimate, so cost / throughput reports work.
+    """
+    decks = {m.group(1): m.group(2) for m in _MOCK_DECK.finditer(document)}
+    if decks and set(decks) == set(schema["properties"]):
+        answer: Dict[str, Any] = {d: _mock_kpis(text) for d, text in decks.items()}
+    else:
+        answer = _mock_kpis(document)
+    if spec.simulated_latency_s:
+        time.sleep(spec.simulated_latency_s)
+    reply = json.dumps(answer)
+    if on_progress:
+        on_progress(len(reply))
+    usage = {"input_tokens": (len(system) + len(document)) // 4 + 1,
+             "output_tokens": len(reply) // 4 + 1}
+    return reply, usage
+
+
+# adapter family (providers.APIS) → implementation
+_ADAPTERS: Dict[str, Callable[..., Reply]] = {
+    "anthropic":     _query_claude,
+    "openai":        _query_openai,
+    "openai_compat": _query_openai_compatible,
+    "mock":          _query_mock,
+}
 
 
 # ---------------------------------------------------------------------------
 #  PUBLIC ENTRY
 # ---------------------------------------------------------------------------
 
-def extract_kpis_with_ai(api_key: str, document_text: str, ai_provider: str = "deepseek") -> Dict[str, Any]:
-    if ai_provider == "claude":
-        kpis = _query_claude(api_key, document_text)
-    elif ai_provider == "openai":
-        kpis = _query_openai(api_key, document_text)
-    elif ai_provider == "deepseek":
-        kpis = _query_deepseek(api_key, document_text)
-    else:
-        raise ValueError(f"Unsupported AI provider: {ai_provider}")
+def _adapter(ai_provider: str) -> Tuple[Provider, Callable[..., Reply]]:
+    spec = get_provider(ai_provider)
+    return spec, _ADAPTERS[spec.api]
 
+
+def _call(spec: Provider, query: Callable[..., Reply], api_key: str, document: str,
+          on_progress: Optional[Callable[[int], None]], system: str, schema: Dict[str, Any],
+          attempt: int, retries: Optional[List[str]] = None) -> Reply:
+    """
+    One provider call, served from / recorded to the LLM archive when
+    enabled. Transport failures (connection errors, timeouts, 408 / 409 /
+    429 / 5xx) are retried up to spec.retries times with linear back‑off;
+    each retry's error is appended to retries.
+    """
+    if llm_archive.replaying():
+        return llm_archive.replay(spec.model, system, schema, document, attempt, on_progress)
+    started = time.perf_counter()
+    for retry in range(1 + spec.retries):
+        try:
+            reply, usage = query(spec, api_key, document, on_progress, system=system, schema=schema)
+            break
+        except Exception as exc:
+            if retry == spec.retries or not _retryable(exc):
+                raise
+            if retries is not None:
+                retries.append(f"{type(exc).__name__}: {exc}")
+            time.sleep((retry + 1) * spec.backoff_s)   # linear back‑off
+    if llm_archive.recording():
+        llm_archive.record(spec.name, spec.model, system, schema, document, attempt,
+                           reply, usage, time.perf_counter() - started)
+    return reply, usage
+
+
+def _query_json(ai_provider: str, api_key: str, document: str,
+                on_progress: Optional[Callable[[int], None]], usage: Optional[Dict[str, int]],
+                system: str = SYSTEM_PROMPT, schema: Dict[str, Any] = KPI_SCHEMA,
+                decks: int = 1) -> Dict[str, Any]:
+    spec, query = _adapter(ai_provider)
+    request_usage: Dict[str, int] = {}
+    calls = failures = 0
+    retries: List[str] = []
+    error: Optional[str] = None
+    # decks this request delivered: none when it fails (its decks are asked
+    # again, and counted there), and for a pack only those its reply holds
+    delivered = 0
+    started = time.perf_counter()
+    # A malformed reply is re‑asked (spec.parse_retries times); a final
+    # failure surfaces to the caller rather than producing an empty email.
+    try:
+        for attempt in range(1 + spec.parse_retries):
+            calls += 1
+            reply, call_usage = _call(spec, query, api_key, document, on_progress, system, schema, attempt,
+                                      retries)
+            _add_usage(request_usage, call_usage)
+            try:
+                result = _json_from_text(reply)
+            except KPIParseError as exc:
+                failures += 1
+                print(f"{ai_provider} reply unparseable (attempt {attempt + 1}): {exc}")
+                if attempt == spec.parse_retries:
+                    raise
+                continue
+            delivered = decks if decks <= 1 else \
+                sum(1 for sub in result.values() if isinstance(sub, dict) and sub)
+            return result
+        raise AssertionError("unreachable")
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        _add_usage(usage, request_usage)
+        if not llm_archive.replaying():
+            provider_metrics.record_request(
+                spec.name, spec.model, delivered, time.perf_counter() - started, calls, failures,
+                request_usage, cost_usd(spec, request_usage), error, retries=len(retries))
+
+
+def _finalize(kpis: Dict[str, Any], slide_kpis: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     kpis = validate_kpis(kpis)
-    kpis = fix_pmax_vla_inconsistency(kpis)
+    kpis, notes = reconcile_pmax_vla(kpis, slide_kpis)
+    for note in notes:
+        print(f"PMAX/VLA reconciliation ({kpis.get('store_name', '?')}): {note}")
     return kpis
+
+
+def _extract_routed(api_key: str, document_text: str, ai_provider: str,
+                    on_progress: Optional[Callable[[int], None]], usage: Optional[Dict[str, int]],
+                    deck: Optional[Dict[str, Any]], route: Optional[Dict[str, Any]],
+                    slide_kpis: Optional[Dict[str, Any]], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    system, schema = _schema_without(tuple(sorted(metadata)))
+
+    def ask(provider: str) -> Dict[str, Any]:
+        reply = _query_json(provider, api_key, document_text, on_progress, usage, system=system, schema=schema)
+        return _finalize({**reply, **metadata}, slide_kpis)
+
+    if deck is None:
+        return ask(ai_provider)
+
+    decision = model_router.plan(get_provider(ai_provider), deck)
+    if route is not None:
+        route.update(decision)
+    if decision["tier"] == "full":
+        return ask(ai_provider)
+
+    try:
+        kpis = ask(decision["provider"])
+        problems = model_router.check(kpis, deck)
+    except Exception as exc:   # fast model unavailable or unparseable → full model
+        problems = [f"{type(exc).__name__}: {exc}"]
+    if not problems:
+        return kpis
+
+    print(f"Stepping up from {decision['model']}: {'; '.join(problems[:3])}")
+    kpis = ask(ai_provider)
+    if route is not None:
+        full = get_provider(ai_provider)
+        route.update(provider=full.name, model=full.model, tier="full", stepped_up=problems)
+    return kpis
+
+
+def extract_kpis_with_ai(api_key: str, document_text: str, ai_provider: str = "deepseek",
+                         on_progress: Optional[Callable[[int], None]] = None,
+                         usage: Optional[Dict[str, int]] = None,
+                         deck: Optional[Dict[str, Any]] = None,
+                         route: Optional[Dict[str, Any]] = None,
+                         repairs: Optional[List[Dict[str, Any]]] = None,
+                         slide_kpis: Optional[Dict[str, Any]] = None,
+                         metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    ai_provider is any name in the provider registry (providers.py),
+    including the offline "local" and "mock" providers (api_key "").
+    on_progress, if given, is called with the number of reply characters
+    received so far while the provider streams its answer.
+    usage, if given, is a running total (see USAGE_KEYS) that this call's
+    token counts – including prompt‑cache reads / writes – are added to.
+    deck, the parse_deck() result for document_text, turns on model
+    routing: simple decks go to the provider's fast variant and are re‑asked
+    on the full model when the result fails model_router.check(). route,
+    if given, is filled with the routing decision.
+    Channels that fail the consistency check are re‑read from their own
+    slides only (see repair_suspect_channels); repairs, if given, is
+    extended with what was re‑asked.
+    slide_kpis, the regex KPIs of the deck (deck["kpis"] by default),
+    lets PMAX / PMAX‑VLA figures be reconciled locally.
+    metadata holds fields already known without the LLM (store_name,
+    date_range – see deck_metadata.known_fields); they are left out of
+    the prompt and schema and copied into the result.
+    """
+    if slide_kpis is None and deck is not None:
+        slide_kpis = deck.get("kpis")
+    metadata = {k: v for k, v in (metadata or {}).items() if v}
+    kpis = _extract_routed(api_key, document_text, ai_provider, on_progress, usage, deck, route,
+                           slide_kpis, metadata)
+    done = repair_suspect_channels(kpis, document_text, ai_provider, api_key, on_progress, usage)
+    if repairs is not None:
+        repairs.extend(done)
+    return kpis
+
+
+# ---------------------------------------------------------------------------
+#  MULTI‑DECK PACKING
+# ---------------------------------------------------------------------------
+
+# Rough input budget per packed request (≈4 chars per token, incl. system
+# prompt and schema) and a deck cap that keeps the combined KPI objects well
+# inside the output limit.
+PACK_TOKEN_BUDGET = 30_000
+PACK_MAX_DECKS = 8
+
+_PACK_INSTRUCTIONS = """
+The user message holds SEVERAL reports. Each one starts with a line
+"=== DECK <id> ===" and ends with "=== END DECK <id> ===". Return ONE JSON
+object whose keys are the deck ids and whose values are that deck's KPI
+object with the keys above. Never mix figures between decks.
+"""
+
+# a slide header in either form: parse_deck's "--- SLIDE n | TYPE: X ---" or
+# condense_document's "[X]" (upper case, so "[xxx]" placeholders don't match)
+_SLIDE_BLOCK = re.compile(r"^(?:--- SLIDE \d+ \| TYPE: (\w+) ---|\[([A-Z][A-Z_]*)\])$", re.M)
+
+
+def slide_blocks(text: str) -> List[Tuple[str, str]]:
+    """(slide type, body) of every slide in structured or condensed deck text."""
+    parts = _SLIDE_BLOCK.split(text)
+    # parts = [preamble, type, condensed type, body, ...] – one type group is None
+    return [(full or short, body) for full, short, body in zip(parts[1::3], parts[2::3], parts[3::3])]
+
+
+def condense_document(text: str) -> str:
+    """
+    Keep the title slide plus every slide that is a known channel type or
+    mentions a KPI label; drop separator lines. Typically a few KB per deck.
+    """
+    parts = SLIDE_SPLIT.split(text)
+    # parts = [preamble, type1, body1, type2, body2, ...]
+    kept = []
+    for n, (stype, body) in enumerate(zip(parts[1::2], parts[2::2])):
+        if n == 0 or stype != "OTHER" or KPI_LABEL.search(body):
+            body = "\n".join(l for l in body.strip().splitlines() if not l.startswith("-" * 10))
+            kept.append(f"[{stype}]\n{body}")
+    return "\n\n".join(kept) if kept else text
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def _pack_ids(count: int) -> List[str]:
+    """Deck ids within one pack – numbered per pack, so equal‑sized packs
+    share an identical tool schema (and the provider's cached prefix)."""
+    return [f"deck_{n}" for n in range(1, count + 1)]
+
+
+def _pack_schema(count: int, schema: Dict[str, Any] = KPI_SCHEMA) -> Dict[str, Any]:
+    """The KPI object is defined once and referenced by every deck id."""
+    deck_ids = _pack_ids(count)
+    return {
+        "type": "object",
+        "$defs": {"kpis": schema},
+        "properties": {d: {"$ref": "#/$defs/kpis"} for d in deck_ids},
+        "required": deck_ids,
+        "additionalProperties": False,
+    }
+
+
+def _pack_text(pack: Dict[str, str]) -> str:
+    return "\n\n".join(f"=== DECK {d} ===\n{text}\n=== END DECK {d} ===" for d, text in pack.items())
+
+
+# request overhead a pack pays once (system prompt, instructions, schema) and
+# per deck (markers, $ref entry)
+_PACK_OVERHEAD = _estimate_tokens(SYSTEM_PROMPT + _PACK_INSTRUCTIONS + json.dumps(_pack_schema(1)))
+_PACK_DECK_OVERHEAD = _estimate_tokens(_pack_text({"deck_10": ""}) + json.dumps(_pack_schema(1)["properties"]))
+
+
+def _plan_packs(documents: Dict[str, str], token_budget: int, max_decks: int) -> List[List[str]]:
+    """Greedy first‑fit in input order; an oversized deck gets a pack of its own."""
+    packs: List[List[str]] = []
+    size = 0
+    for deck_id, text in documents.items():
+        cost = _estimate_tokens(text) + _PACK_DECK_OVERHEAD
+        if not packs or len(packs[-1]) >= max_decks or size + cost > token_budget:
+            packs.append([])
+            size = _PACK_OVERHEAD
+        packs[-1].append(deck_id)
+        size += cost
+    return packs
+
+
+def extract_kpis_packed(api_key: str, documents: Dict[Any, str], ai_provider: str = "deepseek",
+                        token_budget: int = PACK_TOKEN_BUDGET, max_decks: int = PACK_MAX_DECKS,
+                        on_progress: Optional[Callable[[int], None]] = None,
+                        usage: Optional[Dict[str, int]] = None,
+                        slide_kpis: Optional[Dict[Any, Dict[str, Any]]] = None,
+                        metadata: Optional[Dict[Any, Dict[str, Any]]] = None,
+                        repairs: Optional[Dict[Any, List[Dict[str, Any]]]] = None) -> Iterator[Tuple[Any, Any]]:
+    """
+    Extract KPIs for many decks using as few requests as possible: condensed
+    decks are packed into one request each up to the token budget, and the
+    reply is keyed by deck id. Yields (key, kpis) as each pack finishes –
+    kpis is the exception instead when that deck could not be extracted.
+    Each deck's sub‑object goes through validate_kpis on its own; a deck
+    missing from the reply (or a pack whose reply won't parse) is retried
+    in smaller packs, down to a single‑deck request; a pack request that
+    fails outright (provider / transport error) falls back to one request
+    per deck. slide_kpis maps the
+    same keys to each deck's regex KPIs for PMAX / VLA reconciliation, and
+    metadata to each deck's known fields; a field known for every deck of
+    a pack is left out of that pack's schema. repairs, if given, gets each
+    deck's channel re‑asks (see repair_suspect_channels) before it is
+    yielded.
+    """
+    keys = {f"deck_{n}": key for n, key in enumerate(documents, 1)}
+    regex = {d: (slide_kpis or {}).get(k) for d, k in keys.items()}
+    known = {d: {f: v for f, v in ((metadata or {}).get(k) or {}).items() if v} for d, k in keys.items()}
+    condensed = {d: condense_document(documents[k]) for d, k in keys.items()}
+
+    def run(pack: List[str]) -> Iterator[Tuple[Any, Any]]:
+        # pack holds batch‑wide ids; the request numbers its decks 1…k
+        if len(pack) == 1:
+            d = pack[0]
+            done: List[Dict[str, Any]] = []
+            try:
+                kpis = extract_kpis_with_ai(api_key, condensed[d], ai_provider, on_progress, usage,
+                                            repairs=done, slide_kpis=regex[d], metadata=known[d])
+            except Exception as e:
+                yield keys[d], e
+                return
+            if repairs is not None and done:
+                repairs[keys[d]] = done
+            yield keys[d], kpis
+            return
+        local = dict(zip(_pack_ids(len(pack)), pack))
+        doc = _pack_text({n: condensed[d] for n, d in local.items()})
+        common = set.intersection(*(set(known[d]) for d in pack))
+        system, schema = _schema_without(tuple(sorted(common)))
+        try:
+            reply = _query_json(ai_provider, api_key, doc, on_progress, usage,
+                                system=system + _PACK_INSTRUCTIONS, schema=_pack_schema(len(pack), schema),
+                                decks=len(pack))
+        except KPIParseError:
+            mid = len(pack) // 2
+            yield from run(pack[:mid])
+            yield from run(pack[mid:])
+            return
+        except Exception:
+            # provider / transport failure: each deck gets its own request
+            # (and, if that fails too, its own exception)
+            for d in pack:
+                yield from run([d])
+            return
+        missing = []
+        for n, d in local.items():
+            sub = reply.get(n)
+            if isinstance(sub, dict) and sub:
+                kpis = _finalize({**sub, **known[d]}, regex[d])
+                done = repair_suspect_channels(kpis, condensed[d], ai_provider, api_key, on_progress, usage)
+                if repairs is not None and done:
+                    repairs[keys[d]] = done
+                yield keys[d], kpis
+            else:
+                missing.append(d)
+        for d in missing:
+            yield from run([d])
+
+    for pack in _plan_packs(condensed, token_budget, max_decks):
+        yield from run(pack)
+
+
+# ---------------------------------------------------------------------------
+#  CONSISTENCY CHECK & PARTIAL RE‑ASK
+# ---------------------------------------------------------------------------
+
+# Which slide type holds each channel (rsa has none – it sits on OTHER slides)
+_CHANNEL_SLIDES = {"pmax": "PMAX", "pmax_vla": "PMAX_VLA", "social": "SOCIAL",
+                   "dv": "VIDEO", "dg": "DEMAND_GEN", "bcdf": "BCDF"}
+# metrics a channel can't be reported without, once any of its metrics is there;
+# the rest are optional (Demand Gen is CPM‑only, BCDF often has no clicks)
+_CORE_METRICS = {"rsa": ("impr", "clicks"), "pmax": ("impr", "clicks"), "pmax_vla": ("impr", "clicks"),
+                 "dg": ("impr",), "dv": ("views",), "social": ("reach", "impr"), "bcdf": ("impr",)}
+# CPC × clicks and cost/conv × conversions both estimate spend
+SPEND_TOLERANCE = 0.10
+
+
+def find_suspect_channels(kpis: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Channel prefix → what looks wrong, for every internally inconsistent channel."""
+    suspects: Dict[str, List[str]] = {}
+    for prefix, _, metrics in KPI_CHANNELS:
+        vals = {m: _to_number(kpis.get(f"{prefix}_{m}")) for m in metrics}
+        present = {m: v for m, v in vals.items() if v is not None}
+        if not present:
+            continue
+        issues = []
+        missing = [m for m in _CORE_METRICS[prefix] if vals[m] is None]
+        if missing:
+            issues.append("missing " + ", ".join(missing))
+        if any(v < 0 for v in present.values()):
+            issues.append("negative value")
+        impr, clicks, reach = present.get("impr"), present.get("clicks"), present.get("reach")
+        if impr is not None and clicks is not None and clicks > impr:
+            issues.append(f"clicks ({clicks:,}) > impressions ({impr:,})")
+        if impr is not None and reach is not None and reach > impr:
+            issues.append(f"reach ({reach:,}) > impressions ({impr:,})")
+        cpc, conv, cost_conv = present.get("cpc"), present.get("conv"), present.get("cost_conv")
+        if None not in (cpc, clicks, conv, cost_conv) and clicks and conv:
+            by_cpc, by_conv = cpc * clicks, cost_conv * conv
+            if abs(by_cpc - by_conv) > SPEND_TOLERANCE * max(by_cpc, by_conv):
+                issues.append(f"CPC × clicks (${by_cpc:,.0f}) ≠ cost/conv × conversions (${by_conv:,.0f})")
+        if present.get("viewrate", 0) > 100:
+            issues.append(f"view rate {present['viewrate']}% > 100%")
+        if issues:
+            suspects[prefix] = issues
+    return suspects
+
+
+def channel_slides(document: str, prefix: str) -> str:
+    """Only the slides one channel's figures come from, in condensed form."""
+    stype = _CHANNEL_SLIDES.get(prefix)
+    slides = slide_blocks(document)
+    if stype:
+        picked = [(t, b) for t, b in slides if t == stype]
+    else:
+        picked = [(t, b) for t, b in slides if t == "OTHER" and KPI_LABEL.search(b)]
+    return "\n\n".join(f"[{t}]\n{b.strip()}" for t, b in picked)
+
+
+def _channel_schema(prefix: str) -> Dict[str, Any]:
+    keys = [f"{prefix}_{m}" for p, _, metrics in KPI_CHANNELS if p == prefix for m in metrics]
+    return {
+        "type": "object",
+        "properties": {k: KPI_SCHEMA["properties"][k] for k in keys},
+        "required": keys,
+        "additionalProperties": False,
+    }
+
+
+def repair_suspect_channels(kpis: Dict[str, Any], document: str, ai_provider: str, api_key: str,
+                            on_progress: Optional[Callable[[int], None]] = None,
+                            usage: Optional[Dict[str, int]] = None) -> List[Dict[str, Any]]:
+    """
+    Re‑ask each suspect channel with only its own slides and a schema of
+    just its metrics, and merge the answer into kpis (in place) when it
+    passes the consistency check. Returns one record per re‑ask.
+    """
+    repairs = []
+    titles = {p: title for p, title, _ in KPI_CHANNELS}
+    for prefix, issues in find_suspect_channels(kpis).items():
+        slides = channel_slides(document, prefix)
+        if not slides:
+            continue
+        schema = _channel_schema(prefix)
+        system = _prompt_from_schema(schema) + (
+            f"\nThe user message holds only the {titles[prefix]} slide(s) of one report. "
+            f"A previous reading looked wrong ({'; '.join(issues)}); read the figures again.\n")
+        record = {"channel": prefix, "issues": issues, "fixed": False}
+        try:
+            answer = conform_to_schema(
+                _query_json(ai_provider, api_key, slides, on_progress, usage, system=system, schema=schema,
+                            decks=0),   # a second look at a deck already counted
+                schema)
+        except Exception as exc:
+            record["error"] = f"{type(exc).__name__}: {exc}"
+            repairs.append(record)
+            continue
+        merged = {k: v for k, v in kpis.items() if k not in schema["properties"]}
+        merged.update(answer)
+        if prefix not in find_suspect_channels(merged):
+            kpis.clear()
+            kpis.update(merged)
+            record["fixed"] = True
+        repairs.append(record)
+    return repairs
@@ -0,0 +1,213 @@
+"""kpi_history.py – per‑store KPI history for month‑over‑month comparisons
+-----------------------------------------------------------------
+* One validated KPI record per (store, month) in a local SQLite file,
+  keyed on the store_registry key (account id) rather than the free‑form
+  store name; re‑processing a deck for the same month replaces its record
+* A deck is filed under the month its own date_range ends in
+  (report_month()); the month picked in the UI is only the fallback for
+  decks whose range is unknown
+* previous() – the prior month's record for a store, answered from an
+  in‑process index (a dict keyed by store) that is loaded once and
+  reloaded only when another process changes the SQLite file (our own
+  record() calls update it in place), so batch rendering pays a dict
+  lookup per deck rather than a query
+* import_files() backfills from downloaded KPI JSON (per‑store
+  <Store>_<Month>_<Year>_kpis.json and all_kpis_<Month>_<Year>.json); CLI:
+      python kpi_history.py import "project history"
+      python kpi_history.py show "Palmer Chrysler Dodge Jeep Ram"
+* Disable with KPI_HISTORY=off
+"""
+
+from __future__ import annotations
+
+import calendar
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+import deck_metadata
+import local_store
+import store_registry
+
+HISTORY_FILE = os.environ.get("KPI_HISTORY_FILE", "kpi_history.sqlite3")
+ENABLED = os.environ.get("KPI_HISTORY", "on") != "off"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    store_key   TEXT NOT NULL,      -- store_registry.Store.key
+    period      TEXT NOT NULL,      -- YYYY-MM
+    store_name  TEXT NOT NULL,
+    recorded    REAL NOT NULL,
+    kpis        TEXT NOT NULL,      -- JSON
+    PRIMARY KEY (store_key, period)
+) WITHOUT ROWID;
+"""
+
+_MONTHS = {name.lower(): n for n, name in enumerate(calendar.month_name) if name}
+_PERIOD_IN_NAME = re.compile(r"_(%s)_(\d{4})" % "|".join(calendar.month_name[1:]), re.I)
+
+
+def _db() -> ContextManager[sqlite3.Connection]:
+    return local_store.connect(HISTORY_FILE, _SCHEMA)
+
+
+def period_key(month: str) -> Optional[str]:
+    """'April 2025' → '2025-04'; None when the label isn't a month and year."""
+    parts = month.split()
+    if len(parts) != 2 or parts[0].lower() not in _MONTHS or not parts[1].isdigit():
+        return None
+    return f"{int(parts[1]):04d}-{_MONTHS[parts[0].lower()]:02d}"
+
+
+def report_month(kpis: Dict[str, Any], fallback: str) -> str:
+    """
+    Month label ('April 2025') a deck's KPIs belong to: the month its
+    date_range ends in, else `fallback` (the month selected for the batch).
+    """
+    found = deck_metadata.date_range_in(str(kpis.get("date_range") or ""))
+    if found is None:
+        return fallback
+    month, _, year = found.split(" - ")[1].split("/")
+    return f"{calendar.month_name[int(month)]} {year}"
+
+
+def previous_period(period: str) -> str:
+    year, month = map(int, period.split("-"))
+    return f"{year - 1}-12" if month == 1 else f"{year}-{month - 1:02d}"
+
+
+def period_label(period: str) -> str:
+    year, month = map(int, period.split("-"))
+    return f"{calendar.month_name[month]} {year}"
+
+
+# ---------------------------------------------------------------------------
+#  INDEX
+# ---------------------------------------------------------------------------
+
+class _Index(local_store.StampedIndex):
+    """store_key → {period: kpis}, rebuilt when the SQLite file changes."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._records: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    def path(self) -> str:
+        return HISTORY_FILE
+
+    def connect(self) -> ContextManager[sqlite3.Connection]:
+        return _db()
+
+    def load(self, conn: Optional[sqlite3.Connection]) -> None:
+        records: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        if conn is not None:
+            for key, period, kpis in conn.execute("SELECT store_key, period, kpis FROM records"):
+                records.setdefault(key, {})[period] = json.loads(kpis)
+        self._records = records   # swapped whole: readers never see a half‑built dict
+
+    def records(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        self.refresh()
+        return self._records
+
+    def add(self, store: str, period: str, kpis: Dict[str, Any]) -> None:
+        with self.wrote():
+            self._records.setdefault(store, {})[period] = kpis
+
+
+_index = _Index()
+
+
+def previous(store: str, month: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """(label, kpis) of the store's record for the month before `month`, if any."""
+    period = period_key(month)
+    if not ENABLED or period is None or not store:
+        return None
+    prior = previous_period(period)
+    kpis = _index.records().get(store, {}).get(prior)
+    return (period_label(prior), kpis) if kpis is not None else None
+
+
+def history(store: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """Every stored (period, kpis) for one store, oldest first."""
+    return sorted(_index.records().get(store, {}).items())
+
+
+def record(kpis: Dict[str, Any], month: str, store: str, recorded: Optional[float] = None) -> bool:
+    """
+    Store a validated KPI record under a registry key; False when the month
+    isn't one or the key is empty (store_registry.UNKNOWN).
+    """
+    period = period_key(month)
+    store_name = (kpis.get("store_name") or "").strip()
+    if not ENABLED or period is None or not store:
+        return False
+    _index.records()   # loaded before the write, so add() only has to add this record
+    try:
+        with _db() as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO records (store_key, period, store_name, recorded, kpis)"
+                         " VALUES (?, ?, ?, ?, ?)",
+                         (store, period, store_name,
+                          recorded if recorded is not None else time.time(), json.dumps(kpis)))
+    except sqlite3.Error as e:
+        # history must never fail a report
+        print(f"KPI history write failed: {e}")
+        return False
+    _index.add(store, period, kpis)
+    return True
+
+
+# ---------------------------------------------------------------------------
+#  BACKFILL
+# ---------------------------------------------------------------------------
+
+def import_files(paths: List[str]) -> int:
+    """
+    Load downloaded KPI JSON files, oldest first so later downloads win.
+    all_kpis files go first: they are keyed by deck filename, which puts
+    the account id and its name aliases into the store registry before
+    the per‑store files are matched by name.
+    """
+    from kpi_extractor import KPI_SCHEMA, validate_kpis
+
+    count = 0
+    for path in sorted(paths, key=lambda p: (not os.path.basename(p).startswith("all_kpis"),
+                                              os.path.getmtime(p))):
+        match = _PERIOD_IN_NAME.search(os.path.basename(path))
+        if not match:
+            continue
+        month = f"{match.group(1).title()} {match.group(2)}"
+        try:
+            with open(path, encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError) as e:
+            print(f"Skipped {path}: {e}")
+            continue
+        records = data.items() if os.path.basename(path).startswith("all_kpis") else [(None, data)]
+        for deck, kpis in records:
+            if not isinstance(kpis, dict) or sum(k in KPI_SCHEMA["properties"] for k in kpis) < len(kpis) / 2:
+                continue   # pre‑schema download with different field names
+            store = store_registry.resolve(deck, kpis.get("store_name"))
+            kpis = validate_kpis(dict(kpis))
+            if record(kpis, report_month(kpis, month), store.key, os.path.getmtime(path)):
+                count += 1
+    return count
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["import"] and len(sys.argv) == 3:
+        files = glob.glob(os.path.join(sys.argv[2], "*kpis*.json"))
+        print(f"Imported {import_files(files)} records from {len(files)} files")
+    elif sys.argv[1:2] == ["show"] and len(sys.argv) == 3:
+        store = store_registry.find(sys.argv[2])
+        if store is None:
+            sys.exit(f"Unknown store: {sys.argv[2]}")
+        for period, kpis in history(store.key):
+            print(period, json.dumps(kpis))
+    else:
+        sys.exit('usage: python kpi_history.py import DIR | show "Store Name"')
@@ -0,0 +1,164 @@
+"""llm_archive.py – record / replay of raw LLM traffic
+-----------------------------------------------------------------
+* record : every prompt (system + schema + deck) and raw reply is stored,
+           zlib‑compressed, in one SQLite file keyed by the prompt hash
+* replay : the same prompts are answered from the archive – no network,
+           no API key use – with the original latency or none at all
+* Parse re‑asks are recorded as separate attempts, so a replay walks the
+  exact same retry path as the original run
+* Mode comes from LLM_ARCHIVE_MODE (off | record | replay) and
+  LLM_REPLAY_LATENCY (original | zero), or configure() from code
+* CLI:  python llm_archive.py list | show <hash prefix>
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from typing import Any, Callable, ContextManager, Dict, Iterator, Optional, Tuple
+
+import local_store
+
+ARCHIVE_FILE = os.environ.get("LLM_ARCHIVE", "llm_archive.sqlite3")
+MODE = os.environ.get("LLM_ARCHIVE_MODE", "off")
+LATENCY = os.environ.get("LLM_REPLAY_LATENCY", "original")
+
+MODES = ("off", "record", "replay")
+LATENCIES = ("original", "zero")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    key       TEXT NOT NULL,      -- sha256 of model + system + schema + document
+    attempt   INTEGER NOT NULL,   -- 0 = first ask, 1.. = parse re‑asks
+    provider  TEXT NOT NULL,
+    model     TEXT NOT NULL,
+    recorded  REAL NOT NULL,
+    latency_s REAL NOT NULL,
+    usage     TEXT NOT NULL,
+    prompt    BLOB NOT NULL,      -- zlib(JSON {system, schema, document})
+    reply     BLOB NOT NULL,      -- zlib(raw reply text)
+    PRIMARY KEY (key, attempt)
+);
+"""
+
+
+class ReplayMiss(LookupError):
+    """Replay mode found no recorded reply for a prompt."""
+
+
+def configure(mode: Optional[str] = None, latency: Optional[str] = None,
+              archive_file: Optional[str] = None) -> None:
+    global MODE, LATENCY, ARCHIVE_FILE
+    if mode is not None:
+        if mode not in MODES:
+            raise ValueError(f"archive mode must be one of {', '.join(MODES)}")
+        MODE = mode
+    if latency is not None:
+        if latency not in LATENCIES:
+            raise ValueError(f"replay latency must be one of {', '.join(LATENCIES)}")
+        LATENCY = latency
+    if archive_file is not None:
+        ARCHIVE_FILE = archive_file
+
+
+def recording() -> bool:
+    return MODE == "record"
+
+
+def replaying() -> bool:
+    return MODE == "replay"
+
+
+def _db() -> ContextManager[sqlite3.Connection]:
+    return local_store.connect(ARCHIVE_FILE, _SCHEMA)
+
+
+def prompt_key(model: str, system: str, schema: Dict[str, Any], document: str) -> str:
+    h = hashlib.sha256()
+    for part in (model, system, json.dumps(schema, sort_keys=True), document):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# ---------------------------------------------------------------------------
+#  RECORD / REPLAY
+# ---------------------------------------------------------------------------
+
+def record(provider: str, model: str, system: str, schema: Dict[str, Any], document: str,
+           attempt: int, reply: str, usage: Dict[str, int], latency_s: float) -> str:
+    key = prompt_key(model, system, schema, document)
+    prompt = json.dumps({"system": system, "schema": schema, "document": document})
+    with _db() as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (key, attempt, provider, model, time.time(), latency_s, json.dumps(usage),
+                      zlib.compress(prompt.encode("utf-8"), 9), zlib.compress(reply.encode("utf-8"), 9)))
+    return key
+
+
+def replay(model: str, system: str, schema: Dict[str, Any], document: str, attempt: int,
+           on_progress: Optional[Callable[[int], None]] = None) -> Tuple[str, Dict[str, int]]:
+    """
+    (reply, usage) recorded for this prompt and attempt. A retry beyond the
+    recorded ones gets the last recorded reply again.
+    """
+    key = prompt_key(model, system, schema, document)
+    with _db() as conn:
+        row = conn.execute("SELECT reply, usage, latency_s FROM calls WHERE key = ? AND attempt <= ?"
+                           " ORDER BY attempt DESC LIMIT 1", (key, attempt)).fetchone()
+    if row is None:
+        raise ReplayMiss(f"No recorded {model} reply for prompt {key[:12]} in {ARCHIVE_FILE}")
+    reply = zlib.decompress(row[0]).decode("utf-8")
+    if LATENCY == "original":
+        time.sleep(row[2])
+    if on_progress:
+        on_progress(len(reply))
+    return reply, json.loads(row[1])
+
+
+# ---------------------------------------------------------------------------
+#  INSPECTION
+# ---------------------------------------------------------------------------
+
+def entries() -> Iterator[Dict[str, Any]]:
+    with _db() as conn:
+        rows = conn.execute("SELECT key, attempt, provider, model, recorded, latency_s, usage,"
+                            " length(prompt) + length(reply) FROM calls ORDER BY recorded").fetchall()
+    for key, attempt, provider, model, recorded, latency_s, usage, size in rows:
+        yield {"key": key, "attempt": attempt, "provider": provider, "model": model,
+               "recorded": recorded, "latency_s": latency_s, "usage": json.loads(usage), "bytes": size}
+
+
+def load(key_prefix: str) -> Dict[str, Any]:
+    """Full prompt and reply of every attempt whose key starts with key_prefix."""
+    with _db() as conn:
+        rows = conn.execute("SELECT key, attempt, provider, model, prompt, reply FROM calls"
+                            " WHERE key LIKE ? ORDER BY key, attempt", (key_prefix + "%",)).fetchall()
+    if len({r[0] for r in rows}) != 1:
+        raise ReplayMiss(f"{len({r[0] for r in rows})} recorded prompts match {key_prefix!r}")
+    key, _, provider, model, prompt, _ = rows[0]
+    return {"key": key, "provider": provider, "model": model,
+            "prompt": json.loads(zlib.decompress(prompt)),
+            "replies": [zlib.decompress(r[5]).decode("utf-8") for r in rows]}
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["show"] and len(sys.argv) == 3:
+        call = load(sys.argv[2])
+        print(f"{call['key']}  {call['provider']} / {call['model']}\n")
+        print(call["prompt"]["document"])
+        for n, reply in enumerate(call["replies"]):
+            print(f"\n--- reply (attempt {n}) ---\n{reply}")
+    elif sys.argv[1:] == ["list"]:
+        for e in entries():
+            print(f"{e['key'][:12]}  #{e['attempt']}  {e['provider']:9} {e['model']:26}"
+                  f" {e['latency_s']:6.2f}s  {e['usage'].get('output_tokens', 0):5} out tok"
+                  f"  {e['bytes']:7,} B")
+    else:
+        sys.exit("usage: python llm_archive.py list | show <hash prefix>")
@@ -0,0 +1,85 @@
+"""local_store.py – shared plumbing for the local SQLite stores
+-----------------------------------------------------------------
+* connect() – a WAL connection with the store's schema applied, closed on
+  exit (kpi_history, store_registry, llm_archive)
+* StampedIndex – an in‑memory view of one SQLite file that is rebuilt
+  only when the file (or its WAL) changes on disk, i.e. when another
+  process wrote to it. The owner applies its own writes in place inside
+  `with index.wrote():`, which re‑stamps the file afterwards so they
+  don't trigger a reload
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import ContextManager, Iterator, Optional, Tuple
+
+
+@contextmanager
+def connect(path: str, schema: str, synchronous: Optional[str] = None) -> Iterator[sqlite3.Connection]:
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")   # several processes may write at once
+        if synchronous:
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+        conn.executescript(schema)
+        yield conn
+    finally:
+        conn.close()
+
+
+def file_stamp(path: str) -> Tuple:
+    """(mtime, size) of the database and its WAL; None for a missing file."""
+    stamp = []
+    for name in (path, path + "-wal"):
+        try:
+            st = os.stat(name)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class StampedIndex:
+    """
+    Base for a file‑backed index. Subclasses implement path() and
+    load(conn) – conn is None when the file doesn't exist yet – and take
+    `lock` wherever they read state that load() or their writes replace.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self._stamp: Optional[Tuple] = None
+
+    def path(self) -> str:
+        raise NotImplementedError
+
+    def connect(self) -> ContextManager[sqlite3.Connection]:
+        raise NotImplementedError
+
+    def load(self, conn: Optional[sqlite3.Connection]) -> None:
+        raise NotImplementedError
+
+    def refresh(self) -> None:
+        """Reload when the file changed since the last load or own write."""
+        stamp = file_stamp(self.path())
+        if stamp == self._stamp:
+            return
+        with self.lock:
+            if stamp != self._stamp:
+                if stamp[0] is None:
+                    self.load(None)
+                else:
+                    with self.connect() as conn:
+                        self.load(conn)
+                self._stamp = stamp
+
+    @contextmanager
+    def wrote(self) -> Iterator[None]:
+        """Apply our own write in memory instead of reloading the file for it."""
+        with self.lock:
+            yield
+            self._stamp = file_stamp(self.path())
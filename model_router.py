@@ -0,0 +1,121 @@
+"""model_router.py – pick the model tier for each deck
+-----------------------------------------------------------------
+* score() rates a parsed deck 0 (trivial) – 1 (hard) from what parsing
+  already knows: slide types and classifier confidence, slide count,
+  KPI‑looking slides no rule recognised, and how much of every detected
+  channel the regex pass already filled
+* plan() sends easy decks to the provider's fast variant (providers.py
+  fast_variant) and everything else to the full model
+* check() validates a fast‑model result against the regex KPIs; any
+  problem means the deck is re‑asked on the full model (step‑up)
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict, List
+
+from providers import Provider, load_providers
+from slide_classifier import KPI_LABEL, SLIDE_SPLIT
+
+# complexity at or above this goes straight to the full model
+ROUTE_THRESHOLD = 0.3
+LOW_CONFIDENCE = 0.75     # classifier confidence treated as ambiguous
+LARGE_DECK = 40           # slides
+AGREE_TOLERANCE = 0.01    # relative difference allowed vs. the regex value
+
+_NOT_METRICS = ("has_bcdf", "bcdf_tactics")
+_PREFIXES = ("pmax_vla", "pmax", "social", "dv", "dg", "bcdf", "rsa")   # longest first
+
+# signal name → weight; every signal is 0–1 and the weights sum to 1
+_WEIGHTS = {
+    "unfilled": 0.45,        # share of channel metrics the regex pass missed
+    "low_confidence": 0.2,   # share of channel slides with a close‑call type
+    "repeated_channel": 0.15,
+    "unclassified_kpis": 0.1,
+    "size": 0.1,
+}
+
+
+def _prefix(key: str) -> str:
+    return next((p for p in _PREFIXES if key.startswith(p + "_")), "")
+
+
+def _regex_metrics(parsed: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in parsed.get("kpis", {}).items() if k not in _NOT_METRICS}
+
+
+def score(parsed: Dict[str, Any]) -> Dict[str, Any]:
+    """{"score": 0–1, "signals": {...}, "reasons": [...]} for a parse_deck result."""
+    types = parsed.get("slide_types", [])
+    stats = parsed.get("slide_stats", [])
+    channel = [t for t in types if t != "OTHER"]
+    metrics = _regex_metrics(parsed)
+
+    signals: Dict[str, float] = {}
+    reasons: List[str] = []
+
+    if not channel or not metrics:
+        signals["unfilled"] = 1.0
+        reasons.append("no recognised channel slides")
+    else:
+        filled = sum(1 for v in metrics.values() if v is not None)
+        signals["unfilled"] = 1 - filled / len(metrics)
+        if signals["unfilled"] > 0.25:
+            reasons.append(f"regex filled {filled}/{len(metrics)} channel metrics")
+
+    unsure = [s for s in stats if s.get("type") != "OTHER" and s.get("confidence", 1.0) < LOW_CONFIDENCE]
+    signals["low_confidence"] = len(unsure) / len(channel) if channel else 0.0
+    if unsure:
+        reasons.append("ambiguous slide type on slide " + ", ".join(str(s["slide"]) for s in unsure))
+
+    repeated = sorted({t for t in channel if channel.count(t) > 1})
+    signals["repeated_channel"] = 1.0 if repeated else 0.0
+    if repeated:
+        reasons.append("several slides of type " + ", ".join(repeated))
+
+    parts = SLIDE_SPLIT.split(parsed.get("text", ""))
+    other_kpis = sum(1 for stype, body in zip(parts[1::2], parts[2::2])
+                     if stype == "OTHER" and KPI_LABEL.search(body))
+    signals["unclassified_kpis"] = min(1.0, other_kpis / 2)
+    if other_kpis:
+        reasons.append(f"{other_kpis} unclassified slide(s) with KPI labels")
+
+    signals["size"] = min(1.0, len(types) / LARGE_DECK)
+    if len(types) >= LARGE_DECK:
+        reasons.append(f"{len(types)} slides")
+
+    total = sum(_WEIGHTS[name] * value for name, value in signals.items())
+    return {"score": round(total, 3), "signals": signals, "reasons": reasons}
+
+
+def plan(spec: Provider, parsed: Dict[str, Any]) -> Dict[str, Any]:
+    """Which registry provider should extract this deck, and why."""
+    rated = score(parsed)
+    registry = load_providers()
+    fast = registry.get(spec.fast_variant) if spec.fast_variant else None
+    use_fast = fast is not None and rated["score"] < ROUTE_THRESHOLD
+    chosen = fast if use_fast else spec
+    return {"provider": chosen.name, "model": chosen.model, "tier": "fast" if use_fast else "full",
+            "score": rated["score"], "reasons": rated["reasons"], "stepped_up": []}
+
+
+def check(kpis: Dict[str, Any], parsed: Dict[str, Any]) -> List[str]:
+    """Reasons to distrust a fast‑model result; empty when it looks right."""
+    problems = []
+    metrics = _regex_metrics(parsed)
+    for key, expected in metrics.items():
+        if expected is None:
+            continue
+        got = kpis.get(key)
+        if not isinstance(got, (int, float)):
+            problems.append(f"{key} missing (regex found {expected})")
+        elif abs(got - expected) > AGREE_TOLERANCE * max(abs(expected), 1):
+            problems.append(f"{key}={got} but regex found {expected}")
+    # every channel with a slide must show up in the result
+    found = {_prefix(k) for k in kpis if kpis[k] is not None}
+    for prefix in sorted({_prefix(k) for k in metrics} - found):
+        if prefix:
+            problems.append(f"no {prefix} metrics although the deck has that slide")
+    if not kpis.get("store_name"):
+        problems.append("store name missing")
+    return problems
@@ -0,0 +1,48 @@
+import streamlit as st
+
+import provider_metrics
+
+st.set_page_config(page_title="Provider Metrics", layout="wide")
+
+st.markdown("## Provider Metrics")
+st.caption("Every LLM request made by the app and the job-queue workers, per provider and model. "
+           f"Stored in `{provider_metrics.METRICS_FILE}`.")
+
+windows = {"Last 7 days": 7, "Last 30 days": 30, "All time": None}
+window = st.radio("Window", list(windows), index=1, horizontal=True)
+rows = provider_metrics.summary(windows[window])
+
+if not rows:
+    st.info("No requests recorded yet. Process some reports first.")
+else:
+    rates = ("retry_rate", "parse_failure_rate", "error_rate")
+    st.dataframe(
+        [{k: v * 100 if k in rates else v for k, v in r.items()} for r in rows],
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "p50_s": st.column_config.NumberColumn("p50 latency (s)", format="%.2f"),
+            "p95_s": st.column_config.NumberColumn("p95 latency (s)", format="%.2f"),
+            "p99_s": st.column_config.NumberColumn("p99 latency (s)", format="%.2f"),
+            "tokens_per_deck": st.column_config.NumberColumn("tokens / deck"),
+            "retry_rate": st.column_config.NumberColumn("retry rate", format="%.1f%%",
+                                                        help="HTTP attempts that were transport retries"),
+            "parse_failure_rate": st.column_config.NumberColumn("JSON-parse failures", format="%.1f%%"),
+            "error_rate": st.column_config.NumberColumn("errors", format="%.1f%%"),
+            "usd_per_deck": st.column_config.NumberColumn("$ / deck", format="$%.4f"),
+        },
+    )
+
+    # Fastest option among those that rarely fail
+    reliable = [r for r in rows if r["error_rate"] + r["parse_failure_rate"] < 0.05 and r["decks"] >= 10]
+    if reliable:
+        best = min(reliable, key=lambda r: r["p95_s"])
+        cheapest = min(reliable, key=lambda r: r["usd_per_deck"])
+        st.markdown(f"**Fastest reliable:** {best['provider']} / {best['model']} "
+                    f"(p95 {best['p95_s']:.1f}s, ${best['usd_per_deck']:.4f}/deck)  \n"
+                    f"**Cheapest reliable:** {cheapest['provider']} / {cheapest['model']} "
+                    f"(p95 {cheapest['p95_s']:.1f}s, ${cheapest['usd_per_deck']:.4f}/deck)")
+
+if st.button("Reset metrics"):
+    provider_metrics.reset()
+    st.rerun()
@@ -0,0 +1,311 @@
+"""pipeline.py – parse → LLM → render as overlapping stages
+-----------------------------------------------------------------
+* parse : pptx_extractor.parse_decks process pool (CPU‑bound); its
+          generator only submits the next deck when pulled, so a full
+          queue downstream stops new parsing instead of piling up decks
+* llm   : an asyncio loop in its own thread; each deck's extraction runs
+          in a worker thread (the provider SDKs block) with at most
+          llm_concurrency calls in flight
+* render: a small thread pool for the per‑deck post‑processing (email,
+          store resolution, history)
+* Stages are joined by bounded queues (parse_queue / render_queue
+  decks), so parsing deck N+1 overlaps the LLM call for deck N
+* run() yields (key, result) on the caller's thread in completion order –
+  Streamlit elements must be drawn from the script thread; a deck that
+  failed in any stage yields its exception instead. While it waits, run()
+  calls idle() on that thread every _POLL_S, so progress the other stages
+  leave in shared state (e.g. streamed characters) can be drawn
+* on_parsed(key) runs as soon as a deck is parsed, e.g. to delete its
+  spooled upload
+* stats(): per stage items, errors, busy seconds, utilisation (busy time
+  over wall time × workers), seconds blocked on a full downstream queue
+  and the deepest the stage's input queue got; CLI for tuning:
+      python pipeline.py DECKS_DIR [--provider mock] [--llm 4] [--queue 4]
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Tuple
+
+from pptx_extractor import parse_decks
+
+_DONE = object()
+_CRASH = object()
+_POLL_S = 0.1   # how often a blocked stage checks for cancellation
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    errors: int = 0
+    busy_s: float = 0.0
+    blocked_s: float = 0.0      # waiting on a full downstream queue
+    max_queue: int = 0          # deepest this stage's input queue got
+
+    def report(self, wall_s: float) -> Dict[str, Any]:
+        out = asdict(self)
+        out["busy_s"] = round(self.busy_s, 3)
+        out["blocked_s"] = round(self.blocked_s, 3)
+        out["utilization"] = round(self.busy_s / (wall_s * self.workers), 3) if wall_s else 0.0
+        return out
+
+
+class Pipeline:
+    """
+    extract(key, parsed) → extracted runs in the LLM stage; render(key,
+    parsed, extracted) → result in the render stage. sources maps keys to
+    deck paths (or bytes), as for parse_decks; on_parsed(key) is called
+    from the parse stage once a deck's source is no longer needed.
+    """
+
+    def __init__(self, extract: Callable[[Hashable, Dict[str, Any]], Any],
+                 render: Callable[[Hashable, Dict[str, Any], Any], Any],
+                 parse_workers: Optional[int] = None, llm_concurrency: int = 4, render_workers: int = 2,
+                 parse_queue: int = 4, render_queue: int = 4, max_open_mb: Optional[int] = None,
+                 on_parsed: Optional[Callable[[Hashable], None]] = None) -> None:
+        self.extract = extract
+        self.render = render
+        self.on_parsed = on_parsed
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.llm_concurrency = max(1, llm_concurrency)
+        self.render_workers = max(1, render_workers)
+        self.parse_queue = max(1, parse_queue)
+        self.render_queue = max(1, render_queue)
+        self.max_open_mb = max_open_mb
+        self._stats: Dict[str, StageStats] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._started = self._finished = 0.0
+
+    # ------------------------------------------------------------------ plumbing
+    def _put(self, q: queue.Queue, item: Any, stage: Optional[StageStats], watch: Optional[StageStats]) -> bool:
+        """Blocking put that gives up on cancellation; False when cancelled."""
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_S)
+                break
+            except queue.Full:
+                continue
+        with self._lock:
+            if stage is not None:
+                stage.blocked_s += time.perf_counter() - start
+            if watch is not None:
+                watch.max_queue = max(watch.max_queue, q.qsize())
+        return not self._stop.is_set()
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=_POLL_S)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _guard(self, body: Callable[[], None], out: queue.Queue) -> Callable[[], None]:
+        """Run a stage thread; a bug in the stage itself ends the run with that error."""
+        def run() -> None:
+            try:
+                body()
+            except BaseException as exc:   # surfaced to the caller by run()
+                out.put((_CRASH, exc))
+                self._stop.set()
+        return run
+
+    # ------------------------------------------------------------------ stages
+    def _parse_stage(self, sources: Dict[Hashable, Any], parsed_q: queue.Queue, out: queue.Queue) -> None:
+        stats = self._stats["parse"]
+        decks = parse_decks(sources, max_workers=self.parse_workers, max_open_mb=self.max_open_mb)
+        try:
+            for key, parsed in decks:
+                if self.on_parsed is not None:
+                    self.on_parsed(key)
+                with self._lock:
+                    stats.items += 1
+                    if isinstance(parsed, Exception):
+                        stats.errors += 1
+                    else:   # time the deck took inside its pool worker
+                        stats.busy_s += parsed.get("parse_s", 0.0)
+                if isinstance(parsed, Exception):
+                    out.put((key, parsed))
+                elif not self._put(parsed_q, (key, parsed), stats, self._stats["llm"]):
+                    return
+        finally:
+            decks.close()   # stops the pool once the running decks finish
+            self._put(parsed_q, _DONE, None, None)
+
+    def _llm_stage(self, parsed_q: queue.Queue, render_q: queue.Queue, out: queue.Queue) -> None:
+        stats = self._stats["llm"]
+
+        async def one(key: Hashable, parsed: Dict[str, Any], slots: asyncio.Semaphore) -> None:
+            start = time.perf_counter()
+            try:
+                try:
+                    extracted = await asyncio.to_thread(self.extract, key, parsed)
+                except Exception as exc:
+                    extracted = exc
+                with self._lock:
+                    stats.items += 1
+                    stats.busy_s += time.perf_counter() - start
+                    if isinstance(extracted, Exception):
+                        stats.errors += 1
+                if isinstance(extracted, Exception):
+                    out.put((key, extracted))
+                else:
+                    # the slot is held until rendering takes the deck, so a
+                    # backed‑up render stage stops new LLM calls (and parsing)
+                    await asyncio.to_thread(self._put, render_q, (key, parsed, extracted), stats,
+                                            self._stats["render"])
+            finally:
+                slots.release()
+
+        async def main() -> None:
+            slots = asyncio.Semaphore(self.llm_concurrency)
+            tasks = set()
+            while True:
+                await slots.acquire()   # take a deck only when a call slot is free
+                item = await asyncio.to_thread(self._get, parsed_q)
+                if item is _DONE:
+                    break
+                task = asyncio.ensure_future(one(*item, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+
+        try:
+            with ThreadPoolExecutor(self.llm_concurrency + 2, thread_name_prefix="llm") as io_pool:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(io_pool)
+                try:
+                    loop.run_until_complete(main())
+                finally:
+                    loop.close()
+        finally:
+            self._put(render_q, _DONE, None, None)
+
+    def _render_stage(self, render_q: queue.Queue, out: queue.Queue) -> None:
+        stats = self._stats["render"]
+        slots = threading.Semaphore(self.render_workers)
+
+        def one(key: Hashable, parsed: Dict[str, Any], extracted: Any) -> None:
+            start = time.perf_counter()
+            try:
+                result = self.render(key, parsed, extracted)
+            except Exception as exc:
+                result = exc
+            finally:
+                slots.release()
+            with self._lock:
+                stats.items += 1
+                stats.busy_s += time.perf_counter() - start
+                if isinstance(result, Exception):
+                    stats.errors += 1
+            out.put((key, result))
+
+        with ThreadPoolExecutor(self.render_workers, thread_name_prefix="render") as pool:
+            while True:
+                slots.acquire()
+                item = self._get(render_q)
+                if item is _DONE:
+                    break
+                pool.submit(one, *item)
+        out.put(_DONE)
+
+    # ------------------------------------------------------------------ public
+    def run(self, sources: Dict[Hashable, Any],
+            idle: Optional[Callable[[], None]] = None) -> Iterator[Tuple[Hashable, Any]]:
+        self._stop.clear()
+        self._stats = {
+            "parse": StageStats("parse", min(self.parse_workers, max(len(sources), 1))),
+            "llm": StageStats("llm", self.llm_concurrency),
+            "render": StageStats("render", self.render_workers),
+        }
+        if not sources:
+            return
+        parsed_q: queue.Queue = queue.Queue(self.parse_queue)
+        render_q: queue.Queue = queue.Queue(self.render_queue)
+        out: queue.Queue = queue.Queue()
+        threads = [
+            threading.Thread(target=self._guard(lambda: self._parse_stage(sources, parsed_q, out), out),
+                             name="pipeline-parse", daemon=True),
+            threading.Thread(target=self._guard(lambda: self._llm_stage(parsed_q, render_q, out), out),
+                             name="pipeline-llm", daemon=True),
+            threading.Thread(target=self._guard(lambda: self._render_stage(render_q, out), out),
+                             name="pipeline-render", daemon=True),
+        ]
+        self._started = time.perf_counter()
+        self._finished = 0.0
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                try:
+                    item = out.get(timeout=_POLL_S)
+                except queue.Empty:
+                    if idle is not None:
+                        idle()
+                    continue
+                if item is _DONE:
+                    break
+                if item[0] is _CRASH:
+                    raise item[1]
+                yield item
+        finally:
+            # caller stopped early (or a stage crashed): unblock every stage
+            self._stop.set()
+            self._finished = time.perf_counter()
+            for t in threads:
+                t.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per‑stage utilisation of the current / last run."""
+        wall = (self._finished or time.perf_counter()) - self._started if self._started else 0.0
+        with self._lock:
+            stages = {name: s.report(wall) for name, s in self._stats.items()}
+        return {"wall_s": round(wall, 3), "stages": stages}
+
+
+def format_stats(stats: Dict[str, Any]) -> str:
+    parts = [f"{name} {s['utilization']:.0%} busy ({s['workers']}×, {s['items']} decks, "
+             f"blocked {s['blocked_s']:.1f}s, queue ≤{s['max_queue']})"
+             for name, s in stats["stages"].items()]
+    return f"{stats['wall_s']:.1f}s – " + "; ".join(parts)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import providers
+    from email_generator import generate_email
+    from kpi_extractor import extract_kpis_with_ai
+
+    ap = argparse.ArgumentParser(description="Run decks through the pipeline and print stage utilisation")
+    ap.add_argument("decks")
+    ap.add_argument("--provider", default="mock")
+    ap.add_argument("--parse-workers", type=int, default=None)
+    ap.add_argument("--llm", type=int, default=None, help="concurrent LLM calls (default: provider limit)")
+    ap.add_argument("--render-workers", type=int, default=2)
+    ap.add_argument("--queue", type=int, default=4, help="depth of both inter‑stage queues")
+    args = ap.parse_args()
+
+    spec = providers.get_provider(args.provider)
+    key = providers.api_key(args.provider) or ""
+    paths = sorted(os.path.join(args.decks, f) for f in os.listdir(args.decks) if f.lower().endswith(".pptx"))
+    pipe = Pipeline(
+        lambda name, parsed: extract_kpis_with_ai(key, parsed["text"], args.provider, slide_kpis=parsed["kpis"]),
+        lambda name, parsed, kpis: generate_email(kpis, "Report"),
+        parse_workers=args.parse_workers, llm_concurrency=args.llm or spec.max_concurrency,
+        render_workers=args.render_workers, parse_queue=args.queue, render_queue=args.queue)
+    failed = sum(isinstance(result, Exception) for _, result in pipe.run({p: p for p in paths}))
+    print(f"{len(paths) - failed}/{len(paths)} decks")
+    print(format_stats(pipe.stats()))
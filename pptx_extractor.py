@@ -1,42 +1,70 @@
-import io, re
+import hashlib, io, json, os, re, shutil, tempfile, time, zipfile
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pptx import Presentation
 from pptx.enum.shapes import MSO_SHAPE_TYPE
 
+from slide_classifier import KPI_LABEL, default_classifier
+
 # ----------------------------------------------------------------------------
 # Helpers to pull raw text
 # ----------------------------------------------------------------------------
-def extract_text_from_shape(shape):
-    txt = ""
+# Rows kept when a table sits on a slide that isn't a KPI slide (keyword
+# tables can run to hundreds of rows and only bloat the prompt)
+TABLE_PREVIEW_ROWS = 3
+
+def _table_part(table):
+    """One walk of a table → (row lines, column count, is a label / value table)."""
+    cells = [[c.text.strip() for c in r.cells] for r in table.rows]
+    # label / value table ("Total Impressions | 12,345"): KPI labels in the first column
+    label = any(row and KPI_LABEL.search(row[0]) for row in cells[1:])
+    return [" | ".join(row) for row in cells], len(table.columns), label
+
+def _shape_parts(shape, parts):
+    """Append a shape's text blocks and tables (as _table_part tuples) to parts."""
     # plain textbox
     if hasattr(shape, "text") and shape.text.strip():
-        txt += shape.text.strip() + "\n"
+        parts.append(shape.text.strip() + "\n")
     # table cells
     if shape.has_table:
-        rows = []
-        for r in shape.table.rows:
-            rows.append(" | ".join(c.text.strip() for c in r.cells))
-        txt += "\n".join(rows) + "\n"
+        parts.append(_table_part(shape.table))
     # (optional) chart titles / series
     if shape.has_chart and shape.chart.chart_title:
-        txt += f"CHART: {shape.chart.chart_title.text_frame.text}\n"
+        parts.append(f"CHART: {shape.chart.chart_title.text_frame.text}\n")
     # grouped shapes
     if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
         for sub in shape.shapes:
-            txt += extract_text_from_shape(sub)
-    return txt
+            _shape_parts(sub, parts)
+    return parts
+
+def _render_parts(parts, table_rows=None):
+    """
+    Text of walked parts. table_rows=None keeps every table row; a number
+    keeps only a preview, except of untyped KPI tables (e.g. Google Search)
+    whose every figure is kept.
+    """
+    out = []
+    for part in parts:
+        if isinstance(part, str):
+            out.append(part)
+            continue
+        rows, cols, label = part
+        if table_rows is not None and len(rows) > table_rows and not label:
+            rows = rows[:table_rows] + [
+                f"[TABLE: {len(rows)} rows x {cols} cols, {len(rows) - table_rows} rows omitted]"]
+        out.append("\n".join(rows) + "\n")
+    return "".join(out)
+
+def extract_text_from_shape(shape, table_rows=None):
+    """table_rows=None keeps every table row; a number keeps only a preview."""
+    return _render_parts(_shape_parts(shape, []), table_rows)
 
 # ----------------------------------------------------------------------------
 # Slide classification
 # ----------------------------------------------------------------------------
 def identify_slide_type(text):
-    t = text.upper()
-    if "PERFORMANCEMAX W/ VLA" in t:            return "PMAX_VLA"
-    if "PERFORMANCEMAX" in t:                  return "PMAX"
-    if "SOCIAL ADS" in t:                      return "SOCIAL"
-    if "DEMAND GEN" in t:                      return "DEMAND_GEN"
-    if "VIDEO" in t and "DISPLAY" in t:        return "VIDEO"
-    if "BCDF" in t or "BUSINESS CENTER DIRECTED FUNDS" in t: return "BCDF"
-    return "OTHER"
+    """Slide type from the priority rules in slide_rules.json (single pass)."""
+    return default_classifier().classify(text)
 
 # ----------------------------------------------------------------------------
 # Simple regex extract helpers
@@ -63,60 +91,291 @@ def parse_percent(text, label):
 # ----------------------------------------------------------------------------
 # Main PPTX extractor
 # ----------------------------------------------------------------------------
-def extract_text_from_pptx(file_obj):
-    prs = Presentation(io.BytesIO(file_obj.getvalue()))
+# Binary parts that carry no text; python-pptx would read them all into memory
+_SKIP_PARTS = ("ppt/media/", "ppt/embeddings/", "ppt/printerSettings/", "docProps/thumbnail")
+
+def _slim_package(path):
+    """
+    Re‑pack a deck on disk into a small in‑memory zip holding only its XML
+    parts (images / embedded workbooks become empty stubs). Members are read
+    on demand from the file, so a 40 MB photo‑heavy deck never sits in RAM.
+    """
+    buf = io.BytesIO()
+    with zipfile.ZipFile(path) as zin, zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zout:
+        for info in zin.infolist():
+            data = b"" if info.filename.startswith(_SKIP_PARTS) else zin.read(info)
+            zout.writestr(info.filename, data)
+    buf.seek(0)
+    return buf
+
+def _open_presentation(src):
+    """src may be a path, raw bytes, or an uploaded file object."""
+    if isinstance(src, (bytes, bytearray)):
+        return Presentation(io.BytesIO(src))
+    if isinstance(src, (str, os.PathLike)):
+        return Presentation(_slim_package(src))
+    src.seek(0)
+    return Presentation(src)
+
+def spool_upload(file_obj, directory):
+    """Copy an upload to a temp file in chunks (no full in‑memory copy)."""
+    fd, path = tempfile.mkstemp(suffix=".pptx", dir=directory)
+    file_obj.seek(0)
+    with os.fdopen(fd, "wb") as out:
+        shutil.copyfileobj(file_obj, out, 1 << 20)
+    return path
+
+# ----------------------------------------------------------------------------
+# Parsed‑deck cache (SHA‑256 of the file + extractor version)
+# ----------------------------------------------------------------------------
+# Bump whenever parsing output changes, so stale entries are ignored rather
+# than served.
+EXTRACTOR_VERSION = "5"
+CACHE_DIR = os.environ.get("DECK_CACHE_DIR", ".deck_cache")
+
+def deck_digest(src):
+    """SHA‑256 of the deck bytes, read in chunks for paths / file objects."""
+    h = hashlib.sha256()
+    if isinstance(src, (bytes, bytearray)):
+        h.update(src)
+        return h.hexdigest()
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+    src.seek(0)
+    for block in iter(lambda: src.read(1 << 20), b""):
+        h.update(block)
+    src.seek(0)
+    return h.hexdigest()
+
+def _cache_path(digest, cache_dir):
+    # the rules fingerprint keeps edits to slide_rules.json from serving stale types
+    rules = default_classifier().fingerprint
+    return os.path.join(cache_dir, f"{digest}-v{EXTRACTOR_VERSION}-{rules}.json")
+
+def _cache_get(digest, cache_dir):
+    try:
+        with open(_cache_path(digest, cache_dir), encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def _cache_put(digest, parsed, cache_dir):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(parsed, fh)
+        os.replace(tmp, _cache_path(digest, cache_dir))   # atomic across workers
+    except OSError as e:
+        print(f"Deck cache write failed: {e}")
+
+def parse_deck(src, cache_dir=CACHE_DIR):
+    """
+    Parse one deck → {"text", "kpis", "slide_types", "slide_stats",
+    "properties", "sha256", "parse_s"} (plain, picklable data). Results are cached on disk by file hash; pass
+    cache_dir=None to bypass the cache.
+    """
+    start = time.perf_counter()
+    digest = deck_digest(src)
+    if cache_dir:
+        cached = _cache_get(digest, cache_dir)
+        if cached is not None:
+            cached["parse_s"] = time.perf_counter() - start
+            return cached
+
+    parsed = _parse_uncached(src)
+    parsed["sha256"] = digest
+    if cache_dir:
+        _cache_put(digest, parsed, cache_dir)
+    parsed["parse_s"] = time.perf_counter() - start   # this call's cost; not cached
+    return parsed
+
+def channel_kpis(stype, raw):
+    """Regex KPIs for one slide of the given type (empty for OTHER)."""
+    kpis = {}
+    if stype == "PMAX_VLA":
+        kpis["pmax_vla_impr"] = parse_int(raw,  "Impressions")
+        kpis["pmax_vla_clicks"] = parse_int(raw,"Clicks")
+        kpis["pmax_vla_cpc"] = parse_money(raw,"CPC")
+        kpis["pmax_vla_conv"] = parse_int(raw, "Conversions")
+        kpis["pmax_vla_cost_conv"] = parse_money(raw,"Cost / Conversion")
+
+    elif stype == "PMAX":
+        kpis["pmax_impr"] = parse_int(raw,  "Impressions")
+        kpis["pmax_clicks"] = parse_int(raw,"Clicks")
+        kpis["pmax_cpc"] = parse_money(raw,"CPC")
+        kpis["pmax_conv"] = parse_int(raw, "Conversions")
+        kpis["pmax_cost_conv"] = parse_money(raw,"Cost / Conversion")
+
+    elif stype == "SOCIAL":
+        kpis["social_reach"]  = parse_int(raw,  "Reach")
+        kpis["social_impr"]   = parse_int(raw,  "Impressions")
+        kpis["social_clicks"] = parse_int(raw,  "Clicks")
+        kpis["social_cpc"]    = parse_money(raw,"CPC")
+        kpis["social_vdp"]    = parse_int(raw,  "VDP Views")
+
+    elif stype == "VIDEO":
+        kpis["dv_views"]     = parse_int(raw,  "Views")
+        kpis["dv_viewrate"]  = parse_percent(raw,"View Rate")
+        kpis["dv_cpc"]       = parse_money(raw,"CPC")
+        kpis["dv_cpm"]       = parse_money(raw,"CPM")
+
+    elif stype == "DEMAND_GEN":        # <<< NEW block
+        kpis["dg_impr"]   = parse_int  (raw, "Impressions")
+        kpis["dg_clicks"] = parse_int  (raw, "Clicks")
+        kpis["dg_cpm"]    = parse_money(raw, "CPM")
+        kpis["dg_conv"]   = parse_int  (raw, "Conversions")
+
+    elif stype == "BCDF":
+        kpis["has_bcdf"] = True
+        kpis["bcdf_tactics"] = _grab(r"^(.+?)$", raw.splitlines()[0], str) or ""
+        kpis["bcdf_impr"]   = parse_int  (raw, "Impressions")
+        kpis["bcdf_clicks"] = parse_int  (raw, "Clicks")
+        kpis["bcdf_cpc"]    = parse_money(raw, "CPC")
+        kpis["bcdf_vdp"]    = parse_int  (raw, "VDP Views")
+        kpis["bcdf_conv"]   = parse_int  (raw, "Conversions")
+    return kpis
+
+def _scan_slide(slide):
+    """
+    Walk a slide once and classify its full text. Tables on slides that
+    turn out not to be KPI slides are cut to a preview, rendered from the
+    same walk. Returns (slide type, text, cost stats).
+    """
+    start = time.perf_counter()
+    classifier = default_classifier()
+    parts = []
+    for shape in slide.shapes:
+        _shape_parts(shape, parts)
+    raw = _render_parts(parts)
+    stype, confidence = classifier.score(raw)
+    summarized = stype == classifier.default
+    if summarized:
+        raw = _render_parts(parts, TABLE_PREVIEW_ROWS)
+    stats = {
+        "type": stype,
+        "confidence": confidence,
+        "ms": round((time.perf_counter() - start) * 1000, 2),
+        "shapes": len(slide.shapes),
+        "chars": len(raw),
+        "summarized": summarized,
+    }
+    return stype, raw, stats
+
+def _parse_uncached(src):
+    prs = _open_presentation(src)
     structured = []
+    slide_types = []
+    slide_stats = []
 
     kpis = {}  # dict we'll fill slide‑by‑slide
 
     for idx, slide in enumerate(prs.slides, 1):
-        raw = "".join(extract_text_from_shape(s) for s in slide.shapes)
-        stype = identify_slide_type(raw)
+        stype, raw, stats = _scan_slide(slide)
+        slide_types.append(stype)
+        slide_stats.append({"slide": idx, **stats})
 
         # ---------- Channel‑specific parsing ----------
-        if stype == "PMAX_VLA":
-            kpis["pmax_vla_impr"] = parse_int(raw,  "Impressions")
-            kpis["pmax_vla_clicks"] = parse_int(raw,"Clicks")
-            kpis["pmax_vla_cpc"] = parse_money(raw,"CPC")
-            kpis["pmax_vla_conv"] = parse_int(raw, "Conversions")
-            kpis["pmax_vla_cost_conv"] = parse_money(raw,"Cost / Conversion")
-
-        elif stype == "PMAX":
-            kpis["pmax_impr"] = parse_int(raw,  "Impressions")
-            kpis["pmax_clicks"] = parse_int(raw,"Clicks")
-            kpis["pmax_cpc"] = parse_money(raw,"CPC")
-            kpis["pmax_conv"] = parse_int(raw, "Conversions")
-            kpis["pmax_cost_conv"] = parse_money(raw,"Cost / Conversion")
-
-        elif stype == "SOCIAL":
-            kpis["social_reach"]  = parse_int(raw,  "Reach")
-            kpis["social_impr"]   = parse_int(raw,  "Impressions")
-            kpis["social_clicks"] = parse_int(raw,  "Clicks")
-            kpis["social_cpc"]    = parse_money(raw,"CPC")
-            kpis["social_vdp"]    = parse_int(raw,  "VDP Views")
-
-        elif stype == "VIDEO":
-            kpis["dv_views"]     = parse_int(raw,  "Views")
-            kpis["dv_viewrate"]  = parse_percent(raw,"View Rate")
-            kpis["dv_cpc"]       = parse_money(raw,"CPC")
-            kpis["dv_cpm"]       = parse_money(raw,"CPM")
-
-        elif stype == "DEMAND_GEN":        # <<< NEW block
-            kpis["dg_impr"]   = parse_int  (raw, "Impressions")
-            kpis["dg_clicks"] = parse_int  (raw, "Clicks")
-            kpis["dg_cpm"]    = parse_money(raw, "CPM")
-            kpis["dg_conv"]   = parse_int  (raw, "Conversions")
-
-        elif stype == "BCDF":
-            kpis["has_bcdf"] = True
-            kpis["bcdf_tactics"] = _grab(r"^(.+?)$", raw.splitlines()[0], str) or ""
-            kpis["bcdf_impr"]   = parse_int  (raw, "Impressions")
-            kpis["bcdf_clicks"] = parse_int  (raw, "Clicks")
-            kpis["bcdf_cpc"]    = parse_money(raw, "CPC")
-            kpis["bcdf_vdp"]    = parse_int  (raw, "VDP Views")
-            kpis["bcdf_conv"]   = parse_int  (raw, "Conversions")
+        kpis.update(channel_kpis(stype, raw))
 
         # ---------- Write structured dump (for AI path) ----------
         structured.append(f"--- SLIDE {idx} | TYPE: {stype} ---\n{raw}\n" + "-"*80)
 
-    return "\n\n".join(structured), kpis
+    # core properties that may name the store / period (see deck_metadata.py)
+    core = prs.core_properties
+    properties = {"title": core.title or "", "subject": core.subject or ""}
+
+    return {"text": "\n\n".join(structured), "kpis": kpis,
+            "slide_types": slide_types, "slide_stats": slide_stats, "properties": properties}
+
+_SLIDE_HEADER = re.compile(r"^--- SLIDE \d+ \|", re.M)
+
+def document_digest(text):
+    """
+    Hash of the structured text with slide numbers, separators, case and
+    whitespace normalized away, so re‑uploads and trivially regenerated
+    copies of a deck hash the same.
+    """
+    norm = _SLIDE_HEADER.sub("--- SLIDE |", text)
+    norm = re.sub(r"-{10,}", " ", norm)
+    norm = " ".join(norm.split()).casefold()
+    return hashlib.sha256(norm.encode("utf-8")).hexdigest()
+
+def extract_text_from_pptx(file_obj):
+    parsed = parse_deck(file_obj)
+    return parsed["text"], parsed["kpis"]
+
+# ----------------------------------------------------------------------------
+# Batch parsing across processes
+# ----------------------------------------------------------------------------
+def _source_size(src):
+    if isinstance(src, (bytes, bytearray)):
+        return len(src)
+    return os.path.getsize(src)
+
+def parse_decks(sources, max_workers=None, max_open_mb=None):
+    """
+    Parse many decks in a process pool (python‑pptx is CPU‑bound and holds the
+    GIL). `sources` maps a name to a path (preferred – nothing large is
+    pickled) or raw bytes; yields (name, parsed) as each deck finishes, where
+    parsed is parse_deck()'s dict or the exception raised for that deck.
+    Callers can start on the first decks (e.g. LLM calls) while later ones
+    are still parsing.
+
+    max_open_mb caps the combined file size of decks being parsed at once;
+    one deck is always allowed so an oversized file still goes through.
+    """
+    pending = list(dict(sources).items())
+    if not pending:
+        return
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(pending)))
+    ceiling = max_open_mb * 1024 * 1024 if max_open_mb else None
+    # spawn: the Streamlit process is multi‑threaded, fork is not safe there
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        running = {}   # future → (name, size)
+        open_bytes = 0
+        while pending or running:
+            while pending and len(running) < workers:
+                size = _source_size(pending[0][1])
+                if ceiling and running and open_bytes + size > ceiling:
+                    break
+                name, src = pending.pop(0)
+                running[pool.submit(parse_deck, src)] = (name, size)
+                open_bytes += size
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name, size = running.pop(fut)
+                open_bytes -= size
+                try:
+                    yield name, fut.result()
+                except Exception as e:
+                    yield name, e
+
+if __name__ == "__main__":
+    # Throughput check: python pptx_extractor.py <folder of decks> [workers] [max_open_mb]
+    import sys
+    folder = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    max_open_mb = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    decks = {p: p for p in sorted(
+        os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".pptx"))}
+    start = time.perf_counter()
+    failed = 0
+    costs = []
+    for name, parsed in parse_decks(decks, workers, max_open_mb):
+        if isinstance(parsed, Exception):
+            failed += 1
+            print(f"FAILED {name}: {parsed}")
+        else:
+            costs.extend((s["ms"], os.path.basename(name), s) for s in parsed.get("slide_stats", []))
+    elapsed = time.perf_counter() - start
+    print(f"Parsed {len(decks) - failed}/{len(decks)} decks in {elapsed:.1f}s "
+          f"({len(decks) / max(elapsed, 1e-9):.1f} decks/s, workers={workers or os.cpu_count()})")
+    print("Costliest slides:")
+    for ms, deck, s in sorted(costs, key=lambda c: c[0], reverse=True)[:10]:
+        print(f"  {ms:8.1f} ms  {deck} slide {s['slide']} ({s['type']}, {s['shapes']} shapes, "
+              f"{s['chars']:,} chars{', table summarized' if s['summarized'] else ''})")
@@ -0,0 +1,139 @@
+"""provider_metrics.py – running cost / latency statistics per provider & model
+-----------------------------------------------------------------
+* One row per LLM request (a single deck, or a pack of decks) in a local
+  SQLite file shared by the app and every job‑queue worker
+* summary() aggregates per provider / model: p50 / p95 / p99 latency,
+  tokens per deck, retry rate (transport retries per HTTP attempt),
+  JSON‑parse failure rate, error rate and dollars per deck (prices from
+  providers.py)
+* Shown on the "Provider Metrics" page of the app; CLI:
+      python provider_metrics.py [days]
+* Disable with LLM_METRICS=off; replayed calls are never recorded
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+METRICS_FILE = os.environ.get("LLM_METRICS_FILE", "llm_metrics.sqlite3")
+ENABLED = os.environ.get("LLM_METRICS", "on") != "off"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts              REAL NOT NULL,
+    provider        TEXT NOT NULL,
+    model           TEXT NOT NULL,
+    decks           INTEGER NOT NULL,   -- >1 for packed requests
+    latency_s       REAL NOT NULL,      -- wall time incl. re‑asks
+    calls           INTEGER NOT NULL,   -- provider calls made (1 + re‑asks)
+    retries         INTEGER NOT NULL DEFAULT 0,   -- transport retries within those calls
+    parse_failures  INTEGER NOT NULL,   -- replies that held no parseable JSON
+    input_tokens    INTEGER NOT NULL,
+    output_tokens   INTEGER NOT NULL,
+    cache_tokens    INTEGER NOT NULL,   -- cache reads + writes
+    cost_usd        REAL NOT NULL,
+    error           TEXT
+);
+CREATE INDEX IF NOT EXISTS requests_ts ON requests(ts);
+"""
+
+
+@contextmanager
+def _db() -> Iterator[sqlite3.Connection]:
+    conn = sqlite3.connect(METRICS_FILE, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        if "retries" not in {row[1] for row in conn.execute("PRAGMA table_info(requests)")}:
+            # files written before transport retries were counted
+            conn.execute("ALTER TABLE requests ADD COLUMN retries INTEGER NOT NULL DEFAULT 0")
+        yield conn
+    finally:
+        conn.close()
+
+
+def record_request(provider: str, model: str, decks: int, latency_s: float, calls: int,
+                   parse_failures: int, usage: Dict[str, int], cost_usd: float,
+                   error: Optional[str] = None, retries: int = 0) -> None:
+    if not ENABLED:
+        return
+    try:
+        with _db() as conn, conn:
+            conn.execute(
+                "INSERT INTO requests (ts, provider, model, decks, latency_s, calls, retries, parse_failures,"
+                " input_tokens, output_tokens, cache_tokens, cost_usd, error)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), provider, model, decks, latency_s, calls, retries, parse_failures,
+                 usage.get("input_tokens", 0), usage.get("output_tokens", 0),
+                 usage.get("cache_read_tokens", 0) + usage.get("cache_write_tokens", 0),
+                 cost_usd, error))
+    except sqlite3.Error as e:
+        # metrics must never fail an extraction
+        print(f"Metrics write failed: {e}")
+
+
+# ---------------------------------------------------------------------------
+#  AGGREGATION
+# ---------------------------------------------------------------------------
+
+def _percentile(sorted_vals: List[float], pct: float) -> float:
+    """Nearest‑rank percentile of an ascending list."""
+    if not sorted_vals:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_vals)))
+    return sorted_vals[rank - 1]
+
+
+def summary(days: Optional[float] = None) -> List[Dict[str, Any]]:
+    """One dict per (provider, model), busiest first; days limits the window."""
+    since = time.time() - days * 86400 if days else 0.0
+    with _db() as conn:
+        rows = conn.execute(
+            "SELECT provider, model, decks, latency_s, calls, parse_failures,"
+            " input_tokens + output_tokens + cache_tokens, cost_usd, error, retries"
+            " FROM requests WHERE ts >= ?", (since,)).fetchall()
+
+    groups: Dict[tuple, List[tuple]] = {}
+    for row in rows:
+        groups.setdefault((row[0], row[1]), []).append(row[2:])
+
+    out = []
+    for (provider, model), reqs in groups.items():
+        latencies = sorted(r[1] for r in reqs)
+        decks = sum(r[0] for r in reqs) or 1
+        calls = sum(r[2] for r in reqs) or 1
+        retries = sum(r[7] for r in reqs)
+        out.append({
+            "provider": provider,
+            "model": model,
+            "requests": len(reqs),
+            "decks": sum(r[0] for r in reqs),
+            "p50_s": round(_percentile(latencies, 50), 2),
+            "p95_s": round(_percentile(latencies, 95), 2),
+            "p99_s": round(_percentile(latencies, 99), 2),
+            "tokens_per_deck": round(sum(r[4] for r in reqs) / decks),
+            "retry_rate": round(retries / (calls + retries), 3),   # per HTTP attempt
+            "parse_failure_rate": round(sum(r[3] for r in reqs) / calls, 3),
+            "error_rate": round(sum(1 for r in reqs if r[6]) / len(reqs), 3),
+            "usd_per_deck": round(sum(r[5] for r in reqs) / decks, 4),
+        })
+    out.sort(key=lambda s: -s["decks"])
+    return out
+
+
+def reset() -> None:
+    with _db() as conn, conn:
+        conn.execute("DELETE FROM requests")
+
+
+if __name__ == "__main__":
+    import sys
+    days = float(sys.argv[1]) if sys.argv[1:] else None
+    print(json.dumps(summary(days), indent=2))
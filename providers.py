@@ -0,0 +1,192 @@
+"""providers.py – LLM provider registry
+-----------------------------------------------------------------
+* One entry per provider: adapter family, model id, API key source,
+  request limits, pricing, concurrency and retry policy
+* Built‑ins: Claude, OpenAI, DeepSeek (Claude / OpenAI with a fast, cheap
+  variant for simple decks – see model_router.py), plus two offline providers –
+    local : any OpenAI‑compatible server on localhost (llama.cpp, vLLM,
+            Ollama, LM Studio …); no API key needed
+    mock  : deterministic, answers with the regex slide KPIs of the deck
+            text itself – no network, same input → same output
+* parser_config.ini [PROVIDER <name>] sections override any field of a
+  built‑in or define a new provider of an existing adapter family, so a
+  new provider needs no change to the dispatch code
+* api_key() is the one key lookup shared by the app and the job queue
+"""
+
+from __future__ import annotations
+
+import configparser
+import dataclasses
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional
+
+CONFIG_FILE = "parser_config.ini"
+SECTION_PREFIX = "PROVIDER "
+
+# Adapter families implemented in kpi_extractor
+APIS = ("anthropic", "openai", "openai_compat", "mock")
+
+
+@dataclass(frozen=True)
+class Provider:
+    name: str
+    label: str
+    api: str                        # adapter family, one of APIS
+    model: str
+    base_url: str = ""              # openai_compat only
+    key_env: str = ""               # env var holding the key; "" = no key needed
+    key_name: str = ""              # [API_KEYS] entry to use when it isn't `name`
+    listed: bool = True             # offered in the app's provider picker
+    fast_variant: str = ""          # registry entry simple decks are routed to
+    # limits
+    max_input_chars: int = 0        # longer decks are truncated; 0 = no limit
+    max_output_tokens: int = 4000
+    timeout_s: float = 60.0
+    json_mode: bool = True          # openai_compat: request response_format json_object
+    # concurrency (default job‑queue limit) and retry policy
+    max_concurrency: int = 4
+    retries: int = 2                # transport / HTTP errors
+    backoff_s: float = 2.0          # linear back‑off between transport retries
+    parse_retries: int = 1          # re‑asks after an unparseable reply
+    # USD per million tokens
+    price_input: float = 0.0
+    price_output: float = 0.0
+    price_cache_read: float = 0.0
+    price_cache_write: float = 0.0
+    # shortest prefix (tokens) the provider will cache; shorter cache_control
+    # prefixes are silently sent uncached
+    min_cache_tokens: int = 0
+    # mock only: sleep this long per call to imitate a remote model
+    simulated_latency_s: float = 0.0
+
+    @property
+    def needs_key(self) -> bool:
+        return bool(self.key_env)
+
+    @property
+    def local(self) -> bool:
+        return self.api == "mock" or self.base_url.startswith(("http://localhost", "http://127.0.0.1"))
+
+
+BUILTIN_PROVIDERS: Dict[str, Provider] = {p.name: p for p in (
+    Provider("claude", "Claude", "anthropic", "claude-3-opus-20240229",
+             key_env="CLAUDE_API_KEY", max_concurrency=2, fast_variant="claude_fast",
+             price_input=15.0, price_output=75.0, price_cache_read=1.5, price_cache_write=18.75,
+             min_cache_tokens=1024),
+    Provider("claude_fast", "Claude (fast)", "anthropic", "claude-3-haiku-20240307",
+             key_env="CLAUDE_API_KEY", key_name="claude", listed=False, max_concurrency=4,
+             price_input=0.25, price_output=1.25, price_cache_read=0.03, price_cache_write=0.30,
+             # the ~1.8 k token tool + system prefix is under Haiku's minimum: no caching
+             min_cache_tokens=2048),
+    Provider("openai", "OpenAI", "openai", "gpt-4-turbo",
+             key_env="OPENAI_API_KEY", fast_variant="openai_fast",
+             price_input=10.0, price_output=30.0, price_cache_read=10.0),
+    Provider("openai_fast", "OpenAI (fast)", "openai", "gpt-4o-mini",
+             key_env="OPENAI_API_KEY", key_name="openai", listed=False, max_concurrency=8,
+             price_input=0.15, price_output=0.60, price_cache_read=0.075),
+    Provider("deepseek", "DeepSeek", "openai_compat", "deepseek-chat",
+             base_url="https://api.deepseek.com/v1", key_env="DEEPSEEK_API_KEY",
+             max_input_chars=50_000,   # ~60 k token context
+             price_input=0.27, price_output=1.10, price_cache_read=0.07),
+    Provider("local", "Local server", "openai_compat", "local-model",
+             base_url="http://localhost:8080/v1", listed=False,
+             max_concurrency=1, timeout_s=300.0, retries=0),
+    Provider("mock", "Mock (offline)", "mock", "regex-slide-kpis",
+             listed=False, max_concurrency=16, retries=0, parse_retries=0),
+)}
+
+
+# ---------------------------------------------------------------------------
+#  REGISTRY
+# ---------------------------------------------------------------------------
+
+def _read_config(config_file: str) -> configparser.ConfigParser:
+    parser = configparser.ConfigParser()
+    if os.path.exists(config_file):
+        parser.read(config_file)
+    return parser
+
+
+def _override(base: Provider, section: configparser.SectionProxy) -> Provider:
+    changes: Dict[str, Any] = {}
+    for field in dataclasses.fields(Provider):
+        if field.name == "name" or field.name not in section:
+            continue
+        current = getattr(base, field.name)
+        if isinstance(current, bool):
+            changes[field.name] = section.getboolean(field.name)
+        elif isinstance(current, (int, float)):
+            changes[field.name] = type(current)(section[field.name])
+        else:
+            changes[field.name] = section[field.name]
+    unknown = set(section) - {f.name for f in dataclasses.fields(Provider)} - set(section.parser.defaults())
+    if unknown:
+        raise ValueError(f"[{section.name}]: unknown provider setting(s) {', '.join(sorted(unknown))}")
+    return dataclasses.replace(base, **changes)
+
+
+def load_providers(config_file: str = CONFIG_FILE) -> Dict[str, Provider]:
+    """Built‑ins merged with the [PROVIDER <name>] sections of the ini file."""
+    registry = dict(BUILTIN_PROVIDERS)
+    parser = _read_config(config_file)
+    for section in parser.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name = section[len(SECTION_PREFIX):].strip()
+        base = registry.get(name)
+        if base is None:
+            sec = parser[section]
+            if "api" not in sec or "model" not in sec:
+                raise ValueError(f"[{section}]: a new provider needs at least 'api' and 'model'")
+            base = Provider(name, name, sec["api"], sec["model"])
+        provider = _override(base, parser[section])
+        if provider.api not in APIS:
+            raise ValueError(f"[{section}]: api must be one of {', '.join(APIS)}")
+        registry[name] = provider
+    return registry
+
+
+def get_provider(name: str, config_file: str = CONFIG_FILE) -> Provider:
+    try:
+        return load_providers(config_file)[name]
+    except KeyError:
+        raise ValueError(f"Unsupported AI provider: {name}") from None
+
+
+def api_key(name: str, secrets: Optional[Mapping[str, str]] = None,
+            config_file: str = CONFIG_FILE) -> Optional[str]:
+    """
+    Key for one provider: Streamlit secrets [API_KEYS] (when given), then the
+    provider's env var, then parser_config.ini [API_KEYS]. Providers that
+    need no key get "".
+    """
+    provider = get_provider(name, config_file)
+    if not provider.needs_key:
+        return ""
+    entry = provider.key_name or name
+    key = (secrets or {}).get(entry) or os.environ.get(provider.key_env)
+    if not key:
+        key = _read_config(config_file).get("API_KEYS", entry, fallback=None)
+    return key or None
+
+
+def cost_usd(provider: Provider, usage: Mapping[str, int]) -> float:
+    """Dollar cost of a token usage total (see kpi_extractor.USAGE_KEYS)."""
+    cache_read = usage.get("cache_read_tokens", 0)
+    cache_write = usage.get("cache_write_tokens", 0)
+    # input_tokens counts cache reads for OpenAI‑style APIs; Anthropic reports them apart
+    uncached = usage.get("input_tokens", 0)
+    if provider.api != "anthropic":
+        uncached -= cache_read
+    return (uncached * provider.price_input
+            + usage.get("output_tokens", 0) * provider.price_output
+            + cache_read * provider.price_cache_read
+            + cache_write * provider.price_cache_write) / 1_000_000
+
+
+if __name__ == "__main__":
+    for p in load_providers().values():
+        print(f"{p.name:12} {p.api:14} {p.model:28} concurrency={p.max_concurrency}"
+              f" key={p.key_env or '-'}{' (local)' if p.local else ''}")
@@ -0,0 +1,181 @@
+"""slide_classifier.py – data‑driven slide type detection
+-----------------------------------------------------------------
+* Rules live in slide_rules.json (type, priority, phrase groups)
+* Every phrase of every rule is compiled into ONE Aho‑Corasick automaton,
+  so a slide is classified in a single pass over its text no matter how
+  many rules / OEM programs are configured
+* Highest‑priority matching rule wins; confidence reflects how clear‑cut
+  the win was
+* explain() shows which phrases matched and which rules competed
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+from collections import deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+RULES_FILE = os.environ.get(
+    "SLIDE_RULES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "slide_rules.json"))
+
+# The slide header pptx_extractor.parse_deck writes before every slide's text;
+# split() gives [preamble, type1, body1, type2, body2, ...]
+SLIDE_SPLIT = re.compile(r"^--- SLIDE \d+ \| TYPE: (\w+) ---$", re.M)
+# Metric labels that mark KPI figures on slides no rule recognises (Google
+# Search / RSA has no slide type of its own)
+KPI_LABEL = re.compile(r"IMPRESSIONS|CLICKS|CPC|CPM|CONVERSIONS|REACH|VIEWS", re.I)
+
+
+# ---------------------------------------------------------------------------
+#  AHO‑CORASICK AUTOMATON
+# ---------------------------------------------------------------------------
+
+class _Automaton:
+    """Multi‑pattern substring matcher (patterns are matched as given)."""
+
+    def __init__(self, patterns: List[str]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for pid, pat in enumerate(patterns):
+            state = 0
+            for ch in pat:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(pid)
+
+        # breadth‑first failure links
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def scan(self, text: str, positions: bool = False) -> Dict[int, List[int]]:
+        """Pattern id → end offsets (only the first offset unless positions=True)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found: Dict[int, List[int]] = {}
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for pid in out[state]:
+                if pid not in found:
+                    found[pid] = [i + 1]
+                elif positions:
+                    found[pid].append(i + 1)
+        return found
+
+
+# ---------------------------------------------------------------------------
+#  CLASSIFIER
+# ---------------------------------------------------------------------------
+
+class SlideClassifier:
+    def __init__(self, rules: List[Dict[str, Any]], default: str = "OTHER") -> None:
+        self.default = default
+        self.rules: List[Tuple[str, int, List[List[int]]]] = []
+        phrases: Dict[str, int] = {}
+        for rule in rules:
+            try:
+                stype, priority, groups = rule["type"], int(rule["priority"]), rule["match"]
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid slide rule {rule!r}: {e}") from e
+            if not groups or not all(groups):
+                raise ValueError(f"Slide rule {stype!r} needs at least one non‑empty phrase group")
+            ids = [[phrases.setdefault(p.upper(), len(phrases)) for p in group] for group in groups]
+            self.rules.append((stype, priority, ids))
+        # highest priority first; stable for equal priorities (file order)
+        self.rules.sort(key=lambda r: -r[1])
+        self.phrases = list(phrases)
+        self._automaton = _Automaton(self.phrases)
+        self.fingerprint = hashlib.sha256(
+            json.dumps([default, self.rules, self.phrases]).encode()).hexdigest()[:12]
+
+    @classmethod
+    def from_file(cls, path: str = RULES_FILE) -> "SlideClassifier":
+        with open(path, encoding="utf-8") as fh:
+            cfg = json.load(fh)
+        return cls(cfg["rules"], cfg.get("default", "OTHER"))
+
+    def _candidates(self, hits: Set[int]) -> List[Tuple[str, int, List[int]]]:
+        """Matching rules as (type, priority, phrase ids of the matched group)."""
+        out = []
+        for stype, prio, groups in self.rules:
+            group = next((g for g in groups if all(pid in hits for pid in g)), None)
+            if group is not None:
+                out.append((stype, prio, group))
+        return out
+
+    def _confidence(self, candidates: List[Tuple[str, int, List[int]]]) -> float:
+        """
+        1.0 for a lone match; lower the closer the runner‑up's priority.
+        A runner‑up whose phrases only occur inside the winner's phrases
+        (PERFORMANCEMAX inside PERFORMANCEMAX W/ VLA) doesn't count.
+        """
+        if not candidates:
+            return 1.0
+        win_type, top, win_group = candidates[0]
+        win_phrases = [self.phrases[pid] for pid in win_group]
+        rivals = [prio for stype, prio, group in candidates[1:]
+                  if stype != win_type and not all(
+                      any(self.phrases[pid] in w for w in win_phrases) for pid in group)]
+        if not rivals:
+            return 1.0
+        margin = (top - rivals[0]) / top if top > 0 else 0.0
+        return round(0.5 + 0.5 * margin, 3)
+
+    def score(self, text: str) -> Tuple[str, float]:
+        """(slide type, confidence 0–1) from one pass over text."""
+        candidates = self._candidates(set(self._automaton.scan(text.upper())))
+        stype = candidates[0][0] if candidates else self.default
+        return stype, self._confidence(candidates)
+
+    def classify(self, text: str) -> str:
+        return self.score(text)[0]
+
+    def explain(self, text: str) -> Dict[str, Any]:
+        """Which phrases matched where, and every rule that matched."""
+        found = self._automaton.scan(text.upper(), positions=True)
+        candidates = self._candidates(set(found))
+        return {
+            "type": candidates[0][0] if candidates else self.default,
+            "confidence": self._confidence(candidates),
+            "candidates": [{"type": t, "priority": p, "matched": [self.phrases[pid] for pid in g]}
+                           for t, p, g in candidates],
+            "matches": {self.phrases[pid]: [end - len(self.phrases[pid]) for end in ends]
+                        for pid, ends in sorted(found.items())},
+        }
+
+
+_default: Optional[SlideClassifier] = None
+
+
+def default_classifier() -> SlideClassifier:
+    """Classifier built from RULES_FILE, compiled once per process."""
+    global _default
+    if _default is None:
+        _default = SlideClassifier.from_file()
+    return _default
+
+
+if __name__ == "__main__":
+    # Explain mode: python slide_classifier.py "slide text" (or - for stdin)
+    import sys
+    text = sys.stdin.read() if sys.argv[1:] == ["-"] else " ".join(sys.argv[1:])
+    print(json.dumps(default_classifier().explain(text), indent=2))
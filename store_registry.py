@@ -0,0 +1,234 @@
+"""store_registry.py – canonical store identity
+-----------------------------------------------------------------
+* A store is keyed on the numeric account id that prefixes the deck
+  filename ("44305_-_Palmer_Chrysler_Dodge_Jeep_Ram(…).pptx" → 44305);
+  decks without an id get a name key ("n:lake city toyota")
+* Every spelling seen for a store – filename, LLM store_name, "CDJR" vs.
+  "Chrysler Dodge Jeep Ram", "St." vs. "St" – is kept as an alias, so
+  later decks resolve by exact alias first and fuzzy match second
+* The index (alias dict + token → store postings) lives in memory and is
+  reloaded only when the SQLite file changes; a lookup is a dict hit, and
+  a fuzzy match only compares the stores sharing a token with the name
+* Store.slug ("44305_Palmer_Chrysler_Dodge_Jeep_Ram") names the output
+  files, and Store.key keys kpi_history; CLI:
+      python store_registry.py list
+      python store_registry.py resolve "Palmer CDJR"
+"""
+
+from __future__ import annotations
+
+import difflib
+import os
+import re
+import sqlite3
+import time
+from dataclasses import asdict, dataclass
+from typing import ContextManager, Dict, List, Optional, Set, Tuple
+
+import deck_metadata
+import local_store
+
+REGISTRY_FILE = os.environ.get("STORE_REGISTRY_FILE", "store_registry.sqlite3")
+FUZZY_THRESHOLD = 0.88   # difflib ratio of normalised names
+FUZZY_CANDIDATES = 10    # stores sharing the rarest tokens that get compared
+DISTINCT_THRESHOLD = 0.8 # difflib ratio of the tokens the two names don't share
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stores (
+    key         TEXT PRIMARY KEY,   -- account id, or n:<normalised name>
+    account_id  TEXT,
+    name        TEXT NOT NULL,      -- canonical display name
+    first_seen  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias       TEXT PRIMARY KEY,   -- normalised name
+    key         TEXT NOT NULL REFERENCES stores(key)
+) WITHOUT ROWID;
+"""
+
+# spellings that mean the same thing in dealership names
+_SYNONYMS = {"cdjr": "chrysler dodge jeep ram", "st": "saint", "chevy": "chevrolet", "vw": "volkswagen"}
+
+
+@dataclass(frozen=True)
+class Store:
+    key: str
+    account_id: Optional[str]
+    name: str
+
+    @property
+    def slug(self) -> str:
+        name = re.sub(r"[^A-Za-z0-9]+", "_", self.name).strip("_") or "Unknown_Dealership"
+        return f"{self.account_id}_{name}" if self.account_id else name
+
+    def as_dict(self) -> Dict[str, Optional[str]]:
+        return dict(asdict(self), slug=self.slug)
+
+
+# a deck that names no store: never registered, never keys any history
+UNKNOWN = Store("", None, "Unknown Dealership")
+
+
+def normalize(name: str) -> str:
+    """Comparable form of a store name: lower case, no punctuation, synonyms expanded."""
+    name = re.sub(r"(\w)'s\b|(\w)_s_", r"\1\2s ", name.lower())
+    tokens = re.sub(r"[^a-z0-9]+", " ", name).split()
+    return " ".join(_SYNONYMS.get(t, t) for t in tokens)
+
+
+def split_filename(filename: str) -> Tuple[Optional[str], str]:
+    """(account id or None, display name) from a deck filename."""
+    meta = deck_metadata.from_filename(filename)
+    return meta.get("account_id"), meta.get("store_name", "")
+
+
+def _db() -> ContextManager[sqlite3.Connection]:
+    return local_store.connect(REGISTRY_FILE, _SCHEMA, synchronous="NORMAL")
+
+
+# ---------------------------------------------------------------------------
+#  INDEX
+# ---------------------------------------------------------------------------
+
+class _Index(local_store.StampedIndex):
+    """stores by key, alias → key, and token → keys, rebuilt when the file changes."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.stores: Dict[str, Store] = {}
+        self.aliases: Dict[str, str] = {}
+        self.by_key: Dict[str, List[str]] = {}
+        self.tokens: Dict[str, Set[str]] = {}
+
+    def path(self) -> str:
+        return REGISTRY_FILE
+
+    def connect(self) -> ContextManager[sqlite3.Connection]:
+        return _db()
+
+    def add(self, alias: str, key: str) -> None:
+        self.aliases[alias] = key
+        self.by_key.setdefault(key, []).append(alias)
+        for token in alias.split():
+            self.tokens.setdefault(token, set()).add(key)
+
+    def load(self, conn: Optional[sqlite3.Connection]) -> None:
+        # called under self.lock, which every reader of these dicts takes
+        self.stores, self.aliases, self.by_key, self.tokens = {}, {}, {}, {}
+        if conn is not None:
+            for key, account_id, name in conn.execute("SELECT key, account_id, name FROM stores"):
+                self.stores[key] = Store(key, account_id, name)
+            for alias, key in conn.execute("SELECT alias, key FROM aliases"):
+                self.add(alias, key)
+
+    def fuzzy(self, alias: str) -> Optional[str]:
+        # rank stores by shared tokens, rare tokens ("palmer") counting more than
+        # common ones ("toyota"), and only compare the best few
+        weight: Dict[str, float] = {}
+        for token in set(alias.split()):
+            postings = self.tokens.get(token, ())
+            for key in postings:
+                weight[key] = weight.get(key, 0.0) + 1.0 / len(postings)
+        candidates = sorted(weight, key=weight.get, reverse=True)[:FUZZY_CANDIDATES]
+        best, best_ratio = None, FUZZY_THRESHOLD
+        tokens = alias.split()
+        for key in candidates:
+            for other in self.by_key.get(key, ()):
+                ratio = difflib.SequenceMatcher(None, alias, other).ratio()
+                if ratio < best_ratio:
+                    continue
+                # a shared brand suffix carries the ratio, so the words that
+                # tell two stores apart must match too: "palmr" ~ "palmer",
+                # but not "parker" ~ "palmer"
+                other_tokens = other.split()
+                mine = " ".join(t for t in tokens if t not in other_tokens)
+                theirs = " ".join(t for t in other_tokens if t not in tokens)
+                if (mine or theirs) and \
+                        difflib.SequenceMatcher(None, mine, theirs).ratio() < DISTINCT_THRESHOLD:
+                    continue
+                best, best_ratio = key, ratio
+        return best
+
+
+_index = _Index()
+
+
+# ---------------------------------------------------------------------------
+#  LOOKUP
+# ---------------------------------------------------------------------------
+
+def find(store_name: str) -> Optional[Store]:
+    """Known store for a name (exact alias, then fuzzy), without registering anything."""
+    _index.refresh()
+    alias = normalize(store_name or "")
+    if not alias:
+        return None
+    # resolve() adds aliases from the pipeline's render threads while
+    # find() runs in its LLM threads (deck_metadata.known_fields)
+    with _index.lock:
+        key = _index.aliases.get(alias) or _index.fuzzy(alias)
+        return _index.stores.get(key) if key else None
+
+
+def resolve(filename: Optional[str] = None, store_name: Optional[str] = None) -> Store:
+    """
+    Canonical store for a deck: the filename's account id wins, then any
+    known alias of the filename name or the extracted store_name, then a
+    fuzzy match; otherwise a new store is registered. New spellings are
+    remembered as aliases of the store they resolved to. A deck with
+    neither an id nor a name gets an unregistered store with an empty key
+    (UNKNOWN), so unrelated unknown decks never share a history.
+    """
+    account_id, file_name = split_filename(filename or "")
+    names = [n for n in (file_name, (store_name or "").strip()) if normalize(n)]
+    if not account_id and not names:
+        return UNKNOWN
+    _index.refresh()
+    with _index.lock:
+        store = _index.stores.get(account_id) if account_id else None
+        if store is None and not account_id:
+            store = next(filter(None, (find(n) for n in names)), None)
+        if store is None:
+            name = names[0] if names else "Unknown Dealership"   # id only
+            key = account_id or "n:" + normalize(name)
+            store = _index.stores.get(key) or Store(key, account_id, name)
+        new_aliases = {normalize(n) for n in names} - set(_index.aliases)
+        if store.key not in _index.stores or new_aliases:
+            _register(store, new_aliases)
+    return store
+
+
+def _register(store: Store, aliases: Set[str]) -> None:
+    try:
+        with _db() as conn, conn:
+            conn.execute("INSERT OR IGNORE INTO stores (key, account_id, name, first_seen) VALUES (?, ?, ?, ?)",
+                         (store.key, store.account_id, store.name, time.time()))
+            conn.executemany("INSERT OR IGNORE INTO aliases (alias, key) VALUES (?, ?)",
+                             [(a, store.key) for a in aliases])
+    except sqlite3.Error as e:
+        # an unregistered store still resolves for this deck
+        print(f"Store registry write failed: {e}")
+    with _index.wrote():
+        _index.stores.setdefault(store.key, store)
+        for alias in aliases:
+            _index.add(alias, store.key)
+
+
+def stores() -> List[Store]:
+    _index.refresh()
+    with _index.lock:
+        return sorted(_index.stores.values(), key=lambda s: s.name.lower())
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["list"]:
+        for s in stores():
+            aliases = sorted(_index.by_key.get(s.key, ()))
+            print(f"{s.key:40} {s.name:40} {'; '.join(aliases)}")
+    elif sys.argv[1:2] == ["resolve"] and len(sys.argv) == 3:
+        arg = sys.argv[2]
+        print(resolve(filename=arg) if arg.lower().endswith(".pptx") else find(arg))
+    else:
+        sys.exit('usage: python store_registry.py list | resolve "name or deck.pptx"')